@@ -1,17 +1,19 @@
+import concurrent.futures
+import itertools
+import threading
 import transport
 import encryption
 import socket
-import json
+import queue
+import codec
 
 
-def getConnection(IP: str, port: int, publicKey) -> (bytes, socket.socket):  # Given the IP, port and public key of a
-    # server, get an AES key for encryption and a socket with which to communicate with
-    servSocket = socket.socket()
+def getConnection(IP: str, port: int, publicKey, sessionTicket: tuple = None) -> (bytes, socket.socket):  # Given the
+    # IP, port and public key of a server, get an AES key for encryption and a socket with which to communicate with.
+    # If a session ticket from an earlier connection (its sessionTicket) is given, RSA is skipped where possible
+    servSocket = transport.Connection(socket.socket())
     servSocket.connect((IP, port))
-    AESKey = encryption.generateKey()
-    AESEncrypted = encryption.encryptDataRSA(publicKey, AESKey)
-    transport.sendData(AESEncrypted, servSocket)
-    transport.sendEncryptedData(b"\x01", servSocket, AESKey)
+    AESKey = transport.connectToServer(servSocket, publicKey, True, sessionTicket)
     return AESKey, servSocket
 
 
@@ -21,17 +23,30 @@ def sendMessage(servSocket: socket.socket, AESKey: bytes, message: str,
     if sessionToken is None:
         sessionToken = {"id": "0", "randomBytes": "0", "groupID": "1"}  # If the session token is not given,
         # Set it to be default
+    binary = transport.usesBinary(servSocket)
     messageAndToken = {"message": message,
-                       "sessionToken": json.dumps(sessionToken)}
-    toSend = json.dumps(messageAndToken)
-    transport.sendDynamicData(toSend.encode("utf-8"), "message", "utf-8", servSocket, AESKey)
+                       "sessionToken": codec.encodeToken(sessionToken, binary)}
+    toSend, encoding = codec.encode(messageAndToken, binary)
+    transport.sendDynamicData(toSend, "message", encoding, servSocket, AESKey)
 
 
-def getMessages(servSocket: socket.socket, AESKey: bytes, sessionToken: dict) -> list:  # Gets a list of messages
-    toSend = json.dumps(sessionToken)
-    transport.sendDynamicData(toSend.encode("utf-8"), "getMessages", "utf-8", servSocket, AESKey)
+def getMessagePage(servSocket: socket.socket, AESKey: bytes, sessionToken: dict, limit: int = 100, since: int = None,
+                   before: int = None) -> dict:  # Gets a page of messages from the current group. With since, these
+    # are the messages after that message ID; with before, the ones before that ID; otherwise, the latest ones. IDs
+    # come from the server connected to, so in a cluster they can't be used with another node
+    binary = transport.usesBinary(servSocket)
+    request = {"token": codec.encodeToken(sessionToken, binary), "limit": limit, "since": since, "before": before}
+    toSend, encoding = codec.encode(request, binary)
+    transport.sendDynamicData(toSend, "getMessages", encoding, servSocket, AESKey)
     dataType, encoding, data = transport.receiveDynamicData(servSocket, AESKey)
-    return json.loads(data.decode(encoding))
+    return codec.decode(data, encoding)  # In the form {"group": ..., "messages": [{"id": ..., "message": ...}],
+    # "hasMore": ...}
+
+
+def getMessages(servSocket: socket.socket, AESKey: bytes, sessionToken: dict, limit: int = 100,
+                since: int = None) -> list:  # Gets a list of messages
+    page = getMessagePage(servSocket, AESKey, sessionToken, limit, since)
+    return [message["message"] for message in page["messages"]]
 
 
 def login(servSocket: socket.socket, AESKey: bytes, username: str, password: str) -> dict:  # Logs in, and gives a
@@ -39,64 +54,80 @@ def login(servSocket: socket.socket, AESKey: bytes, username: str, password: str
     # Be aware, the username must include the user ID, in the format username:ID
     usernamePassword = {"username": username,
                         "password": password}
-    toSend = json.dumps(usernamePassword)
-    transport.sendDynamicData(toSend.encode("utf-8"), "login", "utf-8", servSocket, AESKey)
+    toSend, encoding = codec.encode(usernamePassword, transport.usesBinary(servSocket))
+    transport.sendDynamicData(toSend, "login", encoding, servSocket, AESKey)
+    dataType, encoding, data = transport.receiveDynamicData(servSocket, AESKey)
+    newToken = codec.decode(data, encoding)
+    return codec.decodeToken(newToken["newToken"])
+
+
+def logout(servSocket: socket.socket, AESKey: bytes):  # Logs out, going back to being a guest in the default group
+    transport.sendDynamicData(b"", "logout", "none", servSocket, AESKey)
+
+
+def profileServer(servSocket: socket.socket, AESKey: bytes, seconds: float) -> dict:  # Profiles the server (which
+    # only admins can do), waiting for the report of where its threads spent their time
+    toSend, encoding = codec.encode({"seconds": seconds}, transport.usesBinary(servSocket))
+    transport.sendDynamicData(toSend, "profile", encoding, servSocket, AESKey)
     dataType, encoding, data = transport.receiveDynamicData(servSocket, AESKey)
-    newToken = json.loads(data.decode("utf-8"))
-    return json.loads(newToken["newToken"])
+    if dataType != "profileReport":
+        raise RequestError(data.decode(encoding).strip())
+    return codec.decode(data, encoding)
 
 
 def makeGroup(servSocket: socket.socket, AESKey: bytes, groupName: str) -> int:  # Creates a group and gives the ID of
     # said group
     groupData = {"groupName": groupName}  # Packages the necessary information into one object
-    toSend = json.dumps(groupData)
-    transport.sendDynamicData(toSend.encode("utf-8"), "makeGroup", "utf-8", servSocket, AESKey)
+    toSend, encoding = codec.encode(groupData, transport.usesBinary(servSocket))
+    transport.sendDynamicData(toSend, "makeGroup", encoding, servSocket, AESKey)
     dataType, encoding, data = transport.receiveDynamicData(servSocket, AESKey)
-    groupInfo = json.loads(data.decode(encoding))
+    groupInfo = codec.decode(data, encoding)
     return int(groupInfo["groupID"])
 
 
 def switchToGroup(servSocket: socket.socket, AESKey: bytes, groupID: int) -> dict:  # Switch to a group, so that when
     # A message is sent, it is sent to that group
     groupData = {"groupToSwitchTo": groupID}
-    toSend = json.dumps(groupData)
-    transport.sendDynamicData(toSend.encode("utf-8"), "switchGroup", "utf-8", servSocket, AESKey)
+    toSend, encoding = codec.encode(groupData, transport.usesBinary(servSocket))
+    transport.sendDynamicData(toSend, "switchGroup", encoding, servSocket, AESKey)
     dataType, encoding, data = transport.receiveDynamicData(servSocket, AESKey)
-    newToken = json.loads(data.decode(encoding))
+    newToken = codec.decode(data, encoding)
     return newToken
 
 
 def addUserToGroup(servSocket: socket.socket, AESKey: bytes, groupID: int, userID: int):
     groupData = {"groupID": groupID, "userID": userID}  # Packages the group's and user's ID together
-    toSend = json.dumps(groupData)
-    transport.sendDynamicData(toSend.encode("utf-8"), "addUserToGroup", "utf-8", servSocket, AESKey)
+    toSend, encoding = codec.encode(groupData, transport.usesBinary(servSocket))
+    transport.sendDynamicData(toSend, "addUserToGroup", encoding, servSocket, AESKey)
 
 
 def leaveGroup(servSocket: socket.socket, AESKey: bytes, groupID: int, sessionToken: dict):
-    relevantData = {"token": json.dumps(sessionToken),
+    binary = transport.usesBinary(servSocket)
+    relevantData = {"token": codec.encodeToken(sessionToken, binary),
                     "group": groupID}
-    toBeSent = json.dumps(relevantData)
-    transport.sendDynamicData(toBeSent.encode("utf-8"), "leaveGroup", "utf-8", servSocket, AESKey)
+    toBeSent, encoding = codec.encode(relevantData, binary)
+    transport.sendDynamicData(toBeSent, "leaveGroup", encoding, servSocket, AESKey)
 
 
 def listGroups(servSocket: socket.socket, AESKey: bytes, sessionToken: dict) -> list:  # Gives a list of groups which
     # The API is in
-    relevantData = {"token": json.dumps(sessionToken)}
-    toSend = json.dumps(relevantData)
-    transport.sendDynamicData(toSend.encode("utf-8"), "getGroups", "utf-8", servSocket, AESKey)
+    binary = transport.usesBinary(servSocket)
+    relevantData = {"token": codec.encodeToken(sessionToken, binary)}
+    toSend, encoding = codec.encode(relevantData, binary)
+    transport.sendDynamicData(toSend, "getGroups", encoding, servSocket, AESKey)
     dataType, encoding, data = transport.receiveDynamicData(servSocket, AESKey)
-    return json.loads(data.decode(encoding))
+    return codec.decode(data, encoding)
 
 
 def makeAccount(servSocket: socket.socket, AESKey: bytes, username: str, password: str) -> dict:  # Makes an account,
     # and gives a session token
     usernamePassword = {"username": username,
                         "password": password}
-    toSend = json.dumps(usernamePassword)
-    transport.sendDynamicData(toSend.encode("utf-8"), "makeAccount", "utf-8", servSocket, AESKey)
+    toSend, encoding = codec.encode(usernamePassword, transport.usesBinary(servSocket))
+    transport.sendDynamicData(toSend, "makeAccount", encoding, servSocket, AESKey)
     dataType, encoding, data = transport.receiveDynamicData(servSocket, AESKey)
-    newToken = json.loads(data.decode("utf-8"))
-    return json.loads(newToken["newToken"])
+    newToken = codec.decode(data, encoding)
+    return codec.decodeToken(newToken["newToken"])
 
 
 def heartBeat(servSocket: socket.socket, AESKey: bytes):  # Performs a heartbeat so the program doesn't stop before the
@@ -105,3 +136,208 @@ def heartBeat(servSocket: socket.socket, AESKey: bytes):  # Performs a heartbeat
     transport.sendDynamicData(toSend, "doHeartbeat", "none", servSocket,
                               AESKey)  # Tell the server to perform a heartbeat
     transport.receiveDynamicData(servSocket, AESKey)
+
+
+class RequestError(Exception):  # Raised by a request which the server couldn't carry out
+    pass
+
+
+class PipelinedClient:  # A connection on which many requests can be waiting at once. Each request is numbered, and
+    # a reader thread matches every reply to its request by that number, so calls give futures rather than waiting for
+    # their reply. Messages from the group (which have no number) are put in the messages queue instead of being
+    # mistaken for a reply
+    def __init__(self, IP: str, port: int, publicKey, sessionTicket: tuple = None):
+        self.AESKey, self.servSocket = getConnection(IP, port, publicKey, sessionTicket)
+        if self.servSocket.protocolVersion < transport.PROTOCOL_REQUEST_IDS:
+            self.servSocket.close()
+            raise ConnectionError("The server doesn't support numbered requests")
+        self.binary = transport.usesBinary(self.servSocket)  # Whether payloads are packed rather than sent as JSON
+        self.requestIDs = itertools.count(1)
+        self.lock = threading.Lock()
+        self.pending = {}  # Maps the ID of each request still waiting for its reply to its future, and the function
+        # which turns the reply into the future's result
+        self.messages = queue.Queue()  # Data sent without being asked for, as (type, encoding, data)
+        self.closed = False
+        reader = threading.Thread(target=self.receive, daemon=True)
+        reader.start()
+
+    def receive(self) -> None:  # Hands every reply to its request's future, until the connection goes
+        while True:
+            try:
+                dataType, encoding, data, requestID = transport.receiveRequest(self.servSocket, self.AESKey)
+            except (OSError, ValueError) as e:
+                self.failPending(ConnectionError(f"The connection was lost: {e}"))
+                return None
+            if requestID is None:
+                self.messages.put((dataType, encoding, data))
+                continue
+            with self.lock:
+                future, parse = self.pending.pop(requestID, (None, None))
+            if future is None:  # A reply to a request which has been given up on
+                continue
+            if dataType == "error":
+                future.set_exception(RequestError(data.decode(encoding).strip()))
+                continue
+            try:
+                future.set_result(parse(dataType, encoding, data))
+            except Exception as e:  # If the reply is not what the request expected
+                future.set_exception(e)
+
+    def failPending(self, error: Exception) -> None:
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future, parse in pending:
+            future.set_exception(error)
+
+    def register(self, parse) -> (int, concurrent.futures.Future):  # Gives a new request its ID and future
+        future = concurrent.futures.Future()
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("The connection has been closed")
+            requestID = next(self.requestIDs)
+            self.pending[requestID] = (future, parse)
+        return requestID, future
+
+    def request(self, data: bytes, typeOfData: str, encoding: str, parse) -> concurrent.futures.Future:  # Sends a
+        # request which the server replies to, giving a future for the reply (as turned into a result by parse)
+        requestID, future = self.register(parse)
+        try:
+            transport.sendDynamicData(data, typeOfData, encoding, self.servSocket, self.AESKey, requestID)
+        except OSError as e:
+            with self.lock:
+                self.pending.pop(requestID, None)
+            future.set_exception(e)
+        return future
+
+    def send(self, data: bytes, typeOfData: str, encoding: str) -> None:  # Sends a request which has no reply
+        transport.sendDynamicData(data, typeOfData, encoding, self.servSocket, self.AESKey)
+
+    def batch(self, requests: list) -> list:  # Sends many requests, given as (data, type, encoding, parse), in one
+        # write, giving their futures in the same order
+        frames = []
+        futures = []
+        for data, typeOfData, encoding, parse in requests:
+            requestID, future = self.register(parse)
+            frames.append(transport.sealFrame(data, typeOfData, encoding, self.AESKey, requestID))
+            futures.append(future)
+        transport.sendSealedFrame(b"".join(frames), self.servSocket)
+        return futures
+
+    def close(self) -> None:
+        self.servSocket.close()
+        self.failPending(ConnectionError("The connection has been closed"))
+
+    # Each of these makes the same request as the function of the same name above, and gives a future for its result
+
+    def login(self, username: str, password: str) -> concurrent.futures.Future:
+        return self.request(*loginRequest(username, password, self.binary))
+
+    def makeAccount(self, username: str, password: str) -> concurrent.futures.Future:
+        return self.request(*makeAccountRequest(username, password, self.binary))
+
+    def makeGroup(self, groupName: str) -> concurrent.futures.Future:
+        return self.request(*makeGroupRequest(groupName, self.binary))
+
+    def switchToGroup(self, groupID: int) -> concurrent.futures.Future:
+        return self.request(*switchToGroupRequest(groupID, self.binary))
+
+    def addUserToGroup(self, groupID: int, userID: int) -> concurrent.futures.Future:  # Its result is the server's
+        # message saying whether it worked
+        return self.request(*addUserToGroupRequest(groupID, userID, self.binary))
+
+    def listGroups(self, sessionToken: dict) -> concurrent.futures.Future:
+        return self.request(*listGroupsRequest(sessionToken, self.binary))
+
+    def getMessagePage(self, sessionToken: dict, limit: int = 100, since: int = None,
+                       before: int = None) -> concurrent.futures.Future:
+        return self.request(*getMessagePageRequest(sessionToken, limit, since, before, self.binary))
+
+    def getMessages(self, sessionToken: dict, limit: int = 100, since: int = None) -> concurrent.futures.Future:
+        return self.request(*getMessagesRequest(sessionToken, limit, since, self.binary))
+
+    def heartBeat(self) -> concurrent.futures.Future:
+        return self.request(encryption.generateKey(), "doHeartbeat", "none", lambda *reply: None)
+
+    def sendMessage(self, message: str, sessionToken: dict = None) -> None:
+        self.send(*messageRequest(message, sessionToken, self.binary))
+
+    def logout(self) -> None:
+        self.send(b"", "logout", "none")
+
+    def leaveGroup(self, groupID: int, sessionToken: dict) -> None:
+        self.send(*leaveGroupRequest(groupID, sessionToken, self.binary))
+
+
+# These give the (data, type, encoding, parse) of a request which has a reply, for PipelinedClient.request and batch.
+# parse is given the reply's type, encoding and data. binary is whether the connection packs its payloads (see
+# transport.usesBinary)
+
+def parsePayload(dataType: str, encoding: str, data: bytes):
+    return codec.decode(data, encoding)
+
+
+def parseToken(dataType: str, encoding: str, data: bytes) -> dict:
+    return codec.decodeToken(codec.decode(data, encoding)["newToken"])
+
+
+def loginRequest(username: str, password: str, binary: bool = False) -> tuple:
+    toSend, encoding = codec.encode({"username": username, "password": password}, binary)
+    return toSend, "login", encoding, parseToken
+
+
+def makeAccountRequest(username: str, password: str, binary: bool = False) -> tuple:
+    toSend, encoding = codec.encode({"username": username, "password": password}, binary)
+    return toSend, "makeAccount", encoding, parseToken
+
+
+def makeGroupRequest(groupName: str, binary: bool = False) -> tuple:
+    toSend, encoding = codec.encode({"groupName": groupName}, binary)
+    return (toSend, "makeGroup", encoding,
+            lambda dataType, encoding, data: int(parsePayload(dataType, encoding, data)["groupID"]))
+
+
+def switchToGroupRequest(groupID: int, binary: bool = False) -> tuple:
+    toSend, encoding = codec.encode({"groupToSwitchTo": groupID}, binary)
+    return toSend, "switchGroup", encoding, parsePayload
+
+
+def addUserToGroupRequest(groupID: int, userID: int, binary: bool = False) -> tuple:
+    toSend, encoding = codec.encode({"groupID": groupID, "userID": userID}, binary)
+    return (toSend, "addUserToGroup", encoding,
+            lambda dataType, encoding, data: data.decode(encoding).strip())
+
+
+def listGroupsRequest(sessionToken: dict, binary: bool = False) -> tuple:
+    toSend, encoding = codec.encode({"token": codec.encodeToken(sessionToken, binary)}, binary)
+    return toSend, "getGroups", encoding, parsePayload
+
+
+def getMessagePageRequest(sessionToken: dict, limit: int = 100, since: int = None, before: int = None,
+                          binary: bool = False) -> tuple:
+    toSend, encoding = codec.encode({"token": codec.encodeToken(sessionToken, binary), "limit": limit,
+                                     "since": since, "before": before}, binary)
+    return toSend, "getMessages", encoding, parsePayload
+
+
+def getMessagesRequest(sessionToken: dict, limit: int = 100, since: int = None, binary: bool = False) -> tuple:
+    data, typeOfData, encoding, parse = getMessagePageRequest(sessionToken, limit, since, binary=binary)
+    return (data, typeOfData, encoding,
+            lambda dataType, encoding, data: [message["message"] for message in parsePayload(dataType, encoding,
+                                                                                             data)["messages"]])
+
+
+# These give the (data, type, encoding) of a request which has no reply
+
+def messageRequest(message: str, sessionToken: dict = None, binary: bool = False) -> tuple:
+    if sessionToken is None:
+        sessionToken = {"id": "0", "randomBytes": "0", "groupID": "1"}
+    toSend, encoding = codec.encode({"message": message, "sessionToken": codec.encodeToken(sessionToken, binary)},
+                                    binary)
+    return toSend, "message", encoding
+
+
+def leaveGroupRequest(groupID: int, sessionToken: dict, binary: bool = False) -> tuple:
+    toSend, encoding = codec.encode({"token": codec.encodeToken(sessionToken, binary), "group": groupID}, binary)
+    return toSend, "leaveGroup", encoding
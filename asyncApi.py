@@ -0,0 +1,209 @@
+import contextlib
+import collections
+import itertools
+import asyncio
+import transport
+import encryption
+import api
+
+DEFAULT_TOKEN = {"id": "0", "randomBytes": "0", "groupID": "1"}
+
+
+class AsyncConnection:  # A connection to a server, for use on an asyncio event loop. A task reads everything the
+    # server sends: replies are handed to the request waiting for them (matched by number, or in order with servers
+    # too old to number them), and messages from the group are queued to be iterated over with async for
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, AESKey: bytes,
+                 protocolVersion: int, sessionTicket: (bytes, bytes)):
+        self.reader = reader
+        self.writer = writer
+        self.AESKey = AESKey
+        self.protocolVersion = protocolVersion
+        self.binary = transport.usesBinary(self)  # Whether payloads are packed rather than sent as JSON
+        self.sessionTicket = sessionTicket  # Can be given to getConnection to skip RSA when connecting again
+        self.sessionToken = DEFAULT_TOKEN  # The token from logging in, kept for the caller (e.g. by ConnectionPool)
+        self.groupKeys = {}
+        self.requestIDs = itertools.count(1)
+        self.pending = {}  # Maps the number of each request waiting for its reply to its future and parse function
+        self.unnumbered = collections.deque()  # The same, in the order sent, when the server can't number replies
+        self.messages = asyncio.Queue()  # Messages from the group, as (type, encoding, data), then None once closed
+        self.closed = False
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def receive(self) -> None:
+        try:
+            while True:
+                dataType, encoding, data, requestID = await transport.receiveRequestAsync(
+                    self.reader, self.AESKey, self.protocolVersion, self.groupKeys)
+                if requestID is not None:
+                    future, parse = self.pending.pop(requestID, (None, None))
+                elif dataType != "message" and self.unnumbered:  # Older servers reply in order, without numbers
+                    future, parse = self.unnumbered.popleft()
+                else:
+                    await self.messages.put((dataType, encoding, data))
+                    continue
+                if future is None or future.done():  # If the request has been given up on
+                    continue
+                if dataType == "error":
+                    future.set_exception(api.RequestError(data.decode(encoding).strip()))
+                    continue
+                try:
+                    future.set_result(parse(dataType, encoding, data))
+                except Exception as e:  # If the reply is not what the request expected
+                    future.set_exception(e)
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            self.fail(ConnectionError(f"The connection was lost: {e}"))
+
+    def fail(self, error: Exception) -> None:  # Fails every request still waiting, and ends the messages
+        if self.closed:
+            return None
+        self.closed = True
+        for future, parse in list(self.pending.values()) + list(self.unnumbered):
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+        self.unnumbered.clear()
+        self.messages.put_nowait(None)
+
+    async def request(self, data: bytes, typeOfData: str, encoding: str, parse):  # Sends a request which the
+        # server replies to, and gives the reply (as turned into a result by parse)
+        if self.closed:
+            raise ConnectionError("The connection has been closed")
+        future = asyncio.get_running_loop().create_future()
+        requestID = None
+        if self.protocolVersion >= transport.PROTOCOL_REQUEST_IDS:
+            requestID = next(self.requestIDs)
+            self.pending[requestID] = (future, parse)
+        else:
+            self.unnumbered.append((future, parse))
+        await transport.sendDynamicDataAsync(data, typeOfData, encoding, self.writer, self.AESKey,
+                                             self.protocolVersion, requestID)
+        return await future
+
+    async def send(self, data: bytes, typeOfData: str, encoding: str) -> None:  # Sends a request which has no reply
+        await transport.sendDynamicDataAsync(data, typeOfData, encoding, self.writer, self.AESKey,
+                                             self.protocolVersion)
+
+    def __aiter__(self):  # Iterates over the group's messages, as strings, until the connection closes
+        return self
+
+    async def __anext__(self) -> str:
+        while True:
+            item = await self.messages.get()
+            if item is None:
+                self.messages.put_nowait(None)  # So that any other iterators stop too
+                raise StopAsyncIteration
+            dataType, encoding, data = item
+            if dataType == "message":
+                return data.decode(encoding)
+
+    async def close(self) -> None:
+        self.writer.close()
+        self.receiver.cancel()
+        self.fail(ConnectionError("The connection has been closed"))
+        with contextlib.suppress(OSError):
+            await self.writer.wait_closed()
+
+
+async def getConnection(IP: str, port: int, publicKey, sessionTicket: tuple = None) -> AsyncConnection:  # The same
+    # as api.getConnection, but the AES key is kept in the connection
+    reader, writer = await asyncio.open_connection(IP, port)
+    try:
+        AESKey, protocolVersion, newTicket = await transport.connectToServerAsync(reader, writer, publicKey, True,
+                                                                                  sessionTicket)
+    except BaseException:
+        writer.close()
+        raise
+    return AsyncConnection(reader, writer, AESKey, protocolVersion, newTicket)
+
+
+# These do the same as the functions of the same name in api, sharing how their requests are made and their replies
+# read
+
+async def sendMessage(connection: AsyncConnection, message: str, sessionToken: dict = None) -> None:
+    await connection.send(*api.messageRequest(message, sessionToken, connection.binary))
+
+
+async def getMessagePage(connection: AsyncConnection, sessionToken: dict, limit: int = 100, since: int = None,
+                         before: int = None) -> dict:
+    return await connection.request(*api.getMessagePageRequest(sessionToken, limit, since, before, connection.binary))
+
+
+async def getMessages(connection: AsyncConnection, sessionToken: dict, limit: int = 100, since: int = None) -> list:
+    return await connection.request(*api.getMessagesRequest(sessionToken, limit, since, connection.binary))
+
+
+async def login(connection: AsyncConnection, username: str, password: str) -> dict:  # The username must include the
+    # user ID, in the format username:ID
+    return await connection.request(*api.loginRequest(username, password, connection.binary))
+
+
+async def logout(connection: AsyncConnection) -> None:
+    await connection.send(b"", "logout", "none")
+
+
+async def makeAccount(connection: AsyncConnection, username: str, password: str) -> dict:
+    return await connection.request(*api.makeAccountRequest(username, password, connection.binary))
+
+
+async def makeGroup(connection: AsyncConnection, groupName: str) -> int:
+    return await connection.request(*api.makeGroupRequest(groupName, connection.binary))
+
+
+async def switchToGroup(connection: AsyncConnection, groupID: int) -> dict:
+    return await connection.request(*api.switchToGroupRequest(groupID, connection.binary))
+
+
+async def addUserToGroup(connection: AsyncConnection, groupID: int, userID: int) -> str:  # Gives the server's
+    # message saying whether it worked, if the server is new enough to always give one
+    data, typeOfData, encoding, parse = api.addUserToGroupRequest(groupID, userID, connection.binary)
+    if connection.protocolVersion >= transport.PROTOCOL_REQUEST_IDS:  # Only numbered requests are always replied to
+        return await connection.request(data, typeOfData, encoding, parse)
+    await connection.send(data, typeOfData, encoding)
+    return None
+
+
+async def leaveGroup(connection: AsyncConnection, groupID: int, sessionToken: dict) -> None:
+    await connection.send(*api.leaveGroupRequest(groupID, sessionToken, connection.binary))
+
+
+async def listGroups(connection: AsyncConnection, sessionToken: dict) -> list:
+    return await connection.request(*api.listGroupsRequest(sessionToken, connection.binary))
+
+
+async def heartBeat(connection: AsyncConnection) -> None:
+    await connection.request(encryption.generateKey(), "doHeartbeat", "none", lambda *reply: None)
+
+
+class ConnectionPool:  # Several connections to one server, each with its own session, which callers take turns
+    # with. Only the first connection pays for RSA; the rest resume its session ticket
+    def __init__(self, IP: str, port: int, publicKey, size: int = 4):
+        self.IP = IP
+        self.port = port
+        self.publicKey = publicKey
+        self.size = size
+        self.connections = []
+        self.idle = asyncio.Queue()  # The connections which aren't being used
+
+    async def open(self, credentials: list = None) -> None:  # Connects, logging each connection in with its own
+        # (username, password) from credentials if they are given
+        first = await getConnection(self.IP, self.port, self.publicKey)
+        self.connections = [first] + list(await asyncio.gather(
+            *(getConnection(self.IP, self.port, self.publicKey, first.sessionTicket) for i in range(self.size - 1))))
+        if credentials is not None:
+            tokens = await asyncio.gather(*(login(connection, username, password) for connection, (username, password)
+                                            in zip(self.connections, credentials)))
+            for connection, token in zip(self.connections, tokens):
+                connection.sessionToken = token
+        for connection in self.connections:
+            self.idle.put_nowait(connection)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):  # Gives a connection which no one else is using, until the with block ends
+        connection = await self.idle.get()
+        try:
+            yield connection
+        finally:
+            self.idle.put_nowait(connection)
+
+    async def close(self) -> None:
+        await asyncio.gather(*(connection.close() for connection in self.connections))
@@ -0,0 +1,56 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import storage
+
+JOURNAL_MODES = {"rollback": ("PRAGMA journal_mode=DELETE", "PRAGMA synchronous=FULL"),  # sqlite's defaults
+                 "wal": storage.PRAGMAS}
+
+
+def measure(journalMode: str, threadCount: int, accountCount: int, batchSize: int) -> dict:  # Creates accounts (each
+    # joining the default group) from several threads at once
+    workingDirectory = tempfile.mkdtemp(prefix="chatroom-bench-")
+    storage.PRAGMAS = JOURNAL_MODES[journalMode]
+    database = storage.SQLDatabase(os.path.join(workingDirectory, "database.db"), max(threadCount, 1))
+    perThread = accountCount // threadCount
+
+    def createAccounts(threadIndex: int):
+        for start in range(0, perThread, batchSize):
+            users = [(f"user{threadIndex}-{i}", "hashedPassword")
+                     for i in range(start, min(start + batchSize, perThread))]
+            if batchSize == 1:
+                userID = database.addUser(*users[0])
+                database.addUserToGroup(userID, 1)
+            else:
+                userIDs = database.addUsers(users)
+                database.addUsersToGroups([(userID, 1) for userID in userIDs])
+
+    threads = [threading.Thread(target=createAccounts, args=(i,)) for i in range(threadCount)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    database.closeConnection()
+    shutil.rmtree(workingDirectory, ignore_errors=True)
+    return {"journalMode": journalMode,
+            "threads": threadCount,
+            "batchSize": batchSize,
+            "accountsPerSecond": perThread * threadCount / elapsed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how quickly accounts can be created from several threads")
+    parser.add_argument("--accounts", type=int, default=2000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--batch-size", type=int, default=100, help="how many accounts are added at once in the "
+                                                                      "batched runs")
+    arguments = parser.parse_args()
+    for journalMode in JOURNAL_MODES:
+        for threadCount in arguments.threads:
+            for batchSize in (1, arguments.batch_size):
+                print(measure(journalMode, threadCount, arguments.accounts, batchSize))
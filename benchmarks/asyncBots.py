@@ -0,0 +1,114 @@
+import json
+import time
+import asyncio
+import argparse
+import asyncApi
+from benchmarks import common
+
+
+class Barrier:  # Lets every bot wait until all of them have reached the same point
+    def __init__(self, count: int):
+        self.count = count
+        self.arrived = 0
+        self.reached = asyncio.Event()
+
+    async def wait(self) -> None:
+        self.arrive()
+        await self.reached.wait()
+
+    def arrive(self) -> None:  # Counts a bot without waiting (e.g. one which has given up)
+        self.arrived += 1
+        if self.arrived == self.count:
+            self.reached.set()
+
+
+class Bots:  # What the bots share
+    def __init__(self, count: int, connectConcurrency: int):
+        self.connecting = asyncio.Semaphore(connectConcurrency)  # So the server's handshake backlog isn't overrun
+        self.ready = Barrier(count)  # Every bot has connected and joined the group
+        self.finished = Barrier(count)  # Every bot has made its requests
+        self.connected = 0
+        self.latencies = []
+
+
+async def countMessages(connection: asyncApi.AsyncConnection) -> int:  # Counts the group's messages until the
+    # connection closes
+    received = 0
+    async for message in connection:
+        received += 1
+    return received
+
+
+async def runBot(number: int, port: int, publicKey, sessionTicket: tuple, requests: int, messages: int,
+                 bots: Bots) -> int:  # Connects and makes an account, waits for every other bot to do the same, then
+    # makes its requests, giving how many group messages reached it
+    try:
+        async with bots.connecting:
+            connection = await asyncApi.getConnection("127.0.0.1", port, publicKey, sessionTicket)
+            await asyncApi.makeAccount(connection, f"bot{number}", "password")
+            token = await asyncApi.switchToGroup(connection, 1)  # APIs are only sent a group's messages once they
+            # switch to it
+    except (OSError, ValueError, asyncio.IncompleteReadError):
+        bots.ready.arrive()
+        bots.finished.arrive()
+        return 0
+    bots.connected += 1
+    listener = asyncio.create_task(countMessages(connection))
+    await bots.ready.wait()
+    for i in range(requests):
+        start = time.perf_counter()
+        if i < messages:
+            await asyncApi.sendMessage(connection, f"bot {number} says {i}", token)
+        elif i % 2:
+            await asyncApi.heartBeat(connection)
+        else:
+            await asyncApi.getMessagePage(connection, token, 10)
+        bots.latencies.append(time.perf_counter() - start)
+    await bots.finished.wait()
+    await asyncio.sleep(1)  # Let the last of the other bots' messages arrive
+    await connection.close()
+    return await listener
+
+
+async def measure(port: int, botCount: int, requests: int, messages: int, connectConcurrency: int) -> dict:
+    publicKey = common.getPublicKey()
+    first = await asyncApi.getConnection("127.0.0.1", port, publicKey)  # Its ticket lets the bots skip RSA
+    bots = Bots(botCount, connectConcurrency)
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(runBot(i, port, publicKey, first.sessionTicket, requests, messages, bots))
+             for i in range(botCount)]
+    await bots.ready.reached.wait()
+    ready = time.perf_counter()
+    await bots.finished.reached.wait()
+    finished = time.perf_counter()
+    received = await asyncio.gather(*tasks)
+    await first.close()
+    latencies = sorted(bots.latencies)
+    expectedMessages = bots.connected ** 2 * min(messages, requests)  # Every message reaches every bot
+    return {"bots": botCount, "connected": bots.connected, "requestsPerBot": requests,
+            "setupSeconds": ready - start,
+            "requestsPerSecond": len(latencies) / (finished - ready),
+            "p50Milliseconds": latencies[len(latencies) // 2] * 1000,
+            "p99Milliseconds": latencies[int(len(latencies) * 0.99)] * 1000,
+            "messagesDeliveredFraction": sum(received) / expectedMessages if expectedMessages else None}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drives many concurrent bot sessions from one process with the "
+                                                 "asyncio API client")
+    parser.add_argument("--bots", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20, help="how many requests each bot makes")
+    parser.add_argument("--messages", type=int, default=0, help="how many of each bot's requests are group messages "
+                                                                "(each is sent to every bot)")
+    parser.add_argument("--connect-concurrency", type=int, default=64,
+                        help="how many bots may be connecting at once")
+    parser.add_argument("--asyncio", dest="useAsync", action="store_true", help="serve clients with asyncio")
+    arguments = parser.parse_args()
+    process, port, workingDirectory = common.startServer("--argon-time-cost", "1", "--argon-memory-cost", "1024",
+                                                         *(["--asyncio"] if arguments.useAsync else []))  # Cheap
+    # hashing, so making the bots' accounts doesn't dominate
+    try:
+        print(json.dumps(asyncio.run(measure(port, arguments.bots, arguments.requests, arguments.messages,
+                                             arguments.connect_concurrency))))
+    finally:
+        common.stopServer(process, workingDirectory)
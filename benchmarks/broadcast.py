@@ -0,0 +1,130 @@
+import time
+import socket
+import asyncio
+import argparse
+import threading
+import encryption
+import transport
+import fanout
+
+
+alwaysWritable = socket.socketpair()[0]  # Lets the sinks be checked for writability like real sockets
+
+
+class SinkSocket:  # Stands in for a client's socket, noting when the expected number of frames have arrived
+    def __init__(self, expectedFrames: int, delay: float = 0.0):
+        self.protocolVersion = transport.PROTOCOL_FRAMED
+        self.sendLock = threading.Lock()
+        self.expectedFrames = expectedFrames
+        self.received = 0
+        self.delay = delay  # How long each send takes, to simulate a client which is slow to receive
+        self.done = threading.Event()
+
+    def send(self, data: bytes) -> int:
+        if self.delay:
+            time.sleep(self.delay)
+        self.received += 1
+        if self.received >= self.expectedFrames:
+            self.done.set()
+        return len(data)
+
+    def shutdown(self, how: int) -> None:
+        pass
+
+    def fileno(self) -> int:
+        return alwaysWritable.fileno()
+
+
+class SinkWriter:  # Stands in for an asyncio stream writer in the same way
+    def __init__(self, sinkSocket: SinkSocket):
+        self.sinkSocket = sinkSocket
+
+    def write(self, data: bytes) -> None:
+        self.sinkSocket.received += 1
+        if self.sinkSocket.received >= self.sinkSocket.expectedFrames:
+            self.sinkSocket.done.set()
+
+    async def drain(self) -> None:
+        if self.sinkSocket.delay:
+            await asyncio.sleep(self.sinkSocket.delay)
+
+
+class FakeClient:
+    def __init__(self, expectedFrames: int, delay: float = 0.0):
+        self.clientSock = SinkSocket(expectedFrames, delay)
+        self.writer = SinkWriter(self.clientSock)
+        self.AESKey = encryption.generateKey()
+
+
+def measure(groupSize: int, messages: int, useOutboxes: bool, slowDelay: float, writers: int) -> dict:  # Times how long it takes
+    # for every fast member of a group to receive every message, when one member is slow
+    members = [FakeClient(messages) for i in range(groupSize - 1)]
+    slowMember = FakeClient(messages, slowDelay)
+    members.insert(0, slowMember)  # The slow member comes first, so it holds up everyone in a sequential broadcast
+    if useOutboxes:
+        writerPool = fanout.WriterPool(writers)
+        for member in members:
+            member.outbox = fanout.PooledOutbox(member, writerPool, messages, fanout.DROP)
+    message = b"bench: Hello everyone!"
+    start = time.perf_counter()
+    for i in range(messages):
+        for member in members:
+            if useOutboxes:
+                member.outbox.put(message, "message", "utf-8")
+            else:
+                transport.sendDynamicData(message, "message", "utf-8", member.clientSock, member.AESKey)
+    broadcastTime = time.perf_counter() - start  # How long the event thread was busy broadcasting
+    for member in members[1:]:
+        member.clientSock.done.wait()
+    deliveredTime = time.perf_counter() - start
+    for member in members:
+        if useOutboxes:
+            member.outbox.close()
+    return {"mode": "pooledOutboxes" if useOutboxes else "sequential", "groupSize": groupSize,
+            "eventThreadMillisecondsPerBroadcast": broadcastTime / messages * 1000,
+            "deliveryMillisecondsPerBroadcast": deliveredTime / messages * 1000}
+
+
+def measureAsync(groupSize: int, messages: int, slowDelay: float) -> dict:  # The same, but with the outboxes
+    # emptied by writer tasks on an event loop, as in the asyncio server
+    members = [FakeClient(messages) for i in range(groupSize - 1)]
+    members.insert(0, FakeClient(messages, slowDelay))
+    loop = asyncio.new_event_loop()
+    loopThread = threading.Thread(target=loop.run_forever, daemon=True)
+    loopThread.start()
+
+    async def makeOutboxes():
+        for member in members:
+            member.clientSock.protocolVersion = transport.PROTOCOL_FRAMED
+            member.outbox = fanout.AsyncOutbox(member, loop, messages, fanout.DROP)
+    asyncio.run_coroutine_threadsafe(makeOutboxes(), loop).result()
+    message = b"bench: Hello everyone!"
+    start = time.perf_counter()
+    for i in range(messages):
+        for member in members:
+            member.outbox.put(message, "message", "utf-8")
+    broadcastTime = time.perf_counter() - start
+    for member in members[1:]:
+        member.clientSock.done.wait()
+    deliveredTime = time.perf_counter() - start
+    for member in members:
+        member.outbox.close()
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0.1), loop).result()  # Let the writer tasks finish
+    loop.call_soon_threadsafe(loop.stop)
+    return {"mode": "asyncOutboxes", "groupSize": groupSize,
+            "eventThreadMillisecondsPerBroadcast": broadcastTime / messages * 1000,
+            "deliveryMillisecondsPerBroadcast": deliveredTime / messages * 1000}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures broadcast latency for groups of different sizes, with one "
+                                                 "slow member")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--slow-delay", type=float, default=0.05, help="how long the slow member takes per frame")
+    parser.add_argument("--writers", type=int, default=8, help="how many threads the writer pool has")
+    arguments = parser.parse_args()
+    for size in arguments.sizes:
+        for useOutboxes in (False, True):
+            print(measure(size, arguments.messages, useOutboxes, arguments.slow_delay, arguments.writers))
+        print(measureAsync(size, arguments.messages, arguments.slow_delay))
@@ -0,0 +1,44 @@
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import storage
+
+
+def measure(storageMethod: storage.StorageMethod, userCount: int, lookups: int) -> dict:  # Times the lookups done
+    # by a group switch (is the user in the group?) and by listing a user's groups (with their names)
+    start = time.perf_counter()
+    for i in range(lookups):
+        storageMethod.getUsersFromGroup(random.randint(1, 10))  # A few busy groups
+    switchTime = (time.perf_counter() - start) / lookups
+    start = time.perf_counter()
+    for i in range(lookups):
+        userID = random.randint(1, userCount)
+        storageMethod.getGroups(storageMethod.getGroupsFromUser(userID))
+    listTime = (time.perf_counter() - start) / lookups
+    return {"storage": type(storageMethod).__name__,
+            "groupSwitchMicroseconds": switchTime * 1000000,
+            "listGroupsMicroseconds": listTime * 1000000}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares membership and group name lookups with and without the "
+                                                 "cache")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups-per-user", type=int, default=20)
+    parser.add_argument("--lookups", type=int, default=20000)
+    arguments = parser.parse_args()
+    workingDirectory = tempfile.mkdtemp(prefix="chatroom-bench-")
+    database = storage.SQLDatabase(os.path.join(workingDirectory, "database.db"))
+    groupIDs = [database.addGroup(f"group{i}") for i in range(100)]
+    userIDs = database.addUsers([(f"user{i}", "hashedPassword") for i in range(arguments.users)])
+    database.addUsersToGroups([(userID, groupID) for userID in userIDs
+                               for groupID in random.sample(groupIDs, arguments.groups_per_user)])
+    print(measure(database, arguments.users, arguments.lookups))
+    cachedStorage = storage.CachedStorage(database)
+    print(measure(cachedStorage, arguments.users, arguments.lookups))
+    print(cachedStorage.getStats())
+    database.closeConnection()
+    shutil.rmtree(workingDirectory, ignore_errors=True)
@@ -0,0 +1,55 @@
+import time
+import socket
+import argparse
+import tracemalloc
+import encryption
+import transport
+
+connection = transport.Connection(socket.socket())  # Keeps a cipher context, as a client's connection would
+
+def sealFrameUncached(data: bytes, typeOfData: str, encoding: str, AESKey: bytes) -> bytes:  # How frames were sealed
+    # before cipher contexts: a random nonce, and the pieces joined together
+    typeBytes = typeOfData.encode("ascii")
+    encodingBytes = encoding.encode("ascii")
+    plaintext = bytes([0, len(typeBytes)]) + typeBytes + bytes([len(encodingBytes)]) + encodingBytes + data
+    nonce, ciphertext, tag = encryption.encryptDataAES(plaintext, AESKey)
+    sealed = nonce + ciphertext + tag
+    return transport.frameHeader.pack(len(sealed) + 1, transport.FRAME_SEALED) + sealed
+
+
+def sealFrameWithContext(data: bytes, typeOfData: str, encoding: str, AESKey: bytes) -> bytes:  # How a connection
+    # seals frames now, with the cipher context it keeps for its key
+    return transport.sealFrame(data, typeOfData, encoding, AESKey,
+                               context=transport.getCipherContext(AESKey, connection))
+
+
+def measure(name: str, seal, payloadSize: int, count: int) -> dict:  # Seals frames, timing them, then seals them
+    # again while tracing memory, to see how much each one allocates
+    AESKey = encryption.generateKey()
+    data = b"x" * payloadSize
+    start = time.perf_counter()
+    for i in range(count):
+        seal(data, "message", "utf-8", AESKey)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    allocated = 0
+    for i in range(min(count, 1000)):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        seal(data, "message", "utf-8", AESKey)
+        allocated += tracemalloc.get_traced_memory()[1] - before  # The most memory in use at once while sealing
+    tracemalloc.stop()
+    return {"sealing": name,
+            "payloadBytes": payloadSize,
+            "framesPerSecond": count / elapsed,
+            "peakBytesPerFrame": allocated / min(count, 1000)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares sealing frames with and without a cached cipher context")
+    parser.add_argument("--frames", type=int, default=50000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[64, 1024, 65536])
+    arguments = parser.parse_args()
+    for payloadSize in arguments.sizes:
+        print(measure("uncached", sealFrameUncached, payloadSize, arguments.frames))
+        print(measure("context", sealFrameWithContext, payloadSize, arguments.frames))
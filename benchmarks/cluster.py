@@ -0,0 +1,105 @@
+import os
+import shutil
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import api
+import cluster
+import transport
+from benchmarks import common
+
+
+class Listener:  # A (non-API) client which notes when each message reaches it
+    def __init__(self, port: int, publicKey):
+        self.sock = transport.Connection(socket.socket())
+        self.sock.connect(("127.0.0.1", port))
+        self.AESKey = transport.connectToServer(self.sock, publicKey, False)
+        self.arrivals = {}
+        self.lock = threading.Condition()
+        receiver = threading.Thread(target=self.receive, daemon=True)
+        receiver.start()
+
+    def receive(self) -> None:
+        while True:
+            try:
+                dataType, encoding, data = transport.receiveDynamicData(self.sock, self.AESKey)
+            except (OSError, ValueError):
+                return None
+            if dataType == "message":
+                with self.lock:
+                    self.arrivals[data.decode(encoding)] = time.perf_counter()
+                    self.lock.notify_all()
+
+    def waitFor(self, message: str, timeout: float = 10) -> float:  # Gives when a message arrived
+        with self.lock:
+            self.lock.wait_for(lambda: message in self.arrivals, timeout)
+            return self.arrivals.get(message)
+
+
+def measure(ports: list, publicKey, messages: int) -> dict:  # Sends messages to the first node, timing how long they
+    # take to reach a client on each node
+    listeners = [Listener(port, publicKey) for port in ports]
+    AESKey, sender = api.getConnection("127.0.0.1", ports[0], publicKey)
+    time.sleep(0.5)  # Let the listeners join the default group
+    latencies = [[] for port in ports]
+    start = time.perf_counter()
+    for i in range(messages):
+        sent = time.perf_counter()
+        api.sendMessage(sender, AESKey, f"cluster {i}")
+        for node, listener in enumerate(listeners):
+            arrived = listener.waitFor(f"Guest: cluster {i}")
+            if arrived is not None:
+                latencies[node].append(arrived - sent)
+    elapsed = time.perf_counter() - start
+    results = {"messagesPerSecond": messages / elapsed}
+    AESKey, reader = api.getConnection("127.0.0.1", ports[-1], publicKey)
+    history = api.getMessages(reader, AESKey, {"id": "0", "randomBytes": "0", "groupID": "1"}, messages)
+    results["savedOnLastNode"] = sum(message.startswith("Guest: cluster ") for message in history)  # Each node keeps
+    # the whole cluster's history
+    for node, nodeLatencies in enumerate(latencies):
+        nodeLatencies.sort()
+        results[f"node{node}"] = {"delivered": len(nodeLatencies),
+                                  "p50Milliseconds": nodeLatencies[len(nodeLatencies) // 2] * 1000,
+                                  "p99Milliseconds": nodeLatencies[int(len(nodeLatencies) * 0.99)] * 1000}
+    return results
+
+
+def checkPresence(ports: list, publicKey) -> dict:  # Checks that a user logged in on one node can't log in on another
+    AESKey, first = api.getConnection("127.0.0.1", ports[0], publicKey)
+    token = api.makeAccount(first, AESKey, "clusterUser", "password")
+    time.sleep(0.2)  # Let the other nodes hear about the login
+    AESKey2, second = api.getConnection("127.0.0.1", ports[1], publicKey)
+    duplicate = api.login(second, AESKey2, f"clusterUser:{token['id']}", "password")
+    transport.sendDynamicData(b"", "logout", "none", first, AESKey)
+    time.sleep(0.2)
+    afterLogout = api.login(second, AESKey2, f"clusterUser:{token['id']}", "password")
+    return {"duplicateLoginRefused": str(duplicate["id"]) == "0",
+            "loginAfterLogout": str(afterLogout["id"]) == str(token["id"])}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a cluster of servers on localhost, checking that messages and "
+                                                 "logins are shared between them, and timing messages across nodes")
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--messages", type=int, default=200)
+    arguments = parser.parse_args()
+    sharedDirectory = tempfile.mkdtemp(prefix="chatroom-cluster-")
+    brokerPath = os.path.join(sharedDirectory, "broker.sock")
+    broker = cluster.UnixSocketBroker(brokerPath)
+    brokerThread = threading.Thread(target=broker.serveForever, daemon=True)
+    brokerThread.start()
+    servers = [common.startServer("--cluster-socket", brokerPath, "--database",
+                                  os.path.join(sharedDirectory, "database.db"), "--node-id", f"node{i}")
+               for i in range(arguments.nodes)]
+    publicKey = common.getPublicKey()
+    try:
+        ports = [port for process, port, workingDirectory in servers]
+        print(json.dumps(checkPresence(ports, publicKey)))
+        print(json.dumps(measure(ports, publicKey, arguments.messages)))
+    finally:
+        for process, port, workingDirectory in servers:
+            common.stopServer(process, workingDirectory)
+        shutil.rmtree(sharedDirectory, ignore_errors=True)
@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import subprocess
+import encryption
+
+REPO_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def getFreePort() -> int:  # Asks the OS for a port which nothing is listening on
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def startServer(*arguments: str, script: str = "server.py") -> (subprocess.Popen, int, str):  # Starts server.py (or
+    # another script which takes a --port, such as launcher.py) in a fresh directory, so the benchmark doesn't touch
+    # the real database or messages
+    workingDirectory = tempfile.mkdtemp(prefix="chatroom-bench-")
+    for keyFile in ("pubKey.rsa", "privKey.rsa"):
+        shutil.copy(os.path.join(REPO_DIRECTORY, keyFile), workingDirectory)
+    port = getFreePort()
+    process = subprocess.Popen([sys.executable, os.path.join(REPO_DIRECTORY, script), "--port", str(port),
+                                *arguments], cwd=workingDirectory, start_new_session=True)  # In its own
+    # process group, so that its hashing processes can be stopped along with it
+    for i in range(300):  # Wait for it to start listening
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    return process, port, workingDirectory
+
+
+def stopServer(process: subprocess.Popen, workingDirectory: str) -> None:
+    os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+    shutil.rmtree(workingDirectory, ignore_errors=True)
+
+
+def readProcessStatus(pid: int, field: str) -> int:  # Reads a numeric field (e.g. VmRSS, Threads) from /proc
+    with open(f"/proc/{pid}/status", "r") as file:
+        for line in file:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def readProcessGroupCPU(processGroup: int) -> float:  # Gives the CPU time (in seconds) used so far by every
+    # process in a group, such as a server started by startServer along with its hashing processes
+    ticks = 0
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", "r") as file:
+                fields = file.read().rsplit(")", 1)[1].split()  # The process' name (in brackets) may have spaces
+        except OSError:  # If it has exited since the directory was listed
+            continue
+        if int(fields[2]) == processGroup:
+            ticks += int(fields[11]) + int(fields[12])  # Time in user and kernel mode
+    return ticks / os.sysconf("SC_CLK_TCK")
+
+
+def getPublicKey():
+    return encryption.readRSAKeyFromFile(os.path.join(REPO_DIRECTORY, "pubKey.rsa"))
@@ -0,0 +1,41 @@
+import time
+import argparse
+import api
+from benchmarks import common
+
+
+def measure(connectionCount: int, useAsyncio: bool) -> dict:  # Opens connections to a server and measures its memory
+    process, port, workingDirectory = common.startServer(*(["--asyncio"] if useAsyncio else []))
+    publicKey = common.getPublicKey()
+    try:
+        time.sleep(0.5)
+        rssBefore = common.readProcessStatus(process.pid, "VmRSS")
+        sockets = []
+        start = time.perf_counter()
+        for i in range(connectionCount):
+            try:
+                sockets.append(api.getConnection("127.0.0.1", port, publicKey)[1])
+            except OSError:  # If the server (or this process) has run out of resources, stop here
+                break
+        elapsed = time.perf_counter() - start
+        time.sleep(1)  # Give the server time to finish the last handshakes
+        rssAfter = common.readProcessStatus(process.pid, "VmRSS")
+        threads = common.readProcessStatus(process.pid, "Threads")
+        for sock in sockets:
+            sock.close()
+    finally:
+        common.stopServer(process, workingDirectory)
+    return {"mode": "asyncio" if useAsyncio else "threaded",
+            "connections": len(sockets),
+            "connectionsPerSecond": len(sockets) / elapsed,
+            "serverThreads": threads,
+            "kilobytesPerConnection": (rssAfter - rssBefore) / max(len(sockets), 1)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares connection count and memory per connection between the "
+                                                 "threaded and asyncio servers")
+    parser.add_argument("--connections", type=int, default=500)
+    arguments = parser.parse_args()
+    for useAsyncio in (False, True):
+        print(measure(arguments.connections, useAsyncio))
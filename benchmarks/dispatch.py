@@ -0,0 +1,52 @@
+import time
+import json
+import argparse
+import events
+
+TOKEN = json.dumps({"id": "1", "randomBytes": "ab" * 32, "groupID": "1"})
+FRAMES = {"message": json.dumps({"message": "Hello everyone!", "sessionToken": TOKEN}).encode("utf-8"),
+          "login": json.dumps({"username": "alice:1", "password": "password"}).encode("utf-8"),
+          "switchGroup": json.dumps({"groupToSwitchTo": 2}).encode("utf-8"),
+          "getMessages": json.dumps({"token": TOKEN, "limit": 20, "since": None, "before": None}).encode("utf-8"),
+          "getGroups": json.dumps({"token": TOKEN}).encode("utf-8"),
+          "doHeartbeat": bytes(32),
+          "unknown": b"something the server doesn't understand"}  # An example frame of each type
+
+
+class Client:  # Just what making the events needs
+    sessionToken = {"id": "1", "randomBytes": "ab" * 32, "groupID": "1"}
+    storageMethod = None
+    messageStorage = None
+
+
+def measure(dataType: str, count: int) -> dict:  # Times turning frames of a type into events (without handling
+    # them), next to just parsing their JSON
+    data = FRAMES[dataType]
+    encoding = "utf-8" if dataType in events.messageTypes and events.messageTypes[dataType].schema is not None \
+        else "none"
+    client = Client()
+    services = events.Services(None, None)
+    start = time.perf_counter()
+    for i in range(count):
+        events.dispatch(dataType, encoding, data, client, services)
+    dispatchSeconds = time.perf_counter() - start
+    start = time.perf_counter()
+    if encoding != "none":
+        for i in range(count):
+            json.loads(data.decode(encoding))
+    parseSeconds = time.perf_counter() - start
+    return {"type": dataType,
+            "dispatchMicroseconds": dispatchSeconds / count * 1e6,
+            "parseMicroseconds": parseSeconds / count * 1e6,
+            "overheadMicroseconds": (dispatchSeconds - parseSeconds) / count * 1e6}  # The lookup, validation and
+    # making of the event
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how long the server takes to turn each type of frame into "
+                                                 "its event")
+    parser.add_argument("--frames", type=int, default=100000)
+    arguments = parser.parse_args()
+    events.unknownLogLimiter = events.RateLimiter(0, 0)  # So unknown frames are measured being dropped, not logged
+    for dataType in FRAMES:
+        print(measure(dataType, arguments.frames))
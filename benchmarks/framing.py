@@ -0,0 +1,52 @@
+import time
+import json
+import socket
+import argparse
+import threading
+import encryption
+import transport
+
+
+def measure(protocolVersion: int, message: bytes, count: int) -> dict:  # Sends messages over a local socket pair
+    # and counts how many bytes and how much time they take
+    sender, receiver = socket.socketpair()
+    sender = transport.Connection(sender, protocolVersion)
+    receiver = transport.Connection(receiver, protocolVersion)
+    AESKey = encryption.generateKey()
+    receivedBytes = [0]
+
+    def receive():
+        for i in range(count):
+            transport.receiveDynamicData(receiver, AESKey)
+
+    class CountingSocket:  # Counts the bytes sent, so the overhead of each format can be compared
+        def send(self, data):
+            receivedBytes[0] += len(data)
+            return sender.send(data)
+
+    receivingThread = threading.Thread(target=receive)
+    start = time.perf_counter()
+    receivingThread.start()
+    countingSocket = CountingSocket()
+    countingSocket.protocolVersion = protocolVersion
+    for i in range(count):
+        transport.sendDynamicData(message, "message", "utf-8", countingSocket, AESKey)
+    receivingThread.join()
+    elapsed = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    return {"protocol": "framed" if protocolVersion >= transport.PROTOCOL_FRAMED else "legacy",
+            "payloadBytes": len(message),
+            "bytesOnWire": receivedBytes[0] / count,
+            "overheadBytes": receivedBytes[0] / count - len(message),
+            "messagesPerSecond": count / elapsed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the legacy chunked header format with single frames")
+    parser.add_argument("--messages", type=int, default=20000)
+    arguments = parser.parse_args()
+    message = json.dumps({"message": "Hello everyone!",
+                          "sessionToken": json.dumps({"id": "1", "randomBytes": "ab" * 32, "groupID": "1"})})
+    for protocolVersion in (transport.PROTOCOL_LEGACY, transport.PROTOCOL_FRAMED):
+        print(measure(protocolVersion, message.encode("utf-8"), arguments.messages))
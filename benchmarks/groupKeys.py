@@ -0,0 +1,63 @@
+import time
+import argparse
+import encryption
+import transport
+import fanout
+
+
+class SinkSocket:  # Stands in for a client's socket, throwing away whatever is sent to it
+    def __init__(self, protocolVersion: int):
+        self.protocolVersion = protocolVersion
+
+    def send(self, data: bytes) -> int:
+        return len(data)
+
+
+class FakeClient:  # Stands in for a connected client
+    def __init__(self, protocolVersion: int):
+        self.clientSock = SinkSocket(protocolVersion)
+        self.AESKey = encryption.generateKey()
+        self.outbox = fanout.Outbox(self)
+
+
+def broadcastAndSend(members: list, message: bytes, groupKeyring: fanout.GroupKeyring) -> None:  # Broadcasts a
+    # message, then sends every member's frames as their writer would (which is where frames are sealed per member)
+    fanout.broadcast(members, message, "message", "utf-8", "1", groupKeyring)
+    for member in members:
+        frame = member.outbox.take()
+        while frame is not None:
+            fanout.sendFrame(frame, member.clientSock, member.AESKey)
+            frame = member.outbox.take()
+
+
+def measure(groupSize: int, broadcasts: int, useGroupKeys: bool, payloadSize: int) -> dict:  # Gives the CPU time
+    # spent on each broadcast to a group, and on the first one after the group's key is replaced
+    members = [FakeClient(transport.PROTOCOL_GROUP_KEYS) for i in range(groupSize)]
+    groupKeyring = fanout.GroupKeyring() if useGroupKeys else None
+    message = b"x" * payloadSize
+    broadcastAndSend(members, message, groupKeyring)  # The first one sends out the key
+    start = time.process_time()
+    for i in range(broadcasts):
+        broadcastAndSend(members, message, groupKeyring)
+    broadcastTime = (time.process_time() - start) / broadcasts
+    if groupKeyring is not None:
+        groupKeyring.rotate("1")
+    start = time.process_time()
+    broadcastAndSend(members, message, groupKeyring)
+    rotationTime = time.process_time() - start
+    return {"sealing": "groupKey" if useGroupKeys else "perMember", "groupSize": groupSize,
+            "payloadBytes": payloadSize,
+            "cpuMillisecondsPerBroadcast": broadcastTime * 1000,
+            "cpuMillisecondsAfterRotation": rotationTime * 1000}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares the CPU time of sealing a group message for each member "
+                                                 "with sealing it once with the group's key")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--broadcasts", type=int, default=20)
+    parser.add_argument("--payload", type=int, default=256, help="how many bytes each message is")
+    arguments = parser.parse_args()
+    for size in arguments.sizes:
+        for useGroupKeys in (False, True):
+            print(measure(size, arguments.broadcasts, useGroupKeys, arguments.payload))
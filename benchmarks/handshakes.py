@@ -0,0 +1,52 @@
+import time
+import socket
+import argparse
+import threading
+import api
+from benchmarks import common
+
+
+def measure(port: int, publicKey, useTickets: bool, connectionCount: int, threadCount: int) -> dict:  # Connects
+    # over and over from several threads, with or without a session ticket
+    AESKey, servSocket = api.getConnection("127.0.0.1", port, publicKey)  # Gets a ticket to resume with
+    sessionTicket = servSocket.sessionTicket if useTickets else None
+    servSocket.close()
+    handshakeTimes = []
+
+    def connect():
+        for i in range(connectionCount // threadCount):
+            start = time.perf_counter()
+            AESKey, servSocket = api.getConnection("127.0.0.1", port, publicKey, sessionTicket)
+            handshakeTimes.append(time.perf_counter() - start)
+            servSocket.close()
+
+    threads = [threading.Thread(target=connect) for i in range(threadCount)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    handshakeTimes.sort()
+    return {"handshake": "resumed" if useTickets else "RSA",
+            "handshakesPerSecond": len(handshakeTimes) / elapsed,
+            "medianMilliseconds": handshakeTimes[len(handshakeTimes) // 2] * 1000}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares full RSA handshakes with resuming a session from a ticket")
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--asyncio", action="store_true")
+    parser.add_argument("--stalled", type=int, default=0, help="how many connections to leave open without ever "
+                                                                 "sending a handshake, as a slow or malicious client "
+                                                                 "would")
+    arguments = parser.parse_args()
+    process, port, workingDirectory = common.startServer(*(["--asyncio"] if arguments.asyncio else []))
+    publicKey = common.getPublicKey()
+    try:
+        stalledSockets = [socket.create_connection(("127.0.0.1", port)) for i in range(arguments.stalled)]
+        for useTickets in (False, True):
+            print(measure(port, publicKey, useTickets, arguments.connections, arguments.threads))
+    finally:
+        common.stopServer(process, workingDirectory)
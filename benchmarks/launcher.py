@@ -0,0 +1,112 @@
+import json
+import shutil
+import time
+import signal
+import socket
+import argparse
+import threading
+import multiprocessing
+import api
+import transport
+from benchmarks import common
+
+
+class CountingListener:  # A (non-API) client which counts the messages which reach it
+    def __init__(self, port: int, publicKey):
+        self.sock = transport.Connection(socket.socket())
+        self.sock.connect(("127.0.0.1", port))
+        self.AESKey = transport.connectToServer(self.sock, publicKey, False)
+        self.received = 0
+        self.lastArrival = None
+        receiver = threading.Thread(target=self.receive, daemon=True)
+        receiver.start()
+
+    def receive(self) -> None:
+        while True:
+            try:
+                dataType, encoding, data = transport.receiveDynamicData(self.sock, self.AESKey)
+            except (OSError, ValueError):
+                return None
+            if dataType == "message":
+                self.received += 1
+                self.lastArrival = time.perf_counter()
+
+
+def send(port: int, messages: int) -> None:  # Run in its own process, so the senders aren't held back by the GIL
+    publicKey = common.getPublicKey()
+    AESKey, servSocket = api.getConnection("127.0.0.1", port, publicKey)
+    for i in range(messages):
+        api.sendMessage(servSocket, AESKey, f"load {i}")
+    time.sleep(1)  # Let the server read the last messages before the connection goes
+    servSocket.close()
+
+
+def measure(workerCount: int, senderCount: int, messages: int, listenerCount: int) -> dict:  # Gives how many
+    # messages a second reach every listener, with the listeners and senders shared out between the workers
+    process, port, workingDirectory = common.startServer("--workers", str(workerCount), "--drain-timeout", "1",
+                                                         script="launcher.py")
+    try:
+        publicKey = common.getPublicKey()
+        listeners = [CountingListener(port, publicKey) for i in range(listenerCount)]
+        time.sleep(1)  # Let the listeners join the default group
+        expected = senderCount * messages
+        context = multiprocessing.get_context("spawn")
+        senders = [context.Process(target=send, args=(port, messages)) for i in range(senderCount)]
+        start = time.perf_counter()
+        for sender in senders:
+            sender.start()
+        deadline = time.monotonic() + 60
+        while any(listener.received < expected for listener in listeners) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        elapsed = max(listener.lastArrival or start for listener in listeners) - start
+        for sender in senders:
+            sender.join()
+        return {"workers": workerCount, "senders": senderCount, "listeners": listenerCount,
+                "messagesPerSecond": expected / elapsed if elapsed > 0 else None,
+                "deliveredFraction": sum(listener.received for listener in listeners) / (expected * listenerCount)}
+    finally:
+        stopLauncher(process, workingDirectory)
+
+
+def measureRestart(workerCount: int, duration: float) -> dict:  # Connects over and over during a rolling restart,
+    # counting how many connections fail
+    process, port, workingDirectory = common.startServer("--workers", str(workerCount), "--drain-timeout", "1",
+                                                         script="launcher.py")
+    try:
+        publicKey = common.getPublicKey()
+        process.send_signal(signal.SIGHUP)
+        succeeded = failed = 0
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            try:
+                AESKey, servSocket = api.getConnection("127.0.0.1", port, publicKey)
+                servSocket.close()
+                succeeded += 1
+            except (OSError, ValueError):
+                failed += 1
+            time.sleep(0.02)
+        return {"workers": workerCount, "restart": "rolling", "connectionsSucceeded": succeeded,
+                "connectionsFailed": failed}
+    finally:
+        stopLauncher(process, workingDirectory)
+
+
+def stopLauncher(process, workingDirectory: str) -> None:  # The launcher stops its workers itself
+    process.send_signal(signal.SIGTERM)
+    process.wait(60)
+    shutil.rmtree(workingDirectory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how messages a second scale with the launcher's worker "
+                                                 "count, and checks that a rolling restart keeps accepting clients")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--senders", type=int, default=4, help="how many processes send messages")
+    parser.add_argument("--messages", type=int, default=250, help="how many messages each sender sends")
+    parser.add_argument("--listeners", type=int, default=4)
+    parser.add_argument("--restart-duration", type=float, default=15,
+                        help="how long to keep connecting during the rolling restart")
+    arguments = parser.parse_args()
+    for workerCount in arguments.workers:
+        print(json.dumps(measure(workerCount, arguments.senders, arguments.messages, arguments.listeners)))
+    print(json.dumps(measureRestart(max(arguments.workers), arguments.restart_duration)))
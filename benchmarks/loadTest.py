@@ -0,0 +1,207 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import asyncApi
+import api
+from benchmarks import common
+
+OPERATIONS = ("login", "message", "switchGroup", "getMessages")
+DEFAULT_MIX = "login=1,message=4,switchGroup=2,getMessages=3"  # How often each operation is picked, relatively
+
+
+def parseMix(mix: str) -> dict:  # Turns "login=1,message=4" into {"login": 1.0, "message": 4.0}
+    weights = {}
+    for part in mix.split(","):
+        operation, weight = part.split("=")
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation {operation}")
+        weights[operation] = float(weight)
+    return weights
+
+
+class Results:  # What the clients measured
+    def __init__(self):
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.errors = {operation: 0 for operation in OPERATIONS}
+        self.messagesReceived = 0
+
+
+class SimulatedClient:  # A user with their own account and group, who keeps doing operations picked from the mix
+    def __init__(self, number: int, connection: asyncApi.AsyncConnection, seed: int):
+        self.number = number
+        self.connection = connection
+        self.random = random.Random(seed)
+        self.token = None
+        self.ownGroup = None
+
+    async def setUp(self) -> None:
+        self.token = await asyncApi.makeAccount(self.connection, f"load{self.number}", "password")
+        self.ownGroup = await asyncApi.makeGroup(self.connection, f"load{self.number}'s group")
+        self.token = await asyncApi.switchToGroup(self.connection, 1)  # APIs are only sent a group's messages
+        # once they switch to it
+
+    async def login(self) -> None:  # Logs out and back in (a user can't log in twice)
+        await asyncApi.logout(self.connection)
+        token = await asyncApi.login(self.connection, f"load{self.number}:{self.token['id']}", "password")
+        if str(token["id"]) == "0":
+            raise api.RequestError("Login refused")
+        self.token = token
+
+    async def message(self) -> None:  # Messages have no reply, so a heartbeat (which is handled after the message)
+        # is sent with it, making the latency the time until the message has been handled
+        await asyncApi.sendMessage(self.connection, f"load test message from {self.number}", self.token)
+        await asyncApi.heartBeat(self.connection)
+
+    async def switchGroup(self) -> None:  # Switches between the default group and the client's own
+        target = self.ownGroup if str(self.token["groupID"]) == "1" else 1
+        self.token = await asyncApi.switchToGroup(self.connection, target)
+
+    async def getMessages(self) -> None:
+        await asyncApi.getMessagePage(self.connection, self.token, 20)
+
+    async def run(self, weights: dict, deadline: float, thinkTime: float, results: Results) -> None:
+        operations = list(weights)
+        weightList = [weights[operation] for operation in operations]
+        while time.perf_counter() < deadline:
+            if thinkTime > 0:
+                await asyncio.sleep(self.random.expovariate(1 / thinkTime))
+            operation = self.random.choices(operations, weightList)[0]
+            start = time.perf_counter()
+            try:
+                await getattr(self, operation)()
+            except (api.RequestError, ValueError, KeyError):  # If the server refused or mangled the request
+                results.errors[operation] += 1
+                continue
+            results.latencies[operation].append(time.perf_counter() - start)
+
+
+async def countMessages(connection: asyncApi.AsyncConnection, results: Results) -> None:
+    async for message in connection:
+        results.messagesReceived += 1
+
+
+async def runLoad(port: int, clientCount: int, weights: dict, duration: float, thinkTime: float,
+                  connectConcurrency: int, seed: int) -> dict:  # Sets the clients up, then runs the mix on all of
+    # them at once for the duration
+    publicKey = common.getPublicKey()
+    first = await asyncApi.getConnection("127.0.0.1", port, publicKey)  # Its ticket lets the others skip RSA
+    connecting = asyncio.Semaphore(connectConcurrency)
+    results = Results()
+
+    async def setUpClient(number: int) -> SimulatedClient:
+        async with connecting:
+            connection = await asyncApi.getConnection("127.0.0.1", port, publicKey, first.sessionTicket)
+            client = SimulatedClient(number, connection, seed + number)
+            await client.setUp()
+        asyncio.create_task(countMessages(connection, results))
+        return client
+
+    start = time.perf_counter()
+    clients = await asyncio.gather(*(setUpClient(i) for i in range(clientCount)))
+    setupSeconds = time.perf_counter() - start
+    start = time.perf_counter()
+    await asyncio.gather(*(client.run(weights, start + duration, thinkTime, results) for client in clients))
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*(client.connection.close() for client in clients))
+    await first.close()
+    return summarise(results, setupSeconds, elapsed)
+
+
+def percentile(latencies: list, fraction: float) -> float:  # Of a sorted list, in milliseconds
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1000 if latencies else None
+
+
+def summarise(results: Results, setupSeconds: float, elapsed: float) -> dict:
+    operations = {}
+    for operation, latencies in results.latencies.items():
+        latencies.sort()
+        operations[operation] = {"count": len(latencies), "errors": results.errors[operation],
+                                 "perSecond": len(latencies) / elapsed,
+                                 "p50Milliseconds": percentile(latencies, 0.5),
+                                 "p99Milliseconds": percentile(latencies, 0.99)}
+    allLatencies = sorted(latency for latencies in results.latencies.values() for latency in latencies)
+    return {"setupSeconds": setupSeconds, "seconds": elapsed,
+            "total": {"count": len(allLatencies), "errors": sum(results.errors.values()),
+                      "perSecond": len(allLatencies) / elapsed,
+                      "p50Milliseconds": percentile(allLatencies, 0.5),
+                      "p99Milliseconds": percentile(allLatencies, 0.99)},
+            "operations": operations, "messagesReceived": results.messagesReceived}
+
+
+def getCommit() -> str:  # The commit being measured, so results from different commits can be told apart
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=common.REPO_DIRECTORY,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline: dict, result: dict, tolerance: float) -> list:  # Gives the operations which have got slower
+    # (in throughput or p99 latency) by more than the tolerance since the baseline
+    regressions = []
+    for operation, now in [("total", result["total"])] + list(result["operations"].items()):
+        before = baseline["total"] if operation == "total" else baseline["operations"].get(operation)
+        if not before or not before["count"] or not now["count"]:
+            continue
+        if now["perSecond"] < before["perSecond"] * (1 - tolerance):
+            regressions.append({"operation": operation, "measure": "perSecond", "before": before["perSecond"],
+                                "now": now["perSecond"]})
+        if now["p99Milliseconds"] > before["p99Milliseconds"] * (1 + tolerance):
+            regressions.append({"operation": operation, "measure": "p99Milliseconds",
+                                "before": before["p99Milliseconds"], "now": now["p99Milliseconds"]})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a server and drives it with many simulated API clients doing "
+                                                 "a mix of operations, reporting throughput, latency, CPU and memory "
+                                                 "as JSON. Any other arguments are passed on to server.py")
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=30, help="how long (in seconds) to run the mix for")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help=f"how often each of {', '.join(OPERATIONS)} is picked, relatively")
+    parser.add_argument("--think-time", type=float, default=0.5,
+                        help="the mean time (in seconds) each client waits between operations")
+    parser.add_argument("--connect-concurrency", type=int, default=64,
+                        help="how many clients may be connecting at once")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this file")
+    parser.add_argument("--compare", help="a results file from an earlier run, to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="how much worse than the earlier run is counted as a regression")
+    arguments, serverArguments = parser.parse_known_args()
+    weights = parseMix(arguments.mix)
+    process, port, workingDirectory = common.startServer("--argon-time-cost", "1", "--argon-memory-cost", "1024",
+                                                         *serverArguments)  # Cheap hashing by default, so setting
+    # up the accounts doesn't dominate (later arguments win)
+    try:
+        serverCPUStart = common.readProcessGroupCPU(process.pid)
+        clientCPUStart = time.process_time()
+        result = asyncio.run(runLoad(port, arguments.clients, weights, arguments.duration, arguments.think_time,
+                                     arguments.connect_concurrency, arguments.seed))
+        serverCPU = common.readProcessGroupCPU(process.pid) - serverCPUStart
+        result["server"] = {"cpuSeconds": serverCPU,
+                            "cpuPercent": serverCPU / (result["setupSeconds"] + result["seconds"]) * 100,
+                            "peakRSSKilobytes": common.readProcessStatus(process.pid, "VmHWM")}
+        result["client"] = {"cpuSeconds": time.process_time() - clientCPUStart}
+    finally:
+        common.stopServer(process, workingDirectory)
+    result = {"commit": getCommit(), "timestamp": time.time(),
+              "parameters": {"clients": arguments.clients, "duration": arguments.duration, "mix": weights,
+                             "thinkTime": arguments.think_time, "seed": arguments.seed,
+                             "serverArguments": serverArguments, "cpus": os.cpu_count()},
+              **result}
+    if arguments.compare is not None:
+        with open(arguments.compare, "r") as file:
+            result["regressions"] = compare(json.load(file), result, arguments.tolerance)
+    print(json.dumps(result))
+    if arguments.output is not None:
+        with open(arguments.output, "w") as file:
+            json.dump(result, file, indent=2)
+    if result.get("regressions"):
+        sys.exit(1)
@@ -0,0 +1,63 @@
+import os
+import time
+import argparse
+import threading
+import api
+import transport
+from benchmarks import common
+
+
+def measure(hashingProcesses: int, clientCount: int, duration: float) -> dict:  # Has several clients log in and out
+    # over and over, while another client checks how long the server takes to answer a heartbeat
+    process, port, workingDirectory = common.startServer("--hashing-processes", str(hashingProcesses))
+    publicKey = common.getPublicKey()
+    try:
+        connections = []
+        for i in range(clientCount):
+            AESKey, servSocket = api.getConnection("127.0.0.1", port, publicKey)
+            sessionToken = api.makeAccount(servSocket, AESKey, f"user{i}", "password")
+            transport.sendDynamicData(b"", "logout", "none", servSocket, AESKey)
+            connections.append((AESKey, servSocket, f"user{i}:{sessionToken['id']}"))
+        logins = [0] * clientCount
+        stopAt = time.perf_counter() + duration
+
+        def logInAndOut(index: int):
+            AESKey, servSocket, username = connections[index]
+            while time.perf_counter() < stopAt:
+                api.login(servSocket, AESKey, username, "password")
+                transport.sendDynamicData(b"", "logout", "none", servSocket, AESKey)
+                logins[index] += 1
+
+        threads = [threading.Thread(target=logInAndOut, args=(i,)) for i in range(clientCount)]
+        heartbeatKey, heartbeatSocket = api.getConnection("127.0.0.1", port, publicKey)
+        heartbeatTimes = []
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        while time.perf_counter() < stopAt:  # Chat traffic shouldn't have to wait for the hashing
+            heartbeatStart = time.perf_counter()
+            api.heartBeat(heartbeatSocket, heartbeatKey)
+            heartbeatTimes.append(time.perf_counter() - heartbeatStart)
+            time.sleep(0.01)
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        common.stopServer(process, workingDirectory)
+    heartbeatTimes.sort()
+    return {"hashingProcesses": hashingProcesses,
+            "clients": clientCount,
+            "loginsPerSecond": sum(logins) / elapsed,
+            "medianHeartbeatMilliseconds": heartbeatTimes[len(heartbeatTimes) // 2] * 1000,
+            "maxHeartbeatMilliseconds": heartbeatTimes[-1] * 1000}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures login throughput as the number of hashing processes grows")
+    parser.add_argument("--processes", type=int, nargs="+",
+                        default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=5)
+    arguments = parser.parse_args()
+    for hashingProcesses in arguments.processes:
+        print(measure(hashingProcesses, arguments.clients, arguments.duration))
@@ -0,0 +1,61 @@
+import os
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import storage
+
+
+def timeLookups(database: storage.SQLDatabase, userCount: int, groupCount: int, lookups: int) -> dict:  # Times
+    # finding a user's groups and a group's users, as GroupSwitch and AddUserToGroup do
+    userTimes = []
+    groupTimes = []
+    for i in range(lookups):
+        start = time.perf_counter()
+        database.getGroupsFromUser(random.randint(1, userCount))
+        userTimes.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        database.getUsersFromGroup(random.randint(1, groupCount))
+        groupTimes.append(time.perf_counter() - start)
+    return {"getGroupsFromUserMilliseconds": sum(userTimes) / lookups * 1000,
+            "getUsersFromGroupMilliseconds": sum(groupTimes) / lookups * 1000}
+
+
+def measure(membershipCount: int, groupsPerUser: int, groupCount: int, lookups: int) -> None:
+    workingDirectory = tempfile.mkdtemp(prefix="chatroom-bench-")
+    path = os.path.join(workingDirectory, "database.db")
+    userCount = membershipCount // groupsPerUser
+    connection = sqlite3.connect(path)
+    storage.migrate(connection, storage.MIGRATIONS[:1])  # Makes the tables as they were before any indexes
+    connection.executemany(storage.ADD_GROUP, ((f"group{i}",) for i in range(groupCount)))
+    connection.executemany(storage.ADD_USER, ((f"user{i}", "hashedPassword") for i in range(userCount)))
+    connection.executemany("INSERT INTO userGroups VALUES(NULL, ?, ?)",
+                           ((userID, groupID) for userID in range(1, userCount + 1)
+                            for groupID in random.sample(range(1, groupCount + 1), groupsPerUser)))
+    connection.commit()
+    connection.close()
+    database = storage.SQLDatabase.__new__(storage.SQLDatabase)  # Opened without migrating, to time the old schema
+    database.pool = storage.ConnectionPool(path, 1)
+    print({"schema": "unindexed", "memberships": userCount * groupsPerUser,
+           **timeLookups(database, userCount, groupCount, lookups)})
+    database.closeConnection()
+    start = time.perf_counter()
+    database = storage.SQLDatabase(path, 1)  # Upgrades the database in place
+    migrationTime = time.perf_counter() - start
+    print({"schema": "indexed", "memberships": userCount * groupsPerUser, "migrationSeconds": migrationTime,
+           **timeLookups(database, userCount, groupCount, lookups)})
+    database.closeConnection()
+    shutil.rmtree(workingDirectory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares membership lookups before and after the userGroups "
+                                                 "indexes are added")
+    parser.add_argument("--memberships", type=int, default=1000000)
+    parser.add_argument("--groups-per-user", type=int, default=10)
+    parser.add_argument("--groups", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=50)
+    arguments = parser.parse_args()
+    measure(arguments.memberships, arguments.groups_per_user, arguments.groups, arguments.lookups)
@@ -0,0 +1,67 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import encryption
+import storage
+
+
+def makeRecord(number: int) -> dict:
+    return {"group": str(number % 10 + 1),
+            "message": {"sender": '{"id": "1", "username": "bench"}', "message": f"Message number {number}"}}
+
+
+def measureLog(totalMessages: int, checkpoints: list) -> list:  # Times saving each message to the message log as the
+    # history grows
+    directory = tempfile.mkdtemp(prefix="chatroom-bench-")
+    results = []
+    try:
+        messageLog = storage.MessageLog(os.path.join(directory, "messages"), os.path.join(directory, "AES.key"))
+        sampleStart = time.perf_counter()
+        sampleSize = 0
+        for i in range(1, totalMessages + 1):
+            messageLog.append(makeRecord(i))
+            sampleSize += 1
+            if i in checkpoints:
+                results.append({"format": "log", "historySize": i,
+                                "meanSaveMicroseconds": (time.perf_counter() - sampleStart) / sampleSize * 1e6})
+                sampleStart = time.perf_counter()
+                sampleSize = 0
+        start = time.perf_counter()
+        replayed = sum(1 for i in storage.MessageLog(os.path.join(directory, "messages"),
+                                                     os.path.join(directory, "AES.key")).replay())
+        results.append({"format": "log", "replayedMessages": replayed, "replaySeconds": time.perf_counter() - start})
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def measureWholeFile(totalMessages: int, checkpoints: list) -> list:  # Times the old approach, which rewrites the
+    # whole history for every message
+    directory = tempfile.mkdtemp(prefix="chatroom-bench-")
+    results = []
+    messages = {}
+    try:
+        for i in range(1, totalMessages + 1):
+            record = makeRecord(i)
+            messages.setdefault(record["group"], []).append(record["message"])
+            if i in checkpoints:
+                start = time.perf_counter()
+                AESKey = encryption.generateKey()
+                encryption.writeAESKey(os.path.join(directory, "AES.key"), AESKey)
+                encryption.writeEncryptedJSON(os.path.join(directory, "messages.enc"), AESKey, messages.copy())
+                results.append({"format": "wholeFile", "historySize": i,
+                                "meanSaveMicroseconds": (time.perf_counter() - start) * 1e6})
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures per-message save latency as the message history grows")
+    parser.add_argument("--messages", type=int, default=1000000)
+    arguments = parser.parse_args()
+    checkpoints = [10 ** i for i in range(1, 8) if 10 ** i <= arguments.messages]
+    for result in measureWholeFile(arguments.messages, checkpoints) + measureLog(arguments.messages, checkpoints):
+        print(result)
@@ -0,0 +1,70 @@
+import json
+import time
+import argparse
+import api
+from benchmarks import common
+
+DEFAULT_TOKEN = {"id": "0", "randomBytes": "0", "groupID": "1"}
+
+
+def measureSequential(port: int, publicKey, requests: int) -> float:  # Each call waits for its reply before the next
+    # is sent, as the api functions do
+    AESKey, servSocket = api.getConnection("127.0.0.1", port, publicKey)
+    start = time.perf_counter()
+    for i in range(requests):
+        api.getMessagePage(servSocket, AESKey, DEFAULT_TOKEN, 10)
+    elapsed = time.perf_counter() - start
+    servSocket.close()
+    return elapsed
+
+
+def measurePipelined(port: int, publicKey, requests: int, window: int) -> float:  # Up to window calls are waiting
+    # for their replies at once
+    client = api.PipelinedClient("127.0.0.1", port, publicKey)
+    start = time.perf_counter()
+    waiting = []
+    for i in range(requests):
+        waiting.append(client.getMessagePage(DEFAULT_TOKEN, 10))
+        if len(waiting) >= window:
+            waiting.pop(0).result(30)
+    for future in waiting:
+        future.result(30)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed
+
+
+def measureBatched(port: int, publicKey, requests: int, window: int) -> float:  # Calls are sent window at a time,
+    # each lot in a single write
+    client = api.PipelinedClient("127.0.0.1", port, publicKey)
+    start = time.perf_counter()
+    for sent in range(0, requests, window):
+        lot = [api.getMessagePageRequest(DEFAULT_TOKEN, 10, binary=client.binary)
+               for i in range(min(window, requests - sent))]
+        for future in client.batch(lot):
+            future.result(30)
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares requests a second over one connection when each call waits "
+                                                 "for its reply, when calls are pipelined, and when they are batched")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--window", type=int, default=64, help="how many requests may be waiting at once")
+    parser.add_argument("--asyncio", dest="useAsync", action="store_true", help="serve clients with asyncio")
+    arguments = parser.parse_args()
+    process, port, workingDirectory = common.startServer(*(["--asyncio"] if arguments.useAsync else []))
+    try:
+        publicKey = common.getPublicKey()
+        for mode, measure in (("sequential", lambda: measureSequential(port, publicKey, arguments.requests)),
+                              ("pipelined", lambda: measurePipelined(port, publicKey, arguments.requests,
+                                                                     arguments.window)),
+                              ("batched", lambda: measureBatched(port, publicKey, arguments.requests,
+                                                                 arguments.window))):
+            elapsed = measure()
+            print(json.dumps({"mode": mode, "requests": arguments.requests, "window": arguments.window,
+                              "requestsPerSecond": arguments.requests / elapsed}))
+    finally:
+        common.stopServer(process, workingDirectory)
@@ -0,0 +1,57 @@
+import time
+import random
+import argparse
+import presence
+
+
+class FakeClient:  # Stands in for a connected client
+    def __init__(self, userID: int):
+        self.sessionToken = {"id": str(userID), "randomBytes": "0", "groupID": "1"}
+
+
+def measureLists(clients: list, operations: int) -> dict:  # Times the list scans the server used to do
+    groupClients = {"1": list(clients)}
+    start = time.perf_counter()
+    for i in range(operations):
+        userIDs = [client.sessionToken["id"] for client in clients]  # The duplicate session check on login
+        str(random.randint(1, len(clients) * 2)) not in userIDs
+    loginTime = (time.perf_counter() - start) / operations
+    start = time.perf_counter()
+    for i in range(operations):  # A client switching group (or disconnecting) and coming back
+        client = random.choice(clients)
+        groupClients["1"].remove(client)
+        groupClients["1"].append(client)
+    switchTime = (time.perf_counter() - start) / operations
+    return {"index": "lists", "loginMicroseconds": loginTime * 1000000, "switchMicroseconds": switchTime * 1000000}
+
+
+def measureRegistry(clients: list, operations: int) -> dict:
+    presenceRegistry = presence.PresenceRegistry()
+    for client in clients:
+        presenceRegistry.connect(client)
+        presenceRegistry.login(client, client.sessionToken["id"])
+        presenceRegistry.joinGroup(client, "1")
+    newClient = FakeClient(0)
+    start = time.perf_counter()
+    for i in range(operations):
+        if presenceRegistry.login(newClient, random.randint(1, len(clients) * 2)):
+            presenceRegistry.logout(newClient)
+    loginTime = (time.perf_counter() - start) / operations
+    start = time.perf_counter()
+    for i in range(operations):
+        client = random.choice(clients)
+        presenceRegistry.joinGroup(client, "2")
+        presenceRegistry.joinGroup(client, "1")
+    switchTime = (time.perf_counter() - start) / operations
+    return {"index": "registry", "loginMicroseconds": loginTime * 1000000, "switchMicroseconds": switchTime * 1000000,
+            "online": presenceRegistry.onlineCount()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compares scanning lists of clients with the presence registry")
+    parser.add_argument("--users", type=int, default=50000)
+    parser.add_argument("--operations", type=int, default=1000)
+    arguments = parser.parse_args()
+    clients = [FakeClient(userID) for userID in range(1, arguments.users + 1)]
+    print(measureLists(clients, arguments.operations))
+    print(measureRegistry(clients, arguments.operations))
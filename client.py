@@ -1,14 +1,13 @@
 import gui
 import socket
 import transport
-import encryption
 import parsing
 import Crypto.PublicKey.RSA
 import Crypto.Random
 import queue
 import threading
 import time
-import json
+import codec
 
 
 class Client:  # A class for the client, which is used to pass information down the callstack
@@ -19,19 +18,28 @@ class Client:  # A class for the client, which is used to pass information down
         self.toGUI = queue.Queue()
         self.clearGUI = queue.Queue()
         self.eventQueue = queue.Queue()
-        self.servSocket = socket.socket()
+        self.servSocket = transport.Connection(socket.socket())
         gui.startGUI(self.fromGUI, self.toGUI, self.clearGUI)
         self.AESKey = None
+        self.sessionTickets = {}  # Maps a server's address to the session ticket it last gave
+        self.oldestMessageID = None  # The ID of the earliest message loaded with `history, if any have been
+        self.shownMessages = 0  # How many of the group's latest messages are on screen (the history given on joining
+        # the group, and any said since), which the first `history skips, as their IDs aren't known
+        self.loadingHistory = None  # The `history command whose pages are being loaded, if there is one
         self.messageReceiver = threading.Thread(target=self.getServerMessages, daemon=True)
         self.messageReceiver.start()
         self.executeGUICommands()
 
-    def handshake(self, publicKey: Crypto.PublicKey.RSA):  # Performs a handshake with a server, creating a shared key
-        self.AESKey = encryption.generateKey()
-        AESEncrypted = encryption.encryptDataRSA(publicKey, self.AESKey)
-        transport.sendData(AESEncrypted, self.servSocket)
-        transport.sendEncryptedData(b"\x00", self.servSocket, self.AESKey)  # Tells the server that the client isn't an
-        # API
+    def handshake(self, publicKey: Crypto.PublicKey.RSA, address: tuple):  # Performs a handshake with a server,
+        # creating a shared key
+        self.AESKey = transport.connectToServer(self.servSocket, publicKey, False,
+                                                self.sessionTickets.get(address))  # Tells the server that the client
+        # isn't an API, and agrees on which protocol to use
+        if hasattr(self.servSocket, "sessionTicket"):  # Remember the server's ticket, to reconnect more quickly
+            self.sessionTickets[address] = self.servSocket.sessionTicket
+        self.oldestMessageID = None  # IDs from another server (or an earlier connection) don't mean anything here
+        self.shownMessages = 0
+        self.loadingHistory = None
         self.readyToReceive = True
         self.toGUI.put("\nSuccessful connection to server!")
 
@@ -59,24 +67,29 @@ class Client:  # A class for the client, which is used to pass information down
             try:
                 dataType, encoding, data = transport.receiveDynamicData(self.servSocket,
                                                                         self.AESKey)  # Get data from the server,
-            except ValueError as e:  # If something has gone wrong with receiving the data,
+            except (ValueError, ConnectionResetError) as e:  # If something has gone wrong with receiving the data,
                 if not self.readyToReceive:  # Check if the socket is disconnected
                     continue  # And if it is, ignore the exception
                 else:  # If the socket is not disconnected,
                     self.toGUI.put("\nAn error has occurred. Please try to re-connect.")  # Show an error to the GUI
                     self.readyToReceive = False
                     self.servSocket.shutdown(0)  # Disconnect from the server
-                    self.servSocket = socket.socket()  # Create a new socket
+                    self.servSocket = transport.Connection(socket.socket())  # Create a new socket
                     continue
             if dataType == "message":  # If the data is a message,
                 message = data.decode(encoding=encoding)
+                self.shownMessages += 1
                 self.toGUI.put("\n" + message)  # Put it in the GUI
             elif dataType == "retrievedMessages":
-                messages = json.loads(data.decode(encoding=encoding))  # Load the messages
+                messages = codec.decode(data, encoding)  # Load the messages
+                self.shownMessages += len(messages)
                 self.toGUI.put("\n"+"\n".join(messages))  # Put all the messages in the GUI
+            elif dataType == "messagePage":  # Used for loading earlier messages
+                if self.loadingHistory is not None:
+                    self.loadingHistory.showPage(self, codec.decode(data, encoding))
             elif dataType == "newToken":  # Used for logging in
-                tokenInfo = json.loads(data.decode(encoding))
-                newToken = json.loads(tokenInfo["newToken"])
+                tokenInfo = codec.decode(data, encoding)
+                newToken = codec.decodeToken(tokenInfo["newToken"])
                 if newToken == "":
                     self.toGUI.put("\nLogin/account creation failed")
                 else:
@@ -86,18 +99,21 @@ class Client:  # A class for the client, which is used to pass information down
                     else:
                         self.toGUI.put("\nLogin/account creation successful! Your user ID is " + str(newToken["id"]))
             elif dataType == "changeToken":  # Used whenever the server wishes to change the client's token
-                token = json.loads(data.decode(encoding))
+                token = codec.decode(data, encoding)
                 if token["groupID"] != self.sessionToken["groupID"]:  # If the group has been switched,
                     self.clearGUI.put(1)  # Clear the screen
                     while not self.clearGUI.empty():
                         time.sleep(0.5)  # Wait for the GUI to be cleared
                     self.toGUI.put(f"Group switched to {token['groupID']}")  # And put a message in
+                    self.oldestMessageID = None
+                    self.shownMessages = 0
+                    self.loadingHistory = None
                 self.sessionToken = token
             elif dataType == "groupID":
-                groupID = json.loads(data.decode(encoding))["groupID"]
+                groupID = codec.decode(data, encoding)["groupID"]
                 self.toGUI.put("\nSuccess in creating new group! The ID is " + str(groupID))
             elif dataType == "listOfGroups":
-                groupsList = json.loads(data.decode(encoding))
+                groupsList = codec.decode(data, encoding)
                 self.toGUI.put("\nYou are in the following groups:\n" + "\n".join(groupsList))
             elif dataType == "didSucceedMessage":
                 self.toGUI.put(data.decode(encoding))
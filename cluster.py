@@ -0,0 +1,306 @@
+import threading
+import argparse
+import socket
+import struct
+import queue
+import uuid
+import json
+import os
+import transport
+import presence
+import events
+
+MESSAGES = "messages"  # Messages said on one node, to be sent to the group's members on the other nodes
+PRESENCE = "presence"  # Who is logged in on each node
+GROUPS = "groups"  # Changes to groups' memberships and keys, so the other nodes can forget what they had cached
+frameLength = struct.Struct(">I")  # Each frame sent to or from a broker is its length, then the frame as JSON
+
+
+class PubSubBackend:  # Carries payloads (dictionaries which can be turned into JSON) between the nodes of a cluster.
+    # A payload published on a channel is given to that channel's subscribers on every other node
+    def __init__(self):
+        self.subscribers = {}  # Maps a channel to the functions which are called with its payloads
+
+    def subscribe(self, channel: str, callback) -> None:
+        self.subscribers.setdefault(channel, []).append(callback)
+
+    def publish(self, channel: str, payload: dict) -> None:  # Sends a payload to the other nodes, without waiting
+        pass
+
+    def deliver(self, channel: str, payload: dict) -> None:  # Gives a payload from another node to the subscribers
+        for callback in self.subscribers.get(channel, ()):
+            try:
+                callback(payload)
+            except Exception as e:  # One bad payload shouldn't stop the node hearing from the cluster
+                print(e)
+
+    def close(self) -> None:
+        pass
+
+
+class LocalBroker:  # Passes payloads between nodes in the same process (e.g. when testing)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.backends = []
+
+    def join(self, backend) -> None:
+        with self.lock:
+            self.backends.append(backend)
+
+    def leave(self, backend) -> None:
+        with self.lock:
+            self.backends.remove(backend)
+
+    def relay(self, sender, channel: str, payload: dict) -> None:
+        with self.lock:
+            backends = [backend for backend in self.backends if backend is not sender]
+        for backend in backends:
+            backend.inbox.put((channel, payload))
+
+
+class LocalBackend(PubSubBackend):  # A backend for a node which shares a process with the rest of its cluster
+    def __init__(self, broker: LocalBroker):
+        super().__init__()
+        self.broker = broker
+        self.inbox = queue.Queue()  # Payloads from the other nodes, which are delivered on this backend's own thread
+        broker.join(self)
+        receiver = threading.Thread(target=self.receive, daemon=True)
+        receiver.start()
+
+    def publish(self, channel: str, payload: dict) -> None:
+        self.broker.relay(self, channel, json.loads(json.dumps(payload)))  # Copied, as if it had been sent over a
+        # socket, so that nodes can't share (and change) each other's objects
+
+    def receive(self) -> None:
+        while True:
+            item = self.inbox.get()
+            if item is None:  # If the backend has been closed
+                return None
+            self.deliver(*item)
+
+    def close(self) -> None:
+        self.broker.leave(self)
+        self.inbox.put(None)
+
+
+def encodeFrame(channel: str, payload: dict) -> bytes:
+    frame = json.dumps({"channel": channel, "payload": payload}).encode("utf-8")
+    return frameLength.pack(len(frame)) + frame
+
+
+def readFrame(reader: transport.SocketReader) -> bytes:  # Gives the JSON of the next frame from a broker (or node)
+    length = frameLength.unpack(reader.read(frameLength.size))[0]
+    if length > transport.MAX_FRAME_SIZE:
+        raise ValueError("Invalid frame length")
+    return bytes(reader.read(length))
+
+
+class UnixSocketBroker:  # Relays every frame a node sends to all the other nodes, over a UNIX socket. When a node
+    # goes away, the others are told, so they can forget who was logged in on it
+    def __init__(self, path: str):
+        if os.path.exists(path):  # A socket left behind by an earlier broker
+            os.remove(path)
+        self.servSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.servSocket.bind(path)
+        self.servSocket.listen()
+        self.lock = threading.Lock()
+        self.nodes = {}  # Maps each node's connection to the node's ID (once it has said hello)
+        self.sendLocks = {}  # Stops frames relayed by different threads being mixed together
+
+    def serveForever(self) -> None:
+        while True:
+            nodeSock = self.servSocket.accept()[0]
+            with self.lock:
+                self.nodes[nodeSock] = None
+                self.sendLocks[nodeSock] = threading.Lock()
+            relayThread = threading.Thread(target=self.relay, args=(nodeSock, ), daemon=True)
+            relayThread.start()
+
+    def relay(self, nodeSock: socket.socket) -> None:  # Passes on everything a node sends, until it goes away
+        reader = transport.SocketReader(nodeSock)
+        try:
+            while True:
+                frame = readFrame(reader)
+                if self.nodes[nodeSock] is None:  # Nodes say hello first, which is where their ID comes from
+                    self.nodes[nodeSock] = json.loads(frame)["payload"].get("node")
+                self.sendToOthers(nodeSock, frameLength.pack(len(frame)) + frame)
+        except (OSError, ValueError, KeyError, AttributeError):  # If the node has gone (or is sending nonsense),
+            # drop it
+            pass
+        with self.lock:
+            nodeID = self.nodes.pop(nodeSock)
+            del self.sendLocks[nodeSock]
+        nodeSock.close()
+        if nodeID is not None:
+            self.sendToOthers(nodeSock, encodeFrame(PRESENCE, {"kind": "nodeLeft", "node": nodeID}))
+
+    def sendToOthers(self, sender: socket.socket, data: bytes) -> None:
+        with self.lock:
+            others = [(nodeSock, self.sendLocks[nodeSock]) for nodeSock in self.nodes if nodeSock is not sender]
+        for nodeSock, sendLock in others:
+            try:
+                with sendLock:
+                    nodeSock.sendall(data)
+            except OSError:  # Its relay thread will notice that it has gone
+                pass
+
+
+class UnixSocketBackend(PubSubBackend):  # A backend for a node which reaches the rest of its cluster through a
+    # broker's UNIX socket
+    def __init__(self, path: str):
+        super().__init__()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.outgoing = queue.Queue()  # Frames waiting to be sent, so that publishing never waits on the broker
+        sender = threading.Thread(target=self.send, daemon=True)
+        sender.start()
+        receiver = threading.Thread(target=self.receive, daemon=True)
+        receiver.start()
+
+    def publish(self, channel: str, payload: dict) -> None:
+        self.outgoing.put(encodeFrame(channel, payload))
+
+    def send(self) -> None:
+        while True:
+            frame = self.outgoing.get()
+            if frame is None:
+                return None
+            try:
+                self.sock.sendall(frame)
+            except OSError as e:
+                print(e)
+                return None
+
+    def receive(self) -> None:
+        reader = transport.SocketReader(self.sock)
+        while True:
+            try:
+                frame = json.loads(readFrame(reader))
+            except (OSError, ValueError) as e:  # If the broker has gone, carry on as a lone node
+                print(e)
+                return None
+            self.deliver(frame["channel"], frame["payload"])
+
+    def close(self) -> None:
+        self.outgoing.put(None)
+        self.sock.close()
+
+
+class ClusterPresenceRegistry(presence.PresenceRegistry):  # A presence registry which also knows who is logged in
+    # on the cluster's other nodes, so that a user can't be logged in on two nodes at once. The other nodes are only
+    # heard from after the fact, so two logins at the same moment on different nodes can both succeed
+    def __init__(self):
+        super().__init__()
+        self.remoteUsers = {}  # Maps the ID of a user logged in on another node to that node's ID
+        self.node = None  # The node which tells the cluster about logins and logouts here
+
+    def login(self, connection, userID) -> bool:
+        if not super().login(connection, userID):
+            return False
+        if self.node is not None:
+            self.node.publish(PRESENCE, {"kind": "login", "user": str(userID)})
+        return True
+
+    def isLoggedIn(self, userID: str) -> bool:  # Must be called with the lock held
+        return userID in self.users or userID in self.remoteUsers
+
+    def removeUser(self, connection) -> None:  # Must be called with the lock held
+        userID = self.userOf.get(connection)
+        super().removeUser(connection)
+        if userID is not None and self.node is not None:
+            self.node.publish(PRESENCE, {"kind": "logout", "user": userID})
+
+    def getLocalUsers(self) -> list:  # Gives the IDs of the users logged in on this node
+        with self.lock:
+            return list(self.users)
+
+    def addRemoteUsers(self, userIDs, nodeID: str) -> None:
+        with self.lock:
+            for userID in userIDs:
+                self.remoteUsers[str(userID)] = nodeID
+
+    def removeRemoteUser(self, userID, nodeID: str) -> None:
+        with self.lock:
+            if self.remoteUsers.get(str(userID)) == nodeID:  # Unless they have since logged in somewhere else
+                del self.remoteUsers[str(userID)]
+
+    def forgetNode(self, nodeID: str) -> None:  # Forgets everyone who was logged in on a node which has gone
+        with self.lock:
+            self.remoteUsers = {userID: node for userID, node in self.remoteUsers.items() if node != nodeID}
+
+    def isOnline(self, userID) -> bool:  # Users on other nodes are online, but have no connection here
+        with self.lock:
+            return self.isLoggedIn(str(userID))
+
+
+class ClusterNode:  # Shares one server's broadcasts, logins and group changes with the rest of its cluster, and
+    # acts on theirs. Accounts and memberships are shared by pointing every node at the same database; message
+    # history is shared by every node saving every message to its own log. Each node numbers the messages in the
+    # order it saved them (its own straight away, the others' once they are relayed), so message IDs, and the
+    # since/before cursors made from them, only mean anything on the node which gave them. A client which moves to
+    # another node should start again from the latest page
+    def __init__(self, backend: PubSubBackend, presenceRegistry: ClusterPresenceRegistry, messageStorage,
+                 eventQueue, storageMethod=None, groupKeyring=None, nodeID: str = None):
+        self.backend = backend
+        self.nodeID = nodeID if nodeID is not None else uuid.uuid4().hex
+        self.presenceRegistry = presenceRegistry
+        self.messageStorage = messageStorage
+        self.eventQueue = eventQueue
+        self.storageMethod = storageMethod
+        self.groupKeyring = groupKeyring
+        backend.subscribe(MESSAGES, self.onMessage)
+        backend.subscribe(PRESENCE, self.onPresence)
+        backend.subscribe(GROUPS, self.onGroupChange)
+        presenceRegistry.node = self
+        if hasattr(storageMethod, "addListener"):  # Only a cache can be out of date, so only then do other nodes
+            # need telling about membership changes
+            storageMethod.addListener(self.relayMemberships)
+        if groupKeyring is not None:
+            groupKeyring.addListener(self.relayRotation)
+        self.publish(PRESENCE, {"kind": "hello"})  # The other nodes reply with who is logged in on them
+
+    def publish(self, channel: str, payload: dict) -> None:
+        payload["node"] = self.nodeID
+        self.backend.publish(channel, payload)
+
+    def relayMessage(self, groupID, message: str, record: dict) -> None:  # Sends a message to the group's members
+        # on the other nodes, along with the record to save in their history
+        self.publish(MESSAGES, {"group": str(groupID), "message": message, "record": record})
+
+    def relayMemberships(self, memberships) -> None:
+        self.publish(GROUPS, {"memberships": [[str(userID), str(groupID)] for userID, groupID in memberships]})
+
+    def relayRotation(self, groupID) -> None:
+        self.publish(GROUPS, {"rotate": str(groupID)})
+
+    def onMessage(self, payload: dict) -> None:
+        self.eventQueue.put(events.RelayedMessage([self.presenceRegistry, payload["group"], payload["message"],
+                                                   payload["record"], self.messageStorage, self.groupKeyring]))
+
+    def onPresence(self, payload: dict) -> None:
+        kind = payload["kind"]
+        nodeID = payload["node"]
+        if kind == "hello":  # A new node wants to know who is logged in here
+            self.publish(PRESENCE, {"kind": "users", "users": self.presenceRegistry.getLocalUsers()})
+        elif kind == "users" or kind == "login":
+            self.presenceRegistry.addRemoteUsers(payload["users"] if kind == "users" else [payload["user"]], nodeID)
+        elif kind == "logout":
+            self.presenceRegistry.removeRemoteUser(payload["user"], nodeID)
+        elif kind == "nodeLeft":
+            self.presenceRegistry.forgetNode(nodeID)
+
+    def onGroupChange(self, payload: dict) -> None:
+        if "memberships" in payload and hasattr(self.storageMethod, "forgetMemberships"):
+            self.storageMethod.forgetMemberships(payload["memberships"])
+        if "rotate" in payload and self.groupKeyring is not None:
+            self.groupKeyring.forgetKey(payload["rotate"])
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a broker which connects the servers in a cluster")
+    parser.add_argument("path", help="where to make the broker's UNIX socket")
+    arguments = parser.parse_args()
+    UnixSocketBroker(arguments.path).serveForever()
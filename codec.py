@@ -0,0 +1,202 @@
+import struct
+import json
+
+BINARY = "binary"  # The encoding given to payloads packed with this codec, rather than sent as JSON
+MAX_FIX_INT = 0x7f  # Tags up to this are the integer itself
+FIX_STR = 0x80  # Tags from here up to 0x9f are a string of up to 31 bytes (the low bits being its length)
+FIX_LIST = 0xa0  # Then a list of up to 15 items
+FIX_MAP = 0xb0  # Then a map of up to 15 pairs
+NONE = 0xc0
+FALSE = 0xc1
+TRUE = 0xc2
+INT = 0xc3  # Followed by the zigzagged integer as a varint
+FLOAT = 0xc4  # Followed by 8 bytes
+STR = 0xc5  # Followed by the length as a varint, then the UTF-8
+BYTES = 0xc6  # Followed by the length as a varint, then the bytes
+LIST = 0xc7  # Followed by how many items as a varint, then the items
+MAP = 0xc8  # Followed by how many pairs as a varint, then each key followed by its value
+double = struct.Struct(">d")
+
+
+def packVarint(number: int, output: bytearray) -> None:  # Seven bits to a byte, with the top bit set on every byte
+    # but the last
+    while number > 0x7f:
+        output.append(number & 0x7f | 0x80)
+        number >>= 7
+    output.append(number)
+
+
+def packLength(length: int, fixTag: int, fixLimit: int, tag: int, output: bytearray) -> None:  # Small lengths are kept
+    # in the tag itself
+    if length < fixLimit:
+        output.append(fixTag | length)
+    else:
+        output.append(tag)
+        packVarint(length, output)
+
+
+def packValue(value, output: bytearray) -> None:
+    valueType = type(value)
+    if valueType is str:
+        encoded = value.encode("utf-8")
+        if len(encoded) < 32:  # Most strings are short, so this is checked here rather than in packLength
+            output.append(FIX_STR | len(encoded))
+        else:
+            output.append(STR)
+            packVarint(len(encoded), output)
+        output += encoded
+    elif valueType is int:
+        if 0 <= value <= MAX_FIX_INT:
+            output.append(value)
+        else:
+            output.append(INT)
+            packVarint(value << 1 if value >= 0 else (-value << 1) - 1, output)  # Zigzagged, so small negative
+            # numbers stay small
+    elif valueType is dict:
+        packLength(len(value), FIX_MAP, 16, MAP, output)
+        for key, item in value.items():
+            packValue(key, output)
+            packValue(item, output)
+    elif valueType is list or valueType is tuple:
+        packLength(len(value), FIX_LIST, 16, LIST, output)
+        for item in value:
+            packValue(item, output)
+    elif value is None:
+        output.append(NONE)
+    elif value is True:
+        output.append(TRUE)
+    elif value is False:
+        output.append(FALSE)
+    elif valueType is float:
+        output.append(FLOAT)
+        output += double.pack(value)
+    elif valueType is bytes or valueType is bytearray:
+        output.append(BYTES)
+        packVarint(len(value), output)
+        output += value
+    else:
+        raise TypeError(f"A {valueType.__name__} can't be packed")
+
+
+def pack(value) -> bytes:  # Packs a value made of dictionaries, lists, strings, numbers, bytes, booleans and None
+    output = bytearray()
+    packValue(value, output)
+    return bytes(output)
+
+
+def unpackVarint(data: bytes, position: int) -> (int, int):  # Gives the number, and where the data after it starts
+    number = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return number, position
+        shift += 7
+
+
+def unpackBytes(data: bytes, position: int, length: int) -> (bytes, int):
+    end = position + length
+    if end > len(data):
+        raise ValueError("The packed data ends too soon")
+    return data[position:end], end
+
+
+def unpackValue(data: bytes, position: int) -> (object, int):  # Gives the value starting at position, and where the
+    # data after it starts
+    tag = data[position]
+    position += 1
+    if tag <= MAX_FIX_INT:
+        return tag, position
+    if tag < FIX_LIST:
+        end = position + (tag & 0x1f)
+        if end > len(data):
+            raise ValueError("The packed data ends too soon")
+        return data[position:end].decode("utf-8"), end
+    if tag < FIX_MAP:
+        return unpackList(data, position, tag & 0x0f)
+    if tag < NONE:
+        return unpackMap(data, position, tag & 0x0f)
+    if tag == NONE:
+        return None, position
+    if tag == FALSE:
+        return False, position
+    if tag == TRUE:
+        return True, position
+    if tag == INT:
+        number, position = unpackVarint(data, position)
+        return number >> 1 if not number & 1 else -((number + 1) >> 1), position
+    if tag == FLOAT:
+        value, position = unpackBytes(data, position, double.size)
+        return double.unpack(value)[0], position
+    if tag in (STR, BYTES, LIST, MAP):
+        length, position = unpackVarint(data, position)
+        if tag == LIST:
+            return unpackList(data, position, length)
+        if tag == MAP:
+            return unpackMap(data, position, length)
+        value, position = unpackBytes(data, position, length)
+        return value.decode("utf-8") if tag == STR else value, position
+    raise ValueError(f"Unknown tag {tag:#x} in packed data")
+
+
+def unpackList(data: bytes, position: int, length: int) -> (list, int):
+    items = []
+    for i in range(length):
+        item, position = unpackValue(data, position)
+        items.append(item)
+    return items, position
+
+
+def unpackMap(data: bytes, position: int, length: int) -> (dict, int):
+    pairs = {}
+    for i in range(length):
+        tag = data[position]
+        if FIX_STR <= tag < FIX_LIST:  # Keys are almost always short strings, so they are read here
+            end = position + 1 + (tag & 0x1f)
+            if end > len(data):
+                raise ValueError("The packed data ends too soon")
+            key = data[position + 1:end].decode("utf-8")
+            position = end
+        else:
+            key, position = unpackValue(data, position)
+        pairs[key], position = unpackValue(data, position)
+    return pairs, position
+
+
+def unpack(data: bytes):  # Unpacks data made by pack, raising ValueError if it is malformed
+    data = bytes(data)
+    try:
+        value, position = unpackValue(data, 0)
+    except (IndexError, TypeError, RecursionError) as e:  # Data which ends too soon, maps keyed by lists, or data
+        # nested too deeply
+        raise ValueError(f"The packed data is malformed: {e!r}") from e
+    if position != len(data):
+        raise ValueError("There is data after the packed value")
+    return value
+
+
+def encode(value, binary: bool) -> (bytes, str):  # Gives a structured payload and its encoding: packed if the
+    # connection has agreed to use this codec (see transport.usesBinary), otherwise JSON
+    if binary:
+        return pack(value), BINARY
+    return json.dumps(value).encode("utf-8"), "utf-8"
+
+
+def decode(data: bytes, encoding: str):  # Reads a payload made by encode, by either side of the connection. The
+    # encoding comes from the peer, so anything encode wouldn't have given is refused with ValueError
+    if encoding == BINARY:
+        return unpack(data)
+    if encoding != "utf-8":
+        raise ValueError(f"Unknown encoding {encoding}")
+    return json.loads(data.decode(encoding))
+
+
+def encodeToken(token: dict, binary: bool):  # Session tokens are carried as typed fields when packed, but JSON peers
+    # expect them as JSON text inside the payload
+    return token if binary else json.dumps(token)
+
+
+def decodeToken(token) -> dict:  # Reads a token given by either kind of peer
+    return json.loads(token) if isinstance(token, str) else token
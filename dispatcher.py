@@ -0,0 +1,69 @@
+import queue
+import threading
+import metrics
+import time
+
+eventWaitSeconds = metrics.registry.histogram("chatroom_event_wait_seconds",
+                                              "How long each type of event waits in the queue", ("event", ))
+
+
+class EventDispatcher:  # Handles events on a pool of worker threads. Events with the same ordering key always go to
+    # the same worker, so they are handled in the order they were queued, while events with different keys can be
+    # handled in parallel
+    def __init__(self, workerCount: int = 4):
+        self.queues = [queue.Queue() for i in range(workerCount)]
+        self.statsLock = threading.Lock()
+        self.eventStats = {}  # Maps an event type to [count, total time waiting, total time handling, max handling time]
+
+    def start(self, onWorkerStart=None) -> None:  # Starts the workers, each of which runs onWorkerStart first
+        for workerQueue in self.queues:
+            worker = threading.Thread(target=self.work, args=(workerQueue, onWorkerStart), daemon=True)
+            worker.start()
+
+    def put(self, event) -> None:  # Queues an event, in the same way as queue.Queue.put
+        index = hash(event.getOrderingKey()) % len(self.queues)
+        self.queues[index].put((event, time.perf_counter()))
+
+    def join(self) -> None:  # Waits until every event queued so far has been handled
+        for workerQueue in self.queues:
+            workerQueue.join()
+
+    def qsize(self) -> int:  # The total number of events waiting to be handled
+        return sum(workerQueue.qsize() for workerQueue in self.queues)
+
+    def work(self, workerQueue: queue.Queue, onWorkerStart) -> None:
+        if onWorkerStart is not None:
+            onWorkerStart()
+        while True:
+            event, timeQueued = workerQueue.get()  # Blocks until there is an event to handle
+            timeStarted = time.perf_counter()
+            try:
+                event.handle()  # Handle it
+            except Exception as e:
+                print(e)  # If there is an error, log it and continue
+                try:
+                    event.handleError(e)
+                except Exception as replyError:  # If the client can't be told either (e.g. it has gone)
+                    print(replyError)
+            self.recordEvent(type(event).__name__, timeStarted - timeQueued, time.perf_counter() - timeStarted)
+            workerQueue.task_done()
+
+    def recordEvent(self, eventType: str, timeWaiting: float, timeHandling: float) -> None:
+        eventWaitSeconds.observe(timeWaiting, eventType)
+        with self.statsLock:
+            stats = self.eventStats.setdefault(eventType, [0, 0.0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += timeWaiting
+            stats[2] += timeHandling
+            stats[3] = max(stats[3], timeHandling)
+
+    def getStats(self) -> dict:  # Gives the queue depth of each worker, and the latency of each type of event
+        with self.statsLock:
+            eventStats = {eventType: {"count": stats[0],
+                                      "meanWait": stats[1] / stats[0],
+                                      "meanLatency": stats[2] / stats[0],
+                                      "maxLatency": stats[3]}
+                          for eventType, stats in self.eventStats.items()}
+        return {"queueDepth": self.qsize(),
+                "workerQueueDepths": [workerQueue.qsize() for workerQueue in self.queues],
+                "events": eventStats}
@@ -5,8 +5,27 @@ import Crypto.Cipher.AES
 import Crypto.Hash.SHA512
 import argon2
 import argon2.exceptions
+import Crypto.Hash.HMAC
+import Crypto.Hash.SHA256
+import concurrent.futures
+import itertools
+import multiprocessing
+import struct
+import time
 import json
 
+TICKET_LIFETIME = 24 * 60 * 60  # How long (in seconds) a session ticket can be used to resume a session for
+TICKET_SIZE = 16 + 16 + 32 + 8  # A ticket is a nonce, tag, then the encrypted secret and expiry time
+passwordHasher = argon2.PasswordHasher(salt_len=32)  # Creates a hashing class with a salt of 32 bytes, which is
+# reused for every hash
+
+
+def configureArgon(timeCost: int = argon2.DEFAULT_TIME_COST, memoryCost: int = argon2.DEFAULT_MEMORY_COST,
+                   parallelism: int = argon2.DEFAULT_PARALLELISM):  # Changes the parameters used for new hashes
+    global passwordHasher
+    passwordHasher = argon2.PasswordHasher(time_cost=timeCost, memory_cost=memoryCost, parallelism=parallelism,
+                                           salt_len=32)
+
 
 def generateRSAKeyPair() -> (
         Crypto.PublicKey.RSA.RsaKey,
@@ -70,6 +89,52 @@ def decryptDataAES(key: bytes, encrypted: bytes, nonce: bytes, tag: bytes) -> by
     return plaintext
 
 
+class CipherContext:  # Seals data for one connection's key (it is kept by the connection, see
+    # transport.getCipherContext). Nonces come from a counter after a random prefix (so the two ends of a connection,
+    # which share the key, never use the same nonce) rather than from the random number generator, and sealed data is
+    # written into one buffer which is reused for everything the context seals. AES.new still runs for every nonce, as
+    # pycryptodome can't reuse a GCM cipher's key schedule with a new nonce
+    def __init__(self, key: bytes):
+        self.key = key
+        self.noncePrefix = Crypto.Random.get_random_bytes(8)
+        self.counter = itertools.count()  # Taking the next number is atomic, so threads can share the context
+        self.buffer = bytearray()
+
+    def reserve(self, numOfBytes: int) -> memoryview:  # Gives numOfBytes of the reused buffer (making it bigger if it
+        # is too small). Whatever was sealed into it before is overwritten, so anything sealed by the context is only
+        # valid until it next seals (the connection's sendLock should be held until it has been sent)
+        if len(self.buffer) < numOfBytes:
+            self.buffer = bytearray(max(numOfBytes, len(self.buffer) * 2))  # A new buffer rather than resizing, as
+            # the old one may still be viewed
+        return memoryview(self.buffer)[:numOfBytes]
+
+    def nextNonce(self) -> bytes:
+        return self.noncePrefix + next(self.counter).to_bytes(8, "big")
+
+    def sealInto(self, output: memoryview, plaintext: bytes) -> int:  # Writes the nonce, ciphertext and tag into
+        # output, giving how many bytes were written
+        nonce = self.nextNonce()
+        cipher = generateAESCipher(self.key, nonce)
+        end = 16 + len(plaintext)
+        output[:16] = nonce
+        cipher.encrypt(plaintext, output=output[16:end])
+        output[end:end + 16] = cipher.digest()
+        return end + 16
+
+    def seal(self, plaintext: bytes) -> memoryview:  # Gives the nonce, ciphertext and tag, in the reused buffer
+        sealed = self.reserve(32 + len(plaintext))
+        self.sealInto(sealed, plaintext)
+        return sealed
+
+    def sealEach(self, messages: list) -> memoryview:  # Seals each message on its own, one after the other in the
+        # reused buffer
+        sealed = self.reserve(sum(32 + len(message) for message in messages))
+        position = 0
+        for message in messages:
+            position += self.sealInto(sealed[position:], message)
+        return sealed
+
+
 def hashStringWithSHA(string: str, salt: bytes = b'') -> str:
     data = string.encode("utf-8")
     if len(salt) != 32 and salt != b"":
@@ -83,19 +148,63 @@ def hashStringWithSHA(string: str, salt: bytes = b'') -> str:
 
 
 def hashStringWithArgon(string: str) -> str:
-    hashingAlgorithm = argon2.PasswordHasher(salt_len=32)  # Creates a new hashing class with a salt of 32 bytes
-    return hashingAlgorithm.hash(string)  # Hash the string
+    return passwordHasher.hash(string)  # Hash the string
 
 
 def verifyHashWithArgon(hashed: str, password: str) -> bool:
-    hashingAlgorithm = argon2.PasswordHasher(salt_len=32)  # Specifies a 32 byte salt length
     try:
-        hashingAlgorithm.verify(hashed, password)  # Verifies the hash
+        passwordHasher.verify(hashed, password)  # Verifies the hash (using the parameters stored in it)
         return True  # If this succeeds, return true
-    except argon2.exceptions.InvalidHash:  # If the verification fails,
+    except (argon2.exceptions.InvalidHash, argon2.exceptions.VerificationError):  # If the verification fails,
         return False  # Return false
 
 
+class PasswordHashingPool:  # Hashes and verifies passwords in other processes, so that the CPU time Argon2 takes
+    # doesn't hold up the rest of the server
+    def __init__(self, processes: int = None, timeCost: int = argon2.DEFAULT_TIME_COST,
+                 memoryCost: int = argon2.DEFAULT_MEMORY_COST, parallelism: int = argon2.DEFAULT_PARALLELISM):
+        self.executor = concurrent.futures.ProcessPoolExecutor(processes, multiprocessing.get_context("spawn"),
+                                                               configureArgon, (timeCost, memoryCost, parallelism))
+        # The processes are spawned rather than forked, as they are started while the server's threads are running
+
+    def hash(self, password: str) -> concurrent.futures.Future:  # Gives a future for the hashed password
+        return self.executor.submit(hashStringWithArgon, password)
+
+    def verify(self, hashed: str, password: str) -> concurrent.futures.Future:  # Gives a future for whether the
+        # password matches the hash
+        return self.executor.submit(verifyHashWithArgon, hashed, password)
+
+
+class TicketIssuer:  # Issues session tickets, which let a client that has connected before agree on a new key
+    # without RSA. A ticket holds a random secret sealed with a key only the server knows, so the server doesn't need
+    # to remember the tickets it has issued
+    def __init__(self, keyFile: str = "ticket.key", lifetime: int = TICKET_LIFETIME):
+        self.key = readOrMakeAESKey(keyFile)  # The key is kept in a file, so tickets still work after a restart
+        self.lifetime = lifetime
+
+    def issue(self) -> (bytes, bytes):  # Gives a new secret, and the ticket which holds it
+        secret = generateKey()
+        expiry = struct.pack(">Q", int(time.time()) + self.lifetime)
+        nonce, encrypted, tag = encryptDataAES(secret + expiry, self.key)
+        return secret, nonce + tag + encrypted  # TICKET_SIZE bytes
+
+    def redeem(self, ticket: bytes) -> bytes:  # Gives the secret held in a ticket, or None if the ticket is forged or
+        # has expired
+        try:
+            plaintext = decryptDataAES(self.key, ticket[32:], ticket[:16], ticket[16:32])
+        except ValueError:
+            return None
+        secret, expiry = plaintext[:32], struct.unpack(">Q", plaintext[32:])[0]
+        if expiry < time.time():
+            return None
+        return secret
+
+
+def deriveResumedKey(secret: bytes, clientNonce: bytes, serverNonce: bytes) -> bytes:  # Makes the AES key for a
+    # resumed session; both sides add a random nonce, so each connection gets a fresh key
+    return Crypto.Hash.HMAC.new(secret, clientNonce + serverNonce, Crypto.Hash.SHA256).digest()
+
+
 def readAESKey(filename: str) -> bytes:  # Reads an AES key from a file
     with open(filename, "rb") as file:
         AESKey = file.read()
@@ -107,6 +216,15 @@ def writeAESKey(filename: str, AESKey: bytes):  # Writes an AES key from a file
         file.write(AESKey)
 
 
+def readOrMakeAESKey(filename: str) -> bytes:  # Reads an AES key from a file, making one if there isn't one yet
+    try:
+        return readAESKey(filename)
+    except FileNotFoundError:
+        AESKey = generateKey()
+        writeAESKey(filename, AESKey)
+        return AESKey
+
+
 def writeEncryptedJSON(filename: str, AESKey: bytes, JSONData: dict):  # Saves a dictionary to an encrypted json file
     plaintext = json.dumps(JSONData)
     nonce, ciphertext, tag = encryptDataAES(plaintext.encode("utf-8"), AESKey)
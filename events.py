@@ -1,38 +1,262 @@
 import transport
-import encryption
+import storage
+import fanout
+import metrics
+import profiler
+import codec
 import Crypto.Random
+import functools
+import math
+import threading
 import json
+import time
+
+eventSeconds = metrics.registry.histogram("chatroom_event_seconds", "How long each type of event takes to handle",
+                                          ("event", ))
+eventsFailed = metrics.registry.counter("chatroom_events_failed_total", "Events whose handling raised an error",
+                                        ("event", ))
+unknownRequests = metrics.registry.counter("chatroom_unknown_requests_total", "Requests of a type the server doesn't "
+                                           "know, which are logged (up to a rate) and otherwise ignored")
+invalidRequests = metrics.registry.counter("chatroom_invalid_requests_total", "Requests which didn't fit their "
+                                           "type's schema", ("type", ))
+UNKNOWN_LOG_RATE = 5  # How many requests of unknown types are logged each second, at most
+UNKNOWN_LOG_BURST = 20  # How many can be logged at once after a quiet spell
+
+messageTypes = {}  # Maps each type of data a client can send to the event which handles it. Filled in as events
+# declaring a wireType are defined, so a plugin can add types just by defining events
+
+
+def measureHandle(handle):  # Wraps an event's handle, recording how long it takes and whether it fails
+    @functools.wraps(handle)
+    def measuredHandle(self):
+        start = time.perf_counter()
+        try:
+            return handle(self)
+        except Exception:
+            eventsFailed.inc(1, type(self).__name__)
+            raise
+        finally:
+            eventSeconds.observe(time.perf_counter() - start, type(self).__name__)
+    return measuredHandle
+
+
+def describeTypes(types) -> str:  # e.g. "int or str"
+    types = types if isinstance(types, tuple) else (types, )
+    return " or ".join("null" if fieldType is type(None) else fieldType.__name__ for fieldType in types)
+
+
+class Services:  # What the server gives the events made from clients' requests
+    def __init__(self, presenceRegistry, eventQueue, hashingPool=None, groupKeyring=None, clusterNode=None,
+                 profiler=None, adminUsers=frozenset()):
+        self.presenceRegistry = presenceRegistry
+        self.eventQueue = eventQueue
+        self.hashingPool = hashingPool
+        self.groupKeyring = groupKeyring  # None if group keys aren't being used
+        self.clusterNode = clusterNode  # None if the server isn't part of a cluster
+        self.profiler = profiler
+        self.adminUsers = adminUsers
 
 
 class Event:
-    def __init__(self, context):  # The context here is just the parameters of the event (the contents of a message,
-        # the data in a file)
+    clientIndex = None  # Where in the context the client which caused the event is, if there is one
+    wireType = None  # The type of data a client sends to cause this event, if clients can cause it
+    schema = None  # The fields a request of the wireType must have in its JSON, mapped to their types (a field
+    # which may be left out includes type(None)), or None if the data is passed on as it is
+
+    def __init_subclass__(cls, **kwargs):  # Every kind of event is measured, without it having to do anything, and
+        # is registered if clients can cause it
+        super().__init_subclass__(**kwargs)
+        if "handle" in cls.__dict__:
+            cls.handle = measureHandle(cls.__dict__["handle"])
+        if "wireType" in cls.__dict__ and cls.wireType is not None:
+            if cls.clientIndex is None:  # An event clients can cause must be able to reply to them
+                raise TypeError(f"{cls.__name__} has a wireType, so it needs a clientIndex")
+            messageTypes[cls.wireType] = cls  # A later event with the same wireType (e.g. from a plugin) replaces
+            # the earlier one
+
+    @classmethod
+    def decode(cls, data: bytes, encoding: str):  # Turns the data a client sent into the request fromRequest is
+        # given, raising ValueError if it doesn't fit the schema
+        if cls.schema is None:
+            return data
+        return cls.validate(codec.decode(data, encoding))
+
+    @classmethod
+    def validate(cls, request):
+        if not isinstance(request, dict):
+            raise ValueError(f"A {cls.wireType} request must be a JSON object")
+        for field, types in cls.schema.items():
+            if not isinstance(request.get(field), types):
+                raise ValueError(f"A {cls.wireType} request's {field} must be {describeTypes(types)}")
+        return request
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):  # Makes the event from a decoded request. By default
+        # its context is just the client and the request, so events which need more from the server override this
+        context = [None] * (cls.clientIndex + 1) + [request]
+        context[cls.clientIndex] = client
+        return cls(context)
+
+    def __init__(self, context, requestID: int = None):  # The context here is just the parameters of the event (the
+        # contents of a message, the data in a file). The request ID is the one the client gave the request which
+        # caused the event, if it gave one
         self.context = context
+        self.requestID = requestID
 
     def handle(self):  # For children of this class, this will contain the code for handling the respective event
         pass
 
+    def getOrderingKey(self):  # Events with the same key are handled in the order they were queued
+        if self.clientIndex is None:  # Events which don't come from a client are kept in order with their own type
+            return type(self).__name__
+        return self.context[self.clientIndex]  # Otherwise, each client's events are kept in order (even when its
+        # token changes group), while different clients' events, such as guests logging in, are handled in parallel.
+        # The client itself is the key rather than its id(), as ids are all multiples of 16, so they would all land
+        # on the same worker when there are a power of two of them.
+        # Messages from different clients in a group aren't ordered with each other; each recipient gets them in
+        # the order they were broadcast, and the history keeps the order they were saved in
+
+    def reply(self, data: bytes, typeOfData: str, encoding: str) -> None:  # Queues data for the client which caused
+        # the event, giving back the ID of its request (if it gave one) so it can tell which request this answers.
+        # Replies go through the client's outbox like broadcasts do (and so follow the same policy when it is full),
+        # so a client which isn't reading can't hold up the event worker
+        client = self.context[self.clientIndex]
+        client.outbox.put(data, typeOfData, encoding, self.requestID)
+
+    def replyWith(self, value, typeOfData: str) -> None:  # Replies with a structured value, packed if the client has
+        # agreed to use the binary codec, otherwise as JSON
+        client = self.context[self.clientIndex]
+        data, encoding = codec.encode(value, transport.usesBinary(client.clientSock))
+        self.reply(data, typeOfData, encoding)
+
+    def replyWithToken(self) -> None:  # Gives the client its (new) session token
+        client = self.context[self.clientIndex]
+        self.replyWith({"newToken": codec.encodeToken(client.sessionToken, transport.usesBinary(client.clientSock))},
+                       "newToken")  # The token is wrapped, because it is possible for the server to send nothing,
+        # which would otherwise cause an error
+
+    def showMessage(self, message: str, typeOfData: str = "didSucceedMessage") -> None:  # Tells the client how its
+        # request went. Clients which numbered the request are always told, so they aren't left waiting for a reply;
+        # otherwise, only clients which aren't APIs are
+        if self.requestID is not None:
+            self.reply(message.encode("utf-8"), typeOfData, "utf-8")
+        else:
+            self.context[self.clientIndex].showMessage(message)
+
+    def handleError(self, error: Exception) -> None:  # Called when handling the event fails, so a client waiting for
+        # a reply is told
+        if self.requestID is not None and self.clientIndex is not None:
+            self.showMessage("\nError! The request failed", "error")
+
+    def queueWhenDone(self, future, eventQueue, makeEvent) -> None:  # Queues the event makeEvent makes from a
+        # future's result once it is done. If the future failed instead (the work raised, or the pool running it
+        # broke), the client is told its request failed, rather than never being replied to
+        client = self.context[self.clientIndex]
+
+        def queue(future):
+            error = future.exception() if not future.cancelled() else "it was cancelled"
+            if error is None:
+                eventQueue.put(makeEvent(future.result()))
+                return None
+            eventsFailed.inc(1, type(self).__name__)
+            print(f"Couldn't finish a {type(self).__name__} event: {error!r}")
+            eventQueue.put(RequestFailed([client, "The request failed"], self.requestID))
+        future.add_done_callback(queue)
+
 
 class Log(Event):  # An event which will be used for testing purposes
     def handle(self):  # It simply prints out its context
         print(self.context)
 
 
+class InvalidRequest(Event):  # Tells a client that its request couldn't be understood
+    clientIndex = 0
+
+    def handle(self):
+        self.showMessage(f"\nError! {self.context[1]}", "error")
+
+
+class RequestFailed(InvalidRequest):  # Tells a client that its request was understood, but couldn't be carried out
+    pass
+
+
+class RateLimiter:  # A token bucket: lets up to rate things through each second, with bursts of up to burst
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+unknownLogLimiter = RateLimiter(UNKNOWN_LOG_RATE, UNKNOWN_LOG_BURST)
+
+
+def dispatch(dataType: str, encoding: str, data: bytes, client, services: Services,
+             requestID: int = None) -> Event:  # Makes the event handling a client's request, with one lookup of its
+    # type and one decode. Gives None if there is nothing to do
+    eventType = messageTypes.get(dataType)
+    if eventType is None:
+        unknownRequests.inc()
+        if requestID is not None:  # The client is waiting for a reply
+            event = InvalidRequest([client, f"Unknown request type {dataType}"])
+        elif unknownLogLimiter.allow():  # Otherwise it is just logged, though a client sending a flood of them
+            # mustn't be able to flood the log too
+            event = Log(data)
+        else:
+            return None
+    else:
+        try:
+            event = eventType.fromRequest(eventType.decode(data, encoding), client, services)
+        except ValueError as e:  # Which includes JSON, text and encodings which can't be decoded
+            invalidRequests.inc(1, dataType)
+            event = InvalidRequest([client, str(e)])
+        except Exception as e:  # Whatever else goes wrong, the client's connection mustn't go down with it
+            invalidRequests.inc(1, dataType)
+            print(f"Couldn't make a {dataType} event: {e!r}")
+            event = InvalidRequest([client, f"The {dataType} request couldn't be read"])
+    event.requestID = requestID
+    return event
+
+
 class Heartbeat(Event):  # An event which performs a heartbeat with a client
+    clientIndex = 0
+    wireType = "doHeartbeat"
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([client, request])
+
     def handle(self):
-        client = self.context[0]
-        transport.sendDynamicData(self.context[1], "heartbeatResponse", "none", client.clientSock, client.AESKey)
+        self.reply(self.context[1], "heartbeatResponse", "none")
 
 
 class Message(Event):  # An event for handling messages given to the client
+    clientIndex = 2
+    wireType = "message"
+    schema = {"message": str, "sessionToken": (str, dict)}
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([services.presenceRegistry, request, client, services.groupKeyring, services.clusterNode])
+
     def handle(self):
-        groupClients = self.context[0]
-        data = self.context[1]
+        presenceRegistry = self.context[0]
+        messageAndToken = self.context[1]
         currentClient = self.context[2]
-        encoding = self.context[3]
-        data = data.decode(encoding)
-        messageAndToken = json.loads(data)
-        token = json.loads(messageAndToken["sessionToken"])
+        groupKeyring = self.context[3]  # None if group keys aren't being used
+        clusterNode = self.context[4]  # None if the server isn't part of a cluster
+        token = codec.decodeToken(messageAndToken["sessionToken"])
         if token != currentClient.sessionToken:  # If the tokens don't match,
             currentClient.resetToken()  # Log the user out
         clientID = currentClient.sessionToken["id"]
@@ -44,62 +268,153 @@ class Message(Event):  # An event for handling messages given to the client
         currentClient.messageStorage.putMessage(toSave)  # Save the message to the storage
         message = f"{currentClient.username}: {messageAndToken['message']}"  # Formats the message so that it
         # includes not only the message, but the user who said it
-        clients = groupClients[currentClient.sessionToken["groupID"]]  # Gets a list of clients in the group
-        for client in clients:
-            transport.sendDynamicData(message.encode("utf-8"), "message", 'utf-8', client.clientSock,
-                                      client.AESKey)  # Send the message to all clients in the group
+        groupID = currentClient.sessionToken["groupID"]
+        clients = presenceRegistry.getGroupMembers(groupID)  # Gets the clients in the group
+        fanout.broadcast(clients, message.encode("utf-8"), "message", "utf-8", groupID,
+                         groupKeyring)  # Queue the message for all clients in the group; each client's outbox sends
+        # it, so a slow client doesn't hold up the rest
+        if clusterNode is not None:  # Send it to the group's members on the cluster's other nodes too
+            clusterNode.relayMessage(groupID, message, toSave)
 
 
-class RetrieveMessages(Event):
+class RelayedMessage(Event):  # A message said on another node of the cluster, to be saved and sent to this node's
+    # members of the group
+    def handle(self):
+        presenceRegistry = self.context[0]
+        groupID = self.context[1]
+        message = self.context[2]
+        record = self.context[3]
+        messageStorage = self.context[4]
+        groupKeyring = self.context[5]
+        messageStorage.putMessage(record)
+        fanout.broadcast(presenceRegistry.getGroupMembers(groupID), message.encode("utf-8"), "message", "utf-8",
+                         groupID, groupKeyring)
+
+    def getOrderingKey(self):  # Kept in order with the group's other messages
+        return str(self.context[1])
+
+
+class RetrieveMessages(Event):  # Gives a page of the group's history. The IDs in it (and so the since and before
+    # cursors made from them) are positions in this server's history; in a cluster, each node numbers the messages
+    # in the order it saved them, so a cursor from one node doesn't carry over to another
+    clientIndex = 0
+    wireType = "getMessages"
+    schema = {"limit": (int, str, type(None)), "since": (int, str, type(None)), "before": (int, str, type(None))}
+
+    @classmethod
+    def validate(cls, request):
+        if not isinstance(request, dict):  # Older clients only send their token
+            request = {}
+        return super().validate(request)
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        query = {key: int(request[key]) for key in ("limit", "since", "before")
+                 if request.get(key) is not None}  # Clients which don't ask for particular messages get the latest
+        # ones as a plain list
+        return cls([client, client.messageStorage, query if query else None])
+
     def handle(self):
         client = self.context[0]
         messages = self.context[1]
+        query = self.context[2] if len(self.context) > 2 else None  # Which messages the client asked for, if it
+        # asked for any in particular
         group = client.sessionToken["groupID"]
-        try:
-            relevantMessages = messages.getMessages()[group]  # Get a list of messages in the required group
-        except KeyError:
-            return None  # If there aren't any messages, do nothing
-        messageList = []
-        for i in relevantMessages:
-            userInfo = json.loads(i["sender"])  # Load info about the user (ID, username)
-            messageList.append(f"{userInfo['username']}: {i['message']}")  # Format the message
-        toBeSent = json.dumps(messageList)  # Dumps the entire message list into one string
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "retrievedMessages", "utf-8", client.clientSock,
-                                  client.AESKey)  # Send this to the client
+        if query is None:  # If the client didn't ask for particular messages, send the latest ones as a plain list
+            page, hasMore = messages.getMessagePage(group, storage.HISTORY_LENGTH)
+            if not page:
+                return None  # If there aren't any messages, do nothing
+            self.replyWith([message for ID, message in page], "retrievedMessages")  # Send this to the client
+            return None
+        page, hasMore = messages.getMessagePage(group, query.get("limit", storage.HISTORY_LENGTH),
+                                                query.get("since"), query.get("before"))
+        self.replyWith({"group": group, "messages": [{"id": ID, "message": message} for ID, message in page],
+                        "hasMore": hasMore}, "messagePage")
 
 
 class NewAccount(Event):  # An event for handling new accounts
+    clientIndex = 1
+    wireType = "makeAccount"
+    schema = {"username": str, "password": str}
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([client.storageMethod, client, request["username"], request["password"], services.hashingPool,
+                    services.eventQueue, services.presenceRegistry])
+
     def handle(self):
         storageMethod = self.context[0]
         client = self.context[1]
         username = self.context[2]
         password = self.context[3]
-        userID = storageMethod.addUser(username, encryption.hashStringWithArgon(
-            password))  # Add the username and the hashed password
+        hashingPool = self.context[4]
+        eventQueue = self.context[5]
+        presenceRegistry = self.context[6]
+        hashedPassword = hashingPool.hash(password)  # The password is hashed in another process, and the account is
+        # made once that is done
+        self.queueWhenDone(hashedPassword, eventQueue,
+                           lambda result: FinishNewAccount([storageMethod, client, username, result, presenceRegistry],
+                                                           self.requestID))
+
+
+class FinishNewAccount(Event):  # Makes a new account once its password has been hashed
+    clientIndex = 1
+
+    def handle(self):
+        storageMethod = self.context[0]
+        client = self.context[1]
+        username = self.context[2]
+        hashedPassword = self.context[3]
+        presenceRegistry = self.context[4]
+        userID = storageMethod.addUser(username, hashedPassword)  # Add the username and the hashed password
         storageMethod.addUserToGroup(userID, 1)  # Add the user to the default group
+        presenceRegistry.login(client, userID)
         sessionTokenBytes = Crypto.Random.get_random_bytes(32).hex()  # Generates a 32-byte session token
         client.sessionToken["randomBytes"] = sessionTokenBytes
         client.sessionToken["id"] = userID  # Sets the ID to the one generated by SQL
         client.username = username  # Caches the username
-        toSend = json.dumps({"newToken": json.dumps(client.sessionToken)})
-        transport.sendDynamicData(toSend.encode("utf-8"), "newToken", "utf-8", client.clientSock,
-                                  client.AESKey)  # Sends the session token to the client
+        self.replyWithToken()  # Sends the session token to the client
 
 
 class Login(Event):
+    clientIndex = 1
+    wireType = "login"
+    schema = {"username": str, "password": str}
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([client.storageMethod, client, request["username"], request["password"],
+                    services.presenceRegistry, services.hashingPool, services.eventQueue])
+
     def handle(self):
         storageMethod = self.context[0]
         client = self.context[1]
         userInfo = self.context[2]
         password = self.context[3]
-        clients = self.context[4]
-        userIDs = [i.sessionToken["id"] for i in
-                   clients]  # Gets a list of user IDs which are currently connected
+        presenceRegistry = self.context[4]
+        hashingPool = self.context[5]
+        eventQueue = self.context[6]
         userID = userInfo.split(":")[1]  # Gets the user's ID from the entered username:ID format
         username, hashedPassword = storageMethod.getUser(
             userID)  # Retrieves the user's name and hashed password from the database
+        passwordMatches = hashingPool.verify(hashedPassword, password)  # The password is checked in another
+        # process, and the client is logged in once that is done
+        self.queueWhenDone(passwordMatches, eventQueue,
+                           lambda result: FinishLogin([client, userID, username, result, presenceRegistry],
+                                                      self.requestID))
+
+
+class FinishLogin(Event):  # Logs a client in (or not) once their password has been checked
+    clientIndex = 0
+
+    def handle(self):
+        client = self.context[0]
+        userID = self.context[1]
+        username = self.context[2]
+        passwordMatches = self.context[3]
+        presenceRegistry = self.context[4]
         sessionTokenBytes = Crypto.Random.get_random_bytes(32).hex()  # Generates a session token
-        if encryption.verifyHashWithArgon(hashedPassword, password) and userID not in userIDs:
+        if passwordMatches and presenceRegistry.login(client, userID):  # The user can't log in if they already are
             client.sessionToken["randomBytes"] = sessionTokenBytes  # If the password is correct, give the client the
             # token
             client.sessionToken["id"] = userID
@@ -107,116 +422,210 @@ class Login(Event):
         else:
             client.resetToken()
             client.username = 'Guest'
-        toSend = json.dumps({
-            "newToken": json.dumps(
-                client.sessionToken)})  # JSON is used because it is possible for the server to send nothing,
-        # which would otherwise cause an error.
-        transport.sendDynamicData(toSend.encode("utf-8"), "newToken", "utf-8", client.clientSock,
-                                  client.AESKey)  # Sends the session token to the client
+        self.replyWithToken()  # Sends the session token to the client
 
 
 class Logout(Event):
+    clientIndex = 0
+    wireType = "logout"
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):  # Whatever the client sent doesn't matter
+        return cls([client, services.presenceRegistry])
+
     def handle(self):
         client = self.context[0]
         client.resetToken()
 
 
 class MakeGroup(Event):
+    clientIndex = 0
+    wireType = "makeGroup"
+    schema = {"groupName": str}
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([client, request["groupName"], client.storageMethod])
+
     def handle(self):
         client = self.context[0]
         groupName = self.context[1]
         storageMethod = self.context[2]
         groupID = storageMethod.addGroup(groupName)  # Uses the database to create the new group
-        toSend = {"groupID": groupID}
-        toBeSent = json.dumps(toSend)
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "groupID", "utf-8", client.clientSock, client.AESKey)
-        # Sends the client the new group's ID
+        self.replyWith({"groupID": groupID}, "groupID")  # Sends the client the new group's ID
         if client.sessionToken["id"] != "0":  # If the client is logged-in,
             userID = client.sessionToken["id"]
             storageMethod.addUserToGroup(userID, groupID)  # Add them to the group
 
 
 class GroupSwitch(Event):
+    clientIndex = 0
+    wireType = "switchGroup"
+    schema = {"groupToSwitchTo": (int, str)}
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([client, request["groupToSwitchTo"], services.presenceRegistry, services.eventQueue])
+
     def handle(self):
         client = self.context[0]
         groupID = self.context[1]
-        groupClients = self.context[2]
+        presenceRegistry = self.context[2]
         eventQueue = self.context[3]
         if int(client.sessionToken["id"]) not in client.storageMethod.getUsersFromGroup(groupID):
-            client.showMessage("\nError! You are not in the group!")  # If the user is not in the group, send an
-            # Error message and quit.
+            self.showMessage("\nError! You are not in the group!", "error")  # If the user is not in the group,
+            # send an error message and quit.
             return None
-        if client in groupClients[client.sessionToken["groupID"]]:
-            groupClients[client.sessionToken["groupID"]].remove(client)  # Remove the client from their current group
-        try:
-            groupClients[groupID].append(client)  # And add them to the new one
-        except KeyError:
-            groupClients[groupID] = [client]
+        presenceRegistry.joinGroup(client, groupID)  # Move the client from their current group to the new one
         client.sessionToken["groupID"] = groupID  # Otherwise, change the client's groupID
-        transport.sendDynamicData(json.dumps(client.sessionToken).encode("utf-8"), "changeToken", "utf-8",
-                                  client.clientSock, client.AESKey)  # And tell the client
+        self.replyWith(client.sessionToken, "changeToken")  # And tell the client
         if not client.isAPI:  # If the client is not an API,
             eventQueue.put(RetrieveMessages([client, client.messageStorage]))  # Retrieve messages
 
 
 class ListGroups(Event):
+    clientIndex = 0
+    wireType = "getGroups"
+    schema = {"token": (str, dict)}
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([client, codec.decodeToken(request["token"]), client.storageMethod])
+
     def handle(self):
         client = self.context[0]
         token = self.context[1]
         storageMethod = self.context[2]
         if token != client.sessionToken:  # If the client has not logged in properly,
             client.resetToken()  # Log them out
+            self.showMessage("\nError! You are not logged in!", "error")
             return None
         clientID = client.sessionToken["id"]
         groups = storageMethod.getGroupsFromUser(clientID)  # Get all the groups which the client is in
-        groupNames = [storageMethod.getGroup(i) for i in groups]  # Get all the groups' names
+        groupNames = storageMethod.getGroups(groups)  # Get all the groups' names
         toSend = []
-        for i in range(len(groups)):
-            group = groups[i]
-            groupName = groupNames[i]
+        for group in groups:
+            groupName = groupNames[group]
             toSend.append(f"{groupName}:{group}")
-        transport.sendDynamicData(json.dumps(toSend).encode("utf-8"), "listOfGroups", "utf-8", client.clientSock,
-                                  client.AESKey)  # Send the client a list of group names and IDs
+        self.replyWith(toSend, "listOfGroups")  # Send the client a list of group
+        # names and IDs
 
 
 class LeaveGroup(Event):
+    clientIndex = 0
+    wireType = "leaveGroup"
+    schema = {"token": (str, dict), "group": (int, str)}
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([client, codec.decodeToken(request["token"]), request["group"], client.storageMethod,
+                    services.presenceRegistry, services.eventQueue, services.groupKeyring])
+
     def handle(self):
         client = self.context[0]
         token = self.context[1]
         groupID = self.context[2]
         storageMethod = self.context[3]
-        groupClients = self.context[4]
+        presenceRegistry = self.context[4]
         eventQueue = self.context[5]
+        groupKeyring = self.context[6]
         if str(groupID) == "1":  # Make sure the user doesn't leave the default group
-            client.showMessage("\nError! You cannot leave the default group!")
+            self.showMessage("\nError! You cannot leave the default group!", "error")
             return None
         if token != client.sessionToken:  # If there is an issue with authentication,
             client.resetToken()  # Force a log-out
             return None
         storageMethod.removeUserFromGroup(token["id"], groupID)
-        if groupID == token["groupID"]:  # If the user was in this group,
-            switchGroup = GroupSwitch([client, "1", groupClients, eventQueue])
-            eventQueue.put(switchGroup)  # Switch them to the default group
+        wasInGroup = str(groupID) == str(token["groupID"]) or presenceRegistry.getGroup(client) == str(groupID)  # IDs
+        # arrive as both strings and integers
+        if wasInGroup:  # Stop sending them the group's messages straight away, before its key is replaced, so that
+            # nothing sealed with the new key (nor the key itself) reaches them
+            presenceRegistry.joinGroup(client, "1")
+        if groupKeyring is not None:  # The user mustn't be able to read the group's messages any more
+            groupKeyring.rotate(groupID)
+        if wasInGroup:  # Then tell them they are in the default group (with its history)
+            switchGroup = GroupSwitch([client, "1", presenceRegistry, eventQueue])
+            eventQueue.put(switchGroup)
 
 
 class AddUserToGroup(Event):
+    clientIndex = 0
+    wireType = "addUserToGroup"
+    schema = {"userID": (int, str), "groupID": (int, str)}
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([client, request["userID"], request["groupID"], services.groupKeyring])
+
     def handle(self):
         client = self.context[0]
         userID = self.context[1]
         groupID = self.context[2]
+        groupKeyring = self.context[3]
         storageMethod = client.storageMethod
         clientID = client.sessionToken["id"]
         if int(groupID) not in storageMethod.getGroupsFromUser(clientID):  # If the user is not in the group,
-            client.showMessage("\nError! You are not in the group!")  # Send an error message and quit.
+            self.showMessage("\nError! You are not in the group!", "error")  # Send an error message and quit.
             return None
         # If the user is in the group,
-        client.showMessage(f"\nSuccessfully added user {userID} to group {groupID}")  # Send a success message
+        self.showMessage(f"\nSuccessfully added user {userID} to group {groupID}")  # Send a success message
         storageMethod.addUserToGroup(userID, groupID)  # If they are, add the required user to the group.
+        if groupKeyring is not None:  # The new member mustn't be able to read the group's earlier messages
+            groupKeyring.rotate(groupID)
 
 
 class SaveMessage(Event):
-    def handle(self):  # Saves a dictionary of messages to a file
-        messagesToSave = self.context
-        AESKey = encryption.generateKey()  # Make a new random AES Key for encrypting the messages
-        encryption.writeAESKey("AES.key", AESKey)  # Save the AES Key
-        encryption.writeEncryptedJSON("messages.enc", AESKey, messagesToSave)  # Encrypt and save the messages
+    def handle(self):  # Appends new messages to the message log
+        messageLog = self.context[0]
+        messagesToSave = self.context[1]
+        messageLog.appendMany(messagesToSave)
+
+
+class Profile(Event):  # Starts profiling the server for a number of seconds (replying with the report once it has
+    # finished), or stops the running profile early. Only admins can do this; guests never can
+    clientIndex = 0
+    wireType = "profile"
+    schema = {"action": (str, type(None)), "seconds": (int, float, str, type(None))}  # Without seconds (or with
+    # null), the profile runs for 10
+
+    @classmethod
+    def fromRequest(cls, request, client, services: Services):
+        return cls([client, request, services.profiler, services.adminUsers, cls.parseSeconds(request.get("seconds"))])
+
+    @staticmethod
+    def parseSeconds(seconds) -> float:  # Gives how long the profile asked for should run, or None if that isn't a
+        # length it can run for
+        try:
+            seconds = float(10 if seconds is None else seconds)
+        except (ValueError, OverflowError):  # Overflowing when a whole number is too big for a float
+            return None
+        if not math.isfinite(seconds) or not 0 < seconds <= profiler.MAX_SECONDS:
+            return None
+        return seconds
+
+    def handle(self):
+        client = self.context[0]
+        request = self.context[1]
+        sampler = self.context[2]
+        adminUsers = self.context[3]
+        seconds = self.context[4]
+        userID = str(client.sessionToken["id"])
+        if userID == "0" or userID not in adminUsers:
+            self.refuse("\nError! Only admins can profile the server")
+        elif request.get("action") == "stop":
+            sampler.stop()
+            self.showMessage("\nStopping the profile")
+        elif seconds is None:
+            self.refuse(f"\nError! A profile must run for more than 0 and at most {profiler.MAX_SECONDS} seconds")
+        elif not sampler.start(seconds, self.sendReport):
+            self.refuse("\nError! A profile is already running")
+
+    def refuse(self, message: str) -> None:  # Even APIs are told (whether or not they numbered the request), as
+        # they are waiting for a report
+        self.reply(message.encode("utf-8"), "error", "utf-8")
+
+    def sendReport(self, report: dict) -> None:  # Called on the profiler's thread once the profile has finished
+        try:
+            self.replyWith(report, "profileReport")
+        except OSError:  # If the admin has since left
+            pass
@@ -0,0 +1,274 @@
+import collections
+import selectors
+import threading
+import asyncio
+import itertools
+import select
+import queue
+import encryption
+import transport
+
+DROP = "drop"  # When a client's outbox is full, new frames for it are thrown away
+DISCONNECT = "disconnect"  # When a client's outbox is full, the client is disconnected
+COALESCE = "coalesce"  # When a client's outbox is full, new messages are merged into the last queued message
+POLICIES = (DROP, DISCONNECT, COALESCE)
+
+
+class Outbox:  # A bounded queue of frames waiting to be sent to one client, so that a slow client only holds up
+    # its own messages rather than the whole group's
+    def __init__(self, client, maxSize: int = 1000, policy: str = DROP):
+        self.client = client
+        self.maxSize = maxSize
+        self.policy = policy
+        self.frames = collections.deque()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.dropped = 0  # How many frames have been thrown away because the client couldn't keep up
+
+    def put(self, data: bytes, typeOfData: str, encoding: str, requestID: int = None) -> bool:  # Queues a frame to be
+        # sent to the client (with the ID of the request it replies to, if it is a reply), giving whether it was queued
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.maxSize:  # If the client isn't keeping up, follow the policy
+                if (self.policy == COALESCE and self.frames and self.frames[-1][1] == typeOfData == "message"
+                        and self.frames[-1][3] is None and requestID is None):  # Replies aren't merged, as each
+                    # answers its own request
+                    lastData, lastType, lastEncoding, lastRequestID = self.frames[-1]
+                    self.frames[-1] = (lastData + "\n".encode(lastEncoding) + data, lastType, lastEncoding, None)
+                    return True
+                self.dropped += 1
+                if self.policy == DISCONNECT:
+                    self.closed = True
+                    self.frames.clear()
+                    self.disconnectClient()
+                return False
+            self.frames.append((data, typeOfData, encoding, requestID))
+        self.wakeWriter()
+        return True
+
+    def putFrame(self, frame: bytes) -> bool:  # Queues a frame which has already been sealed, giving whether it was
+        # queued
+        return self.put(frame, None, None)
+
+    def take(self):  # Gives the next frame to send, or None if there isn't one
+        with self.lock:
+            if self.frames:
+                return self.frames.popleft()
+            return None
+
+    def close(self) -> None:  # Stops the writer once it has nothing left to do
+        with self.lock:
+            self.closed = True
+        self.wakeWriter()
+
+    def wakeWriter(self) -> None:  # Tells the writer that there is something to do
+        pass
+
+    def disconnectClient(self) -> None:  # Drops the connection, so the client's reader cleans up after it
+        try:
+            self.client.clientSock.shutdown(2)
+        except OSError:
+            pass
+
+
+class PooledOutbox(Outbox):  # An outbox which is emptied by a shared pool of writer threads
+    def __init__(self, client, pool, maxSize: int = 1000, policy: str = DROP):
+        super().__init__(client, maxSize, policy)
+        self.pool = pool
+        self.scheduled = False  # Whether the outbox is waiting for (or being emptied by) a writer
+
+    def wakeWriter(self) -> None:
+        with self.lock:
+            if self.scheduled:  # If a writer will already get to it, there is nothing to do
+                return None
+            self.scheduled = True
+        self.pool.schedule(self)
+
+    def takeOrFinish(self):  # Gives the next frame, or marks the outbox as no longer scheduled if there isn't one
+        with self.lock:
+            if self.frames:
+                return self.frames.popleft()
+            self.scheduled = False
+            return None
+
+    def writeSome(self) -> None:  # Called by a writer thread to send some of the waiting frames
+        for i in range(self.pool.framesPerTurn):
+            if not isWritable(self.client.clientSock):  # If the client isn't taking data, wait until it is, without
+                # holding up the writer
+                self.pool.park(self)
+                return None
+            frame = self.takeOrFinish()
+            if frame is None:
+                return None
+            try:
+                sendFrame(frame, self.client.clientSock, self.client.AESKey)
+            except OSError:  # If the client has gone, stop
+                with self.lock:
+                    self.closed = True
+                    self.frames.clear()
+                    self.scheduled = False
+                return None
+        self.pool.schedule(self)  # Let other outboxes have a turn before sending the rest
+
+
+def sendFrame(frame: tuple, sock, AESKey: bytes) -> None:  # Sends a frame taken from an outbox
+    data, typeOfData, encoding, requestID = frame
+    if typeOfData is None:  # If it was queued already sealed
+        transport.sendSealedFrame(data, sock)
+    else:
+        transport.sendDynamicData(data, typeOfData, encoding, sock, AESKey, requestID)
+
+
+class WriterPool:  # A pool of threads which send frames from outboxes, so that each client doesn't need its own
+    # writer thread
+    def __init__(self, threadCount: int = 8, framesPerTurn: int = 64):
+        self.framesPerTurn = framesPerTurn
+        self.ready = queue.Queue()  # Outboxes with frames to send
+        self.toPark = queue.Queue()  # Outboxes whose clients aren't taking data yet
+        self.selector = selectors.DefaultSelector()
+        for i in range(threadCount):
+            writerThread = threading.Thread(target=self.write, daemon=True)
+            writerThread.start()
+        pollingThread = threading.Thread(target=self.poll, daemon=True)
+        pollingThread.start()
+
+    def schedule(self, outbox: PooledOutbox) -> None:
+        self.ready.put(outbox)
+
+    def park(self, outbox: PooledOutbox) -> None:  # Puts an outbox aside until its client can take more data
+        self.toPark.put(outbox)
+
+    def write(self) -> None:
+        while True:
+            outbox = self.ready.get()  # Block until there is an outbox to empty
+            outbox.writeSome()
+
+    def poll(self) -> None:  # Watches the parked outboxes' sockets, and schedules them again once they are writable
+        while True:
+            if not self.selector.get_map():
+                self.watch(self.toPark.get())  # If nothing is being watched, block until an outbox is parked
+            while not self.toPark.empty():
+                self.watch(self.toPark.get())
+            for key, events in self.selector.select(timeout=0.01):
+                self.selector.unregister(key.fileobj)
+                self.schedule(key.data)
+
+    def watch(self, outbox: PooledOutbox) -> None:
+        try:
+            self.selector.register(outbox.client.clientSock, selectors.EVENT_WRITE, outbox)
+        except (KeyError, ValueError, OSError):  # If it can't be watched (e.g. it has been closed), let a writer
+            # deal with it
+            self.schedule(outbox)
+
+
+def isWritable(sock) -> bool:  # Checks whether a socket can take more data without blocking
+    try:
+        if hasattr(select, "poll"):
+            poller = select.poll()
+            poller.register(sock, select.POLLOUT)
+            return bool(poller.poll(0))
+        return bool(select.select([], [sock], [], 0)[1])
+    except (ValueError, OSError):  # If the socket has been closed, sending to it will say so
+        return True
+
+
+class AsyncOutbox(Outbox):  # An outbox which is emptied by a writer task on an asyncio event loop
+    def __init__(self, client, loop: asyncio.AbstractEventLoop, maxSize: int = 1000, policy: str = DROP):
+        super().__init__(client, maxSize, policy)
+        self.loop = loop
+        self.hasFrames = asyncio.Event()
+        self.writerTask = loop.create_task(self.write())
+
+    def wakeWriter(self) -> None:
+        self.loop.call_soon_threadsafe(self.hasFrames.set)
+
+    async def write(self) -> None:
+        while True:
+            await self.hasFrames.wait()
+            self.hasFrames.clear()
+            frame = self.take()
+            while frame is not None:
+                try:
+                    if frame[1] is None:  # If it was queued already sealed
+                        self.client.writer.write(frame[0])
+                        transport.countSent(self.client.writer, len(frame[0]))
+                        await self.client.writer.drain()
+                    else:
+                        data, typeOfData, encoding, requestID = frame
+                        await transport.sendDynamicDataAsync(data, typeOfData, encoding, self.client.writer,
+                                                             self.client.AESKey,
+                                                             self.client.clientSock.protocolVersion,
+                                                             requestID)  # This waits for the client to take the
+                        # data, without holding up anyone else
+                except (OSError, RuntimeError):  # If the client has gone, stop
+                    self.close()
+                    return None
+                frame = self.take()
+            if self.closed:
+                return None
+
+
+class GroupKeyring:  # Gives each group a key which its messages are sealed with, so a message is encrypted once for
+    # the whole group rather than once per member. A group's key is replaced whenever its membership changes, so
+    # someone who has left the group can't read what is said afterwards
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keyIDs = itertools.count(1)  # Every key gets a new ID, so clients can tell old and new keys apart
+        self.keys = {}  # Maps a group's ID to the ID of its current key, and the context which seals with it
+        self.sent = {}  # Maps a connection to the ID of the key it was last sent for each group
+        self.listeners = []  # Called with the ID of each group whose key is replaced here (e.g. to tell the other
+        # servers in a cluster to replace theirs too)
+
+    def addListener(self, listener) -> None:
+        self.listeners.append(listener)
+
+    def getKey(self, groupID) -> (int, encryption.CipherContext):  # Gives the ID of a group's key, and the context
+        # which seals with it (making one if the group doesn't have one). The context is kept with the key, so its
+        # nonces keep counting up rather than starting again for every message
+        groupID = str(groupID)
+        with self.lock:
+            if groupID not in self.keys:
+                self.keys[groupID] = (next(self.keyIDs), encryption.CipherContext(encryption.generateKey()))
+            return self.keys[groupID]
+
+    def forgetKey(self, groupID) -> None:  # Throws away a group's key, so that its next message is sealed with a new
+        # one (which is sent to every member first)
+        with self.lock:
+            self.keys.pop(str(groupID), None)
+
+    def rotate(self, groupID) -> None:  # Replaces a group's key, and tells the listeners
+        self.forgetKey(groupID)
+        for listener in self.listeners:
+            listener(groupID)
+
+    def hasSent(self, connection, groupID, keyID: int) -> bool:  # Whether a connection has been given a key
+        with self.lock:
+            return self.sent.get(connection, {}).get(str(groupID)) == keyID
+
+    def markSent(self, connection, groupID, keyID: int) -> None:
+        with self.lock:
+            self.sent.setdefault(connection, {})[str(groupID)] = keyID
+
+    def forget(self, connection) -> None:  # Forgets which keys a disconnected client was sent
+        with self.lock:
+            self.sent.pop(connection, None)
+
+
+def broadcast(members, data: bytes, typeOfData: str, encoding: str, groupID,
+              groupKeyring: GroupKeyring = None) -> None:  # Queues data for every member of a group. With a keyring,
+    # it is sealed once with the group's key for all the members which understand group keys, and each of those is
+    # sent the key over their own connection if they don't have it yet; everyone else has it sealed separately
+    groupFrame = None
+    for member in members:
+        if groupKeyring is None or member.clientSock.protocolVersion < transport.PROTOCOL_GROUP_KEYS:
+            member.outbox.put(data, typeOfData, encoding)
+            continue
+        if groupFrame is None:
+            keyID, groupContext = groupKeyring.getKey(groupID)
+            groupFrame = transport.sealGroupFrame(data, typeOfData, encoding, keyID, groupContext)
+        if not groupKeyring.hasSent(member, groupID, keyID):
+            if not member.outbox.putFrame(transport.makeGroupKeyFrame(keyID, groupContext.key, member.AESKey)):
+                continue  # Without the key, the member couldn't open the message either
+            groupKeyring.markSent(member, groupID, keyID)
+        member.outbox.putFrame(groupFrame)
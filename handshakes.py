@@ -0,0 +1,113 @@
+import collections
+import functools
+import threading
+import socket
+import queue
+import time
+
+
+class HandshakeStats:  # Records how many handshakes are in progress, how long they take, and how many succeed, fail
+    # or time out
+    def __init__(self, window: int = 1000):
+        self.lock = threading.Lock()
+        self.inProgress = 0
+        self.latencies = collections.deque(maxlen=window)  # The latest handshakes' latencies, for the percentiles
+        self.counts = {"succeeded": 0, "failed": 0, "timedOut": 0, "rejected": 0}
+
+    def start(self) -> None:
+        with self.lock:
+            self.inProgress += 1
+
+    def finish(self, outcome: str, latency: float = None) -> None:
+        with self.lock:
+            self.inProgress -= 1
+            self.counts[outcome] += 1
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def reject(self) -> None:  # Counts a client which was turned away before its handshake started
+        with self.lock:
+            self.counts["rejected"] += 1
+
+    def getStats(self) -> dict:
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {"inProgress": self.inProgress, **self.counts}
+        stats["latency"] = {name: latencies[int(len(latencies) * fraction)] if latencies else None
+                            for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))}
+        stats["latency"]["max"] = latencies[-1] if latencies else None
+        return stats
+
+
+class HandshakePool:  # Performs handshakes on a pool of threads, so that the accept loop never waits on a client. At
+    # most backlog sockets wait for a worker (any more are turned away), and a handshake which takes longer than the
+    # timeout has its socket shut down
+    def __init__(self, workerCount: int = 8, backlog: int = 128, timeout: float = 10):
+        self.timeout = timeout
+        self.waiting = queue.Queue(maxsize=backlog)  # Accepted sockets which haven't been picked up by a worker
+        self.stats = HandshakeStats()
+        self.deadlinesLock = threading.Lock()
+        self.deadlines = {}  # Maps the socket of each handshake in progress to when it must be finished by
+        for i in range(workerCount):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+        watchdog = threading.Thread(target=self.watch, daemon=True)
+        watchdog.start()
+
+    def submit(self, clientSock: socket.socket, handshake) -> bool:  # Queues a handshake, which is a function taking
+        # the socket and a claim function, and giving whether it succeeded. The handshake must call claim once it has
+        # finished, before the client is served: after that the watchdog leaves the socket alone, and if claim gives
+        # False the handshake took too long (and the socket has been shut down). Gives whether it was queued
+        try:
+            self.waiting.put_nowait((clientSock, handshake, time.perf_counter()))
+            return True
+        except queue.Full:  # If the server is already behind, turn the client away rather than fall further behind
+            self.stats.reject()
+            clientSock.close()
+            return False
+
+    def work(self) -> None:
+        while True:
+            clientSock, handshake, timeAccepted = self.waiting.get()
+            self.stats.start()
+            with self.deadlinesLock:
+                self.deadlines[clientSock] = time.monotonic() + self.timeout
+            claimed = []  # Whether the handshake claimed its socket before the watchdog did, once it has tried
+            claim = functools.partial(self.claim, clientSock, claimed)
+            try:
+                succeeded = handshake(clientSock, claim)
+            except Exception as e:
+                print(e)
+                succeeded = False
+            if not claimed:  # A handshake which failed before claiming its socket
+                claim()
+            if not claimed[0]:
+                self.stats.finish("timedOut")
+            else:
+                self.stats.finish("succeeded" if succeeded else "failed", time.perf_counter() - timeAccepted)
+
+    def claim(self, clientSock: socket.socket, claimed: list) -> bool:  # Takes the socket's deadline away from the
+        # watchdog, giving whether it was still there (the watchdog removes the deadlines it acts on)
+        with self.deadlinesLock:
+            onTime = self.deadlines.pop(clientSock, None) is not None
+        claimed.append(onTime)
+        return onTime
+
+    def watch(self) -> None:  # Shuts down the sockets of handshakes which have taken too long, so their workers can
+        # move on (a per-read timeout wouldn't stop a client which sends one byte at a time)
+        while True:
+            time.sleep(min(self.timeout / 10, 0.5))
+            now = time.monotonic()
+            with self.deadlinesLock:
+                expired = [clientSock for clientSock, deadline in self.deadlines.items() if deadline < now]
+                for clientSock in expired:
+                    del self.deadlines[clientSock]
+            for clientSock in expired:
+                try:
+                    clientSock.shutdown(socket.SHUT_RDWR)
+                except OSError:  # If it has already been closed
+                    pass
+
+    def getStats(self) -> dict:  # Gives how many sockets are waiting, how many handshakes are in progress, and how
+        # long they are taking
+        return {"queueDepth": self.waiting.qsize(), **self.stats.getStats()}
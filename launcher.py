@@ -0,0 +1,126 @@
+import itertools
+import threading
+import argparse
+import tempfile
+import subprocess
+import select
+import signal
+import time
+import sys
+import os
+import encryption
+import cluster
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+WORKERS = os.cpu_count() or 1  # How many server processes to run
+START_TIMEOUT = 30  # How long (in seconds) a worker has to start listening
+STOP_GRACE = 10  # How long (in seconds) a worker has to exit after its clients have been given time to leave
+
+
+class Launcher:  # Runs several server processes on one port (with SO_REUSEPORT, so the OS shares the clients out
+    # between them), joined together as a cluster so that messages reach a group's members on every worker
+    def __init__(self, workerCount: int, serverArguments: list, drainTimeout: float, brokerPath: str):
+        self.serverArguments = serverArguments
+        self.drainTimeout = drainTimeout
+        self.brokerPath = brokerPath
+        self.workers = [None] * workerCount  # The process in each slot
+        self.generations = itertools.count()  # Every worker started gets a new node ID
+        self.restartRequested = False
+        self.stopRequested = False
+        for keyFile in ("AES.key", "ticket.key"):  # Made before the workers start, so they share them (rather than
+            # racing to make their own)
+            encryption.readOrMakeAESKey(keyFile)
+        broker = cluster.UnixSocketBroker(brokerPath)
+        brokerThread = threading.Thread(target=broker.serveForever, daemon=True)
+        brokerThread.start()
+
+    def startWorker(self, slot: int) -> None:  # Starts a worker in a slot, waiting until it is listening
+        readFD, writeFD = os.pipe()
+        process = subprocess.Popen([sys.executable, SERVER_SCRIPT, *self.serverArguments, "--reuse-port",
+                                    "--cluster-socket", self.brokerPath,
+                                    "--node-id", f"worker{slot}-{next(self.generations)}",
+                                    "--messages-dir", f"messages-{slot}",  # Each slot keeps its own log, which its
+                                    # next worker carries on with
+                                    "--drain-timeout", str(self.drainTimeout), "--ready-fd", str(writeFD)],
+                                   pass_fds=(writeFD, ), start_new_session=True)  # In its own process group, so
+        # that its hashing processes can be killed along with it
+        os.close(writeFD)
+        ready = bool(select.select([readFD], [], [], START_TIMEOUT)[0]) and os.read(readFD, 1) == b"1"  # If the
+        # worker dies first, the pipe is closed without anything being written
+        os.close(readFD)
+        if not ready:
+            self.kill(process)
+            raise RuntimeError(f"Worker {slot} didn't start")
+        self.workers[slot] = process
+
+    def stopWorker(self, slot: int) -> None:  # Stops a worker gracefully: it stops accepting clients, gives the
+        # ones it has time to leave, and saves their messages
+        process = self.workers[slot]
+        self.workers[slot] = None
+        if process is None:
+            return None
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(self.drainTimeout + STOP_GRACE)
+        except subprocess.TimeoutExpired:
+            self.kill(process)
+
+    def kill(self, process: subprocess.Popen) -> None:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:  # If it has already gone
+            pass
+        process.wait()
+
+    def rollingRestart(self) -> None:  # Replaces the workers one at a time, so the rest keep serving clients
+        # throughout. Each worker is stopped before its replacement starts, so only one process ever writes a slot's
+        # log; messages said while a slot is empty are not in that slot's history
+        for slot in range(len(self.workers)):
+            self.stopWorker(slot)
+            self.startWorker(slot)
+            print(f"Restarted worker {slot}")
+
+    def run(self) -> None:  # Starts the workers, then looks after them until told to stop. SIGHUP restarts them
+        signal.signal(signal.SIGHUP, self.requestRestart)
+        signal.signal(signal.SIGTERM, self.requestStop)
+        signal.signal(signal.SIGINT, self.requestStop)
+        for slot in range(len(self.workers)):
+            self.startWorker(slot)
+        print(f"Started {len(self.workers)} workers")
+        while not self.stopRequested:
+            time.sleep(0.5)
+            if self.restartRequested:
+                self.restartRequested = False
+                self.rollingRestart()
+            for slot, process in enumerate(self.workers):
+                if process is not None and process.poll() is not None:  # If a worker has died, replace it
+                    print(f"Worker {slot} exited with {process.returncode}")
+                    self.kill(process)
+                    self.startWorker(slot)
+        for process in self.workers:  # All the workers are told to stop first, so they drain at the same time
+            if process is not None and process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        for slot in range(len(self.workers)):
+            self.stopWorker(slot)
+
+    def requestRestart(self, signalNumber, frame) -> None:
+        self.restartRequested = True
+
+    def requestStop(self, signalNumber, frame) -> None:
+        self.stopRequested = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs several chatroom servers on one port, as a cluster. Any "
+                                                 "other arguments are passed on to server.py")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="how many server processes to run")
+    parser.add_argument("--drain-timeout", type=float, default=30,
+                        help="when restarting or stopping, how long a worker's clients are given to leave")
+    parser.add_argument("--broker-socket", help="where to make the cluster broker's UNIX socket (a temporary "
+                                                "directory by default)")
+    arguments, serverArguments = parser.parse_known_args()
+    brokerPath = arguments.broker_socket
+    if brokerPath is None:
+        brokerPath = os.path.join(tempfile.mkdtemp(prefix="chatroom-"), "broker.sock")
+    Launcher(arguments.workers, serverArguments, arguments.drain_timeout, brokerPath).run()
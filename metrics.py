@@ -0,0 +1,210 @@
+import http.server
+import threading
+import bisect
+import json
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = tuple(4 ** i for i in range(2, 13))  # From 16 bytes to 16 MiB
+
+
+def escapeLabel(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def formatLabels(labelNames: tuple, labelValues: tuple, extra: str = "") -> str:  # Lays out labels as Prometheus
+    # expects them, e.g. {event="Message"}
+    labels = [f'{name}="{escapeLabel(str(value))}"' for name, value in zip(labelNames, labelValues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:  # A value (or, with labels, one value for each set of label values) which can be exported
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labelNames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = {}  # Maps a tuple of label values to the value for those labels
+
+    def getValues(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+    def toPrometheus(self) -> list:  # Gives the lines describing the metric in Prometheus' text format
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for labelValues, value in sorted(self.getValues().items()):
+            lines.append(f"{self.name}{formatLabels(self.labelNames, labelValues)} {value}")
+        return lines
+
+    def toJSON(self):  # Gives the value, or a dictionary from each set of labels (joined with commas) to its value
+        values = self.getValues()
+        if not self.labelNames:
+            return values.get((), 0)
+        return {",".join(str(value) for value in labelValues): value for labelValues, value in values.items()}
+
+
+class Counter(Metric):  # A count which only goes up
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labelValues) -> None:
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+
+class Gauge(Metric):  # A value which can go up and down. It is either set, or read from a function when exported
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, labelNames: tuple = ()):
+        super().__init__(name, description, labelNames)
+        self.function = None
+
+    def set(self, value: float, *labelValues) -> None:
+        with self.lock:
+            self.values[labelValues] = value
+
+    def setFunction(self, function) -> None:  # Reads the value from function whenever it is exported
+        self.function = function
+
+    def getValues(self) -> dict:
+        if self.function is not None:
+            return {(): self.function()}
+        return super().getValues()
+
+
+class Histogram(Metric):  # Counts how many observations fall into each bucket, along with their total
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labelNames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, description, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelValues) -> None:
+        index = bisect.bisect_left(self.buckets, value)  # The first bucket the value fits into
+        with self.lock:
+            counts = self.values.get(labelValues)
+            if counts is None:
+                counts = self.values[labelValues] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # Each bucket's count
+                # (the last being for values bigger than every bucket), the total, and the number of observations
+            counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def getValues(self) -> dict:
+        with self.lock:
+            return {labelValues: (list(counts[0]), counts[1], counts[2]) for labelValues, counts in self.values.items()}
+
+    def toPrometheus(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for labelValues, (bucketCounts, total, count) in sorted(self.getValues().items()):
+            cumulative = 0
+            for bound, bucketCount in zip(self.buckets + ("+Inf", ), bucketCounts):
+                cumulative += bucketCount
+                labels = formatLabels(self.labelNames, labelValues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = formatLabels(self.labelNames, labelValues)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+    def toJSON(self):
+        results = {}
+        for labelValues, (bucketCounts, total, count) in self.getValues().items():
+            results[",".join(str(value) for value in labelValues)] = {
+                "count": count, "mean": total / count if count else None,
+                **{name: self.estimateQuantile(bucketCounts, count, fraction)
+                   for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99))}}
+        return results if self.labelNames else results.get("", {"count": 0})
+
+    def estimateQuantile(self, bucketCounts: list, count: int, fraction: float) -> float:  # Gives the upper bound of
+        # the bucket which the quantile falls into (or None if it is bigger than every bucket)
+        cumulative = 0
+        for bound, bucketCount in zip(self.buckets + (None, ), bucketCounts):
+            cumulative += bucketCount
+            if cumulative >= count * fraction:
+                return bound
+        return None
+
+
+class Registry:  # Holds every metric, and anything else (like per-connection details) to be shown in the JSON
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.collectors = {}  # Maps a name to a function giving extra details for the JSON (Prometheus doesn't
+        # show these)
+
+    def add(self, metric: Metric) -> Metric:  # Registers a metric, or gives the one already registered by that name
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, description: str, labelNames: tuple = ()) -> Counter:
+        return self.add(Counter(name, description, labelNames))
+
+    def gauge(self, name: str, description: str, labelNames: tuple = ()) -> Gauge:
+        return self.add(Gauge(name, description, labelNames))
+
+    def histogram(self, name: str, description: str, labelNames: tuple = (),
+                  buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self.add(Histogram(name, description, labelNames, buckets))
+
+    def addCollector(self, name: str, function) -> None:
+        with self.lock:
+            self.collectors[name] = function
+
+    def toPrometheus(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.toPrometheus())
+        return "\n".join(lines) + "\n"
+
+    def toJSON(self) -> dict:
+        with self.lock:
+            metrics = list(self.metrics.values())
+            collectors = dict(self.collectors)
+        results = {metric.name: metric.toJSON() for metric in metrics}
+        for name, function in collectors.items():
+            try:
+                results[name] = function()
+            except Exception as e:  # A broken collector shouldn't hide every other metric
+                results[name] = {"error": str(e)}
+        return results
+
+
+registry = Registry()  # The registry which the server's own metrics are kept in
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):  # Serves /metrics in Prometheus' text format, and
+    # /metrics.json as JSON
+    registry = registry
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            body = self.registry.toPrometheus().encode("utf-8")
+            contentType = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path == "/metrics.json":
+            body = json.dumps(self.registry.toJSON()).encode("utf-8")
+            contentType = "application/json"
+        else:
+            self.send_error(404)
+            return None
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # Scrapes shouldn't fill the server's output
+        pass
+
+
+def serve(port: int, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:  # Serves the metrics on their own
+    # thread. Only on localhost by default, as they say who is connected
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    serverThread = threading.Thread(target=server.serve_forever, daemon=True)
+    serverThread.start()
+    return server
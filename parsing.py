@@ -3,6 +3,9 @@ import encryption
 import json
 import sys
 import transport
+import codec
+
+MAX_PAGE_SIZE = 500  # The most messages the server gives in one page (storage.MAX_PAGE_SIZE)
 
 
 def parse(text: str):  # Parses some text as a command
@@ -43,6 +46,8 @@ def parse(text: str):  # Parses some text as a command
         return LeaveGroup(tokens[1])
     elif tokens[0] == "getGroups":
         return ListGroups()
+    elif tokens[0] == "history":
+        return History(tokens[1:])
     else:  # If the command name doesn't exist,
         return Error(tokens[0])  # Display an error message
 
@@ -69,6 +74,14 @@ class Command:  # Superclass for any command
     def handle(self, client):  # Gets the client object, and does something with it
         pass
 
+    def sendRequest(self, client, request: dict, typeOfData: str) -> None:  # Sends a request to the server, packed if
+        # the connection has agreed to use the binary codec, otherwise as JSON
+        toBeSent, encoding = codec.encode(request, transport.usesBinary(client.servSocket))
+        transport.sendDynamicData(toBeSent, typeOfData, encoding, client.servSocket, client.AESKey)
+
+    def packToken(self, client):  # The client's session token, as it is put in a request
+        return codec.encodeToken(client.sessionToken, transport.usesBinary(client.servSocket))
+
 
 class Connect(Command):
     def __init__(self, IP, port):
@@ -82,13 +95,13 @@ class Connect(Command):
 
     def handle(self, client):
         client.servSocket.connect((self.IP, self.port))
-        client.handshake(self.publicKey)
+        client.handshake(self.publicKey, (self.IP, self.port))
 
 
 class Disconnect(Command):
     def handle(self, client):
         client.servSocket.shutdown(0)  # Disconnect from the server
-        client.servSocket = socket.socket()  # Create a new socket
+        client.servSocket = transport.Connection(socket.socket())  # Create a new socket
         client.readyToReceive = False  # Tell the client that the connection has been removed
         client.AESKey = None  # Delete the AES key used for connection with the now disconnected server
 
@@ -110,9 +123,8 @@ class Say(Command):
         self.message = " ".join(words)
 
     def handle(self, client):
-        messageAndToken = {"message": self.message, "sessionToken": json.dumps(client.sessionToken)}
-        toBeSent = json.dumps(messageAndToken)
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "message", "utf-8", client.servSocket, client.AESKey)
+        messageAndToken = {"message": self.message, "sessionToken": self.packToken(client)}
+        self.sendRequest(client, messageAndToken, "message")
 
 
 class MakeAccount(Command):
@@ -122,10 +134,8 @@ class MakeAccount(Command):
 
     def handle(self, client):
         userPasswordComb = {"username": self.username, "password": self.password}
-        toBeSent = json.dumps(userPasswordComb)
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "makeAccount", "utf-8", client.servSocket,
-                                  client.AESKey)  # Sends the user/password combination to the server and tells it
-        # that the intent is to create a new account
+        self.sendRequest(client, userPasswordComb, "makeAccount")  # Sends the user/password combination to the
+        # server and tells it that the intent is to create a new account
 
 
 class Login(Command):
@@ -135,16 +145,13 @@ class Login(Command):
 
     def handle(self, client):
         userPasswordComb = {"username": self.username, "password": self.password}
-        toBeSent = json.dumps(userPasswordComb)
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "login", "utf-8", client.servSocket,
-                                  client.AESKey)  # Same as with MakeAccount, but sets the intent to login
+        self.sendRequest(client, userPasswordComb, "login")  # Same as with MakeAccount, but sets the intent to login
 
 
 class Logout(Command):
     def handle(self, client):
-        clientData = {"sessionToken": json.dumps(client.sessionToken)}  # Tell the server which client wants to log-out
-        toBeSent = json.dumps(clientData)
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "logout", "utf-8", client.servSocket, client.AESKey)
+        clientData = {"sessionToken": self.packToken(client)}  # Tell the server which client wants to log-out
+        self.sendRequest(client, clientData, "logout")
         client.resetToken()
 
 
@@ -154,9 +161,7 @@ class MakeGroup(Command):
 
     def handle(self, client):
         groupData = {"groupName": self.name}  # Packages the necessary information into one object
-        toBeSent = json.dumps(groupData)  # Stringifies said object
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "makeGroup", "utf-8", client.servSocket, client.AESKey)
-        # And sends it to the server
+        self.sendRequest(client, groupData, "makeGroup")  # And sends it to the server
 
 
 class SwitchGroup(Command):
@@ -165,15 +170,58 @@ class SwitchGroup(Command):
 
     def handle(self, client):
         groupData = {"groupToSwitchTo": self.groupID}
-        toBeSent = json.dumps(groupData)
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "switchGroup", "utf-8", client.servSocket, client.AESKey)
+        self.sendRequest(client, groupData, "switchGroup")
 
 
 class ListGroups(Command):
     def handle(self, client):
-        relevantData = {"token": json.dumps(client.sessionToken)}
-        toBeSent = json.dumps(relevantData)
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "getGroups", "utf-8", client.servSocket, client.AESKey)
+        relevantData = {"token": self.packToken(client)}
+        self.sendRequest(client, relevantData, "getGroups")
+
+
+class History(Command):  # A command to load earlier messages from the current group. It may take several pages,
+    # each asked for once the last has arrived (see client.Client.getServerMessages)
+    def __init__(self, words):
+        self.limit = int(words[0]) if words else 20
+        self.wanted = self.limit  # How many earlier messages are still to be shown
+        self.shown = 0
+        self.toSkip = 0  # How many of the group's latest messages (already on screen) are still to be skipped
+
+    def handle(self, client):
+        if client.oldestMessageID is None:  # If no messages have been loaded yet, the latest ones are given instead,
+            # so the ones already on screen are skipped. They are counted once the first page arrives
+            self.toSkip = None
+        client.loadingHistory = self
+        self.requestPage(client)
+
+    def requestPage(self, client) -> None:  # Asks for the next page, with enough messages to cover the ones still to
+        # be skipped, up to the most the server gives at once
+        toSkip = client.shownMessages if self.toSkip is None else self.toSkip
+        relevantData = {"token": self.packToken(client), "limit": min(self.wanted + toSkip, MAX_PAGE_SIZE),
+                        "before": client.oldestMessageID}
+        self.sendRequest(client, relevantData, "getMessages")
+
+    def showPage(self, client, page: dict) -> None:  # Called by the client with each page which arrives
+        messages = page["messages"]
+        if self.toSkip is None:  # The first page ends with the messages already on screen (every message said
+            # before the page was made has arrived by now, as they are sent in order)
+            self.toSkip = client.shownMessages
+        skipped = min(self.toSkip, len(messages))
+        self.toSkip -= skipped
+        if messages:
+            client.oldestMessageID = messages[0]["id"]  # Later pages carry on from here, so anything said since
+            # doesn't need skipping
+        messages = messages[:len(messages) - skipped]
+        self.wanted -= len(messages)
+        self.shown += len(messages)
+        if messages:
+            client.toGUI.put("\nEarlier messages:\n" + "\n".join(message["message"] for message in messages))
+        if page["hasMore"] and self.wanted > 0:  # If the page was cut short (or was all skipped), ask for the rest
+            self.requestPage(client)
+            return None
+        client.loadingHistory = None
+        if self.shown == 0:
+            client.toGUI.put("\nThere are no earlier messages")
 
 
 class LeaveGroup(Command):
@@ -181,10 +229,9 @@ class LeaveGroup(Command):
         self.groupID = groupID
 
     def handle(self, client):
-        relevantData = {"token": json.dumps(client.sessionToken),
+        relevantData = {"token": self.packToken(client),
                         "group": self.groupID}
-        toBeSent = json.dumps(relevantData)
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "leaveGroup", "utf-8", client.servSocket, client.AESKey)
+        self.sendRequest(client, relevantData, "leaveGroup")
 
 
 class AddUser(Command):  # A command to add a user to a group
@@ -194,8 +241,7 @@ class AddUser(Command):  # A command to add a user to a group
 
     def handle(self, client):
         groupData = {"groupID": self.groupID, "userID": self.userID}  # Packages the group's and user's ID together
-        toBeSent = json.dumps(groupData)
-        transport.sendDynamicData(toBeSent.encode("utf-8"), "addUserToGroup", "utf-8", client.servSocket, client.AESKey)
+        self.sendRequest(client, groupData, "addUserToGroup")
 
 
 class Config(Command):
@@ -0,0 +1,94 @@
+import threading
+
+
+class PresenceRegistry:  # Keeps track of who is connected, who they are logged in as, and which group's messages
+    # they are sent. Every change is made under one lock, so a connection is never half-way between groups, and two
+    # connections can't both log in as the same user
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = set()  # Every connection which has finished its handshake
+        self.users = {}  # Maps a user's ID to the connection they are logged in on
+        self.userOf = {}  # Maps a connection to the ID of the user it is logged in as
+        self.groups = {}  # Maps a group's ID to the set of connections which are sent its messages
+        self.groupOf = {}  # Maps a connection to the ID of the group it is sent messages from
+
+    def connect(self, connection) -> None:
+        with self.lock:
+            self.connections.add(connection)
+
+    def disconnect(self, connection) -> None:  # Forgets everything about a connection
+        with self.lock:
+            self.connections.discard(connection)
+            self.removeUser(connection)
+            self.removeFromGroup(connection)
+
+    def login(self, connection, userID) -> bool:  # Logs a connection in as a user, giving whether it could be (a user
+        # can only be logged in on one connection at a time)
+        userID = str(userID)  # IDs arrive as both strings and integers
+        with self.lock:
+            if self.isLoggedIn(userID):
+                return False
+            self.removeUser(connection)
+            self.users[userID] = connection
+            self.userOf[connection] = userID
+            return True
+
+    def logout(self, connection) -> None:
+        with self.lock:
+            self.removeUser(connection)
+
+    def joinGroup(self, connection, groupID) -> None:  # Sends a connection the messages from a group (instead of the
+        # group it was in before)
+        groupID = str(groupID)
+        with self.lock:
+            self.removeFromGroup(connection)
+            self.groups.setdefault(groupID, set()).add(connection)
+            self.groupOf[connection] = groupID
+
+    def leaveGroup(self, connection) -> None:  # Stops sending a connection any group's messages
+        with self.lock:
+            self.removeFromGroup(connection)
+
+    def isLoggedIn(self, userID: str) -> bool:  # Must be called with the lock held
+        return userID in self.users
+
+    def removeUser(self, connection) -> None:  # Must be called with the lock held
+        userID = self.userOf.pop(connection, None)
+        if userID is not None:
+            del self.users[userID]
+
+    def removeFromGroup(self, connection) -> None:  # Must be called with the lock held
+        groupID = self.groupOf.pop(connection, None)
+        if groupID is not None:
+            members = self.groups[groupID]
+            members.discard(connection)
+            if not members:  # Empty groups are forgotten, so they don't build up
+                del self.groups[groupID]
+
+    def getGroupMembers(self, groupID) -> tuple:  # Gives the connections which are sent a group's messages (as a
+        # copy, so it can be looped over while connections come and go)
+        with self.lock:
+            return tuple(self.groups.get(str(groupID), ()))
+
+    def getGroup(self, connection):  # Gives the ID of the group a connection is sent messages from, or None
+        with self.lock:
+            return self.groupOf.get(connection)
+
+    def getConnection(self, userID):  # Gives the connection a user is logged in on, or None if they aren't online
+        with self.lock:
+            return self.users.get(str(userID))
+
+    def isOnline(self, userID) -> bool:
+        return self.getConnection(userID) is not None
+
+    def getConnections(self) -> tuple:  # Gives every connection (as a copy)
+        with self.lock:
+            return tuple(self.connections)
+
+    def onlineCount(self) -> int:  # How many users are logged in
+        with self.lock:
+            return len(self.users)
+
+    def connectionCount(self) -> int:  # How many connections there are, including ones which aren't logged in
+        with self.lock:
+            return len(self.connections)
@@ -0,0 +1,107 @@
+import collections
+import itertools
+import threading
+import time
+import sys
+import os
+import re
+
+SAMPLE_INTERVAL = 0.005  # How often (in seconds) every thread's stack is sampled
+MAX_SECONDS = 300  # The longest a profile can run for
+PROFILE_DIRECTORY = "profiles"  # Where the collapsed stacks are written
+
+
+def describeFrame(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def findEventType(frame) -> str:  # Gives the type of event being handled in a stack (the innermost, if an event
+    # handles another), or None
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name == "handle" and code.co_filename.endswith("events.py") and "." in code.co_qualname:
+            return code.co_qualname.split(".")[0]
+        frame = frame.f_back
+    return None
+
+
+class SamplingProfiler:  # Samples the stack of every thread every so often, rather than tracing every call, so it
+    # can be turned on in a running server without slowing it down much. Only one profile runs at a time
+    def __init__(self, directory: str = PROFILE_DIRECTORY, interval: float = SAMPLE_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = False
+        self.stopRequested = threading.Event()
+
+    def start(self, seconds: float, onFinish) -> bool:  # Profiles for up to seconds on its own thread, then calls
+        # onFinish with the report. Gives whether it started (it doesn't if a profile is already running)
+        with self.lock:
+            if self.running:
+                return False
+            self.running = True
+            self.stopRequested.clear()
+        sampler = threading.Thread(target=self.run, args=(min(seconds, MAX_SECONDS), onFinish), daemon=True,
+                                   name="profiler")
+        sampler.start()
+        return True
+
+    def stop(self) -> None:  # Finishes the running profile early
+        self.stopRequested.set()
+
+    def run(self, seconds: float, onFinish) -> None:
+        stacks = collections.Counter()  # Maps each collapsed stack to how many times it was seen
+        eventSamples = collections.Counter()  # Maps each type of event to how many samples were handling it
+        samples = 0
+        ownIdent = threading.get_ident()
+        start = time.perf_counter()
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline and not self.stopRequested.wait(self.interval):
+                threadNames = {thread.ident: re.sub(r"-\d+", "", thread.name) for thread in threading.enumerate()}
+                samples += 1
+                for ident, frame in sys._current_frames().items():
+                    if ident == ownIdent:
+                        continue
+                    eventType = findEventType(frame)
+                    if eventType is not None:
+                        eventSamples[eventType] += 1
+                    names = []
+                    while frame is not None:
+                        names.append(describeFrame(frame))
+                        frame = frame.f_back
+                    names.append(threadNames.get(ident, "unknown thread"))
+                    stacks[";".join(reversed(names))] += 1
+            report = self.write(stacks, eventSamples, samples, time.perf_counter() - start)
+        except Exception as e:  # Whoever asked for the profile should still hear back
+            report = {"error": str(e)}
+        with self.lock:
+            self.running = False
+        onFinish(report)
+
+    def write(self, stacks: collections.Counter, eventSamples: collections.Counter, samples: int,
+              elapsed: float) -> dict:  # Writes the stacks in the collapsed format flame graph tools read, giving
+        # the report
+        os.makedirs(self.directory, exist_ok=True)
+        with self.openReportFile() as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+            filename = file.name
+        return {"file": os.path.abspath(filename), "seconds": elapsed, "samples": samples,
+                "topEvents": [{"event": eventType, "samples": count,
+                               "seconds": count * elapsed / samples if samples else 0}  # Roughly how long was
+                              # spent handling that type of event, summed over the workers
+                              for eventType, count in eventSamples.most_common(10)]}
+
+    def openReportFile(self):  # Makes a new file for the stacks, named after when the profile finished (to the
+        # millisecond). If another profile (e.g. from another worker sharing the directory) already has that name, a
+        # number is added, rather than either profile being overwritten
+        now = time.time()
+        name = time.strftime("profile-%Y%m%d-%H%M%S", time.localtime(now)) + f"-{int(now * 1000) % 1000:03d}"
+        for attempt in itertools.count():
+            suffix = f"-{attempt}" if attempt else ""
+            try:
+                return open(os.path.join(self.directory, f"{name}{suffix}.folded"), "x")
+            except FileExistsError:
+                continue
@@ -5,134 +5,454 @@ import encryption
 import Crypto.PublicKey.RSA
 import Crypto.Random
 import threading
-import queue
+import concurrent.futures
+import handshakes
+import time
+import asyncio
+import argon2
+import argparse
+import dispatcher
+import fanout
+import presence
+import cluster
 import storage
-import json
+import metrics
+import profiler
+import importlib
+import signal
+import os
 
 PORT = 8888
-eventQueue = queue.Queue()
-clients = []
-groupClients = {"1": []}
-storageMethod = storage.SQLDatabase()
+USE_ASYNCIO = False  # Whether to serve clients from one asyncio event loop instead of one thread per client
+EVENT_WORKERS = 4  # How many threads handle events
+STATS_INTERVAL = 0  # How often (in seconds) to print the event dispatcher's stats, or 0 to not print them
+OUTBOX_SIZE = 1000  # How many frames can be waiting to be sent to one client
+SLOW_CLIENT_POLICY = fanout.DROP  # What to do when a client's outbox is full (see fanout.POLICIES)
+WRITER_THREADS = 8  # How many threads send messages to clients (when not using asyncio)
+HASHING_PROCESSES = None  # How many processes hash passwords (None means one per CPU core)
+ARGON_TIME_COST = argon2.DEFAULT_TIME_COST  # The Argon2 parameters used to hash new passwords
+ARGON_MEMORY_COST = argon2.DEFAULT_MEMORY_COST
+ARGON_PARALLELISM = argon2.DEFAULT_PARALLELISM
+HANDSHAKE_WORKERS = 8  # How many handshakes can be done at once
+HANDSHAKE_BACKLOG = 128  # How many accepted clients can be waiting for their handshake before more are turned away
+HANDSHAKE_TIMEOUT = 10  # How long (in seconds) a client has to finish its handshake
+USE_BINARY = True  # Whether clients which can are sent (and send) structured payloads packed with codec rather than
+# as JSON
+USE_GROUP_KEYS = False  # Whether group messages are sealed once with a group key, rather than once per client
+DATABASE_PATH = "database.db"  # Servers in a cluster share accounts and groups by using the same database
+CLUSTER_SOCKET = None  # The UNIX socket of the broker connecting the servers in a cluster, or None to run alone
+DRAIN_TIMEOUT = 30  # When stopping, how long (in seconds) clients are given to leave before they are disconnected
+METRICS_PORT = 0  # The port on localhost to serve metrics on, or 0 to not serve them
+ADMIN_USERS = set()  # The IDs (as strings) of the users who may profile the server
+eventQueue = dispatcher.EventDispatcher(EVENT_WORKERS)
+presenceRegistry = presence.PresenceRegistry()  # Who is connected, and which group each client is sent messages from
+writerPool = None
+hashingPool = None
+ticketIssuer = None
+handshakeStats = None  # The handshake pool (or, with asyncio, just its stats)
+groupKeyring = None  # The groups' keys, if they are being used
+clusterNode = None  # Shares messages, logins and group changes with the rest of the cluster, if there is one
+samplingProfiler = profiler.SamplingProfiler()  # Started (by an admin) while the server is running
+services = events.Services(presenceRegistry, eventQueue, profiler=samplingProfiler)  # What events made from
+# clients' requests are given; remade once the server's set up
+connectionBytes = metrics.registry.histogram("chatroom_connection_bytes", "Bytes sent to and received from each "
+                                             "client, counted when it leaves", ("direction", ), metrics.SIZE_BUCKETS)
 
 
 class Client:
-    def __init__(self, clientSock: socket.socket, privKey: Crypto.PublicKey.RSA.RsaKey, messageStorage: storage.MessageStorage, groupClients: dict, storageMethod: storage.StorageMethod):
-        global clients
-        self.clientSock = clientSock
+    def __init__(self, clientSock: socket.socket, messageStorage: storage.MessageStorage, presenceRegistry: presence.PresenceRegistry, storageMethod: storage.StorageMethod):
+        self.clientSock = transport.Connection(clientSock)
         self.sessionToken = {"id": "0", "randomBytes": "0", "groupID": "1"}
         self.username = 'Guest'
         self.storageMethod = storageMethod
         self.messageStorage = messageStorage
+        self.presenceRegistry = presenceRegistry
         self.isAPI = False
+
+    def start(self, privKey: Crypto.PublicKey.RSA.RsaKey, claim) -> bool:  # Performs the handshake, then serves the
+        # client on its own thread. Gives whether the handshake succeeded. claim is the handshake pool's (see
+        # handshakes.HandshakePool.submit)
         try:
             self.handshake(privKey)
-        except (ValueError, TimeoutError):  # If the AES decryption fails, or if the socket times-out
-            try:
-                clients.remove(self)  # Remove the client from the list
-            except ValueError:
-                pass
-            return None  # And stop the constructor
-        mainThread = threading.Thread(target=self.main, args=(groupClients, ))
+        except (ValueError, TimeoutError, OSError):  # If the decryption fails, or if the socket times-out or closes
+            self.clientSock.close()
+            return False
+        if not claim():  # If the watchdog has already shut the socket down, the client mustn't be served
+            self.clientSock.close()
+            return False
+        mainThread = threading.Thread(target=self.main, args=(self.presenceRegistry, ))
         mainThread.start()
+        return True
 
     def handshake(self, privKey: Crypto.PublicKey.RSA.RsaKey) -> None:  # Performs a handshake with a client
-        encryptedKey = transport.receiveData(256, self.clientSock)
-        AESKey = encryption.decryptDataRSA(privKey, encryptedKey)  # Gets and decrypts the AES key with RSA
+        encryptedKey = transport.receiveData(transport.HANDSHAKE_SIZE, self.clientSock)
+        AESKey = None
+        if transport.isResumeRequest(encryptedKey):  # If the client has a session ticket, try to skip RSA
+            AESKey = transport.acceptResumption(encryptedKey, self.clientSock, ticketIssuer)
+            if AESKey is None:  # If the ticket isn't valid, the client sends a key with RSA instead
+                encryptedKey = transport.receiveData(transport.HANDSHAKE_SIZE, self.clientSock)
+        if AESKey is None:
+            AESKey = encryption.decryptDataRSA(privKey, encryptedKey)  # Gets and decrypts the AES key with RSA
         self.AESKey = AESKey
-        isAPI = transport.receiveEncryptedData(1, self.clientSock, self.AESKey)
-        if isAPI == b"\x01":
-            self.isAPI = True
+        flags = transport.receiveEncryptedData(1, self.clientSock, self.AESKey)
+        self.isAPI, clientVersion = transport.readHandshakeFlags(flags)
+        self.agreeProtocol(clientVersion)
+
+    def agreeProtocol(self, clientVersion: int) -> None:  # Finishes a handshake, telling the client which version of
+        # the protocol to use
+        if clientVersion > transport.PROTOCOL_LEGACY:  # Older clients don't expect to be told which protocol to use
+            protocolVersion = transport.chooseProtocol(clientVersion, transport.PROTOCOL_VERSION if USE_BINARY
+                                                       else transport.PROTOCOL_BINARY - 1)
+            transport.sendEncryptedData(bytes([protocolVersion]), self.clientSock, self.AESKey)
+            self.clientSock.protocolVersion = protocolVersion
+            if protocolVersion >= transport.PROTOCOL_TICKETS:  # Give the client a ticket for its next connection
+                transport.sendSessionTicket(self.clientSock, self.AESKey, ticketIssuer)
 
     def resetToken(self):  # If some authentication goes wrong, this is used to log clients out
         self.sessionToken = {"id": "0", "randomBytes": "0", "groupID": "1"}
         self.username = "Guest"
+        presenceRegistry.logout(self)
+        if presenceRegistry.getGroup(self) is not None:  # If the client is sent a group's messages, send it the
+            # default group's instead, to match their token
+            presenceRegistry.joinGroup(self, "1")
 
     def showMessage(self, message):  # Displays a debug message
         if self.isAPI:  # If the client is an API,
             return None  # Do not send the debug message
         else:
-            transport.sendDynamicData(message.encode("utf-8"), "didSucceedMessage", "utf-8",
-                                      self.clientSock, self.AESKey)
+            self.outbox.put(message.encode("utf-8"), "didSucceedMessage", "utf-8")  # Queued like any other reply,
+            # so the event worker doesn't wait on the client
 
-    def main(self, groupClients) -> None:
-        global eventQueue
-        global clients
+    def joinServer(self, presenceRegistry) -> None:  # Adds a newly connected client to the default group
+        presenceRegistry.connect(self)
         if not self.isAPI:  # If the client is an API, they should not receive messages
-            groupClients["1"].append(self)
+            presenceRegistry.joinGroup(self, "1")
             eventQueue.put(events.RetrieveMessages([self, self.messageStorage]))
-        while True:
-            try:
-                dataType, encoding, data = transport.receiveDynamicData(self.clientSock,
-                                                                        self.AESKey)  # Get data from the client
-            except (ValueError, TimeoutError, ConnectionResetError):  # If the client has disconnected,
+
+    def getTraffic(self) -> (int, int):  # Gives how many bytes have been sent to and received from the client
+        return getattr(self.clientSock, "bytesSent", 0), getattr(self.clientSock.reader, "bytesReceived", 0)
+
+    def leaveServer(self, presenceRegistry) -> None:  # Removes a disconnected client from the server
+        bytesSent, bytesReceived = self.getTraffic()
+        connectionBytes.observe(bytesSent, "sent")
+        connectionBytes.observe(bytesReceived, "received")
+        presenceRegistry.disconnect(self)
+        if groupKeyring is not None:
+            groupKeyring.forget(self)
+        self.outbox.close()
+        self.clientSock.close()
+
+    def main(self, presenceRegistry) -> None:
+        self.outbox = fanout.PooledOutbox(self, writerPool, OUTBOX_SIZE, SLOW_CLIENT_POLICY)  # Messages to this
+        # client are sent by the writer pool
+        self.joinServer(presenceRegistry)
+        try:
+            while True:
+                try:
+                    dataType, encoding, data, requestID = transport.receiveRequest(self.clientSock,
+                                                                                   self.AESKey)  # Get data from the
+                    # client
+                except (ValueError, TimeoutError, ConnectionResetError):  # If the client has disconnected,
+                    return None
+                event = self.makeEvent(dataType, encoding, data, requestID)
+                if event is not None:
+                    eventQueue.put(event)
+        finally:  # However the loop ends, the client is removed from the server
+            self.leaveServer(presenceRegistry)
+
+    def makeEvent(self, dataType: str, encoding: str, data: bytes,
+                  requestID: int = None) -> events.Event:  # Turns data received from the client into the event which
+        # handles it (which replies with the request's ID, if it has one), or None if it is ignored. Each type of
+        # data is handled by the event declaring it as its wireType (see events.messageTypes)
+        return events.dispatch(dataType, encoding, data, self, services, requestID)
+
+
+class AsyncClient(Client):  # A client which is served by the asyncio event loop rather than its own thread
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 messageStorage: storage.MessageStorage, storageMethod: storage.StorageMethod):
+        self.reader = reader
+        self.writer = writer
+        self.clientSock = transport.AsyncSocket(writer, asyncio.get_running_loop())  # Lets the event thread send
+        # to this client
+        self.sessionToken = {"id": "0", "randomBytes": "0", "groupID": "1"}
+        self.username = 'Guest'
+        self.storageMethod = storageMethod
+        self.messageStorage = messageStorage
+        self.isAPI = False
+
+    async def handshake(self, privKey: Crypto.PublicKey.RSA.RsaKey,
+                        executor: concurrent.futures.Executor = None) -> None:  # Performs a handshake with a client
+        encryptedKey = await transport.receiveDataAsync(transport.HANDSHAKE_SIZE, self.reader)
+        AESKey = None
+        if transport.isResumeRequest(encryptedKey):  # If the client has a session ticket, try to skip RSA
+            AESKey = transport.acceptResumption(encryptedKey, self.clientSock, ticketIssuer)
+            if AESKey is None:  # If the ticket isn't valid, the client sends a key with RSA instead
+                encryptedKey = await transport.receiveDataAsync(transport.HANDSHAKE_SIZE, self.reader)
+        if AESKey is None:
+            loop = asyncio.get_running_loop()
+            AESKey = await loop.run_in_executor(executor, encryption.decryptDataRSA, privKey,
+                                                encryptedKey)  # The RSA decryption is done off the event loop, so
+            # other handshakes can carry on in the meantime
+        self.AESKey = AESKey
+        flags = await transport.receiveEncryptedDataAsync(1, self.reader, self.AESKey)
+        self.isAPI, clientVersion = transport.readHandshakeFlags(flags)
+        self.agreeProtocol(clientVersion)
+
+    def getTraffic(self) -> (int, int):  # Frames are sent both by other threads (through clientSock) and by the
+        # outbox's writer task (straight to the writer)
+        return (getattr(self.clientSock, "bytesSent", 0) + getattr(self.writer, "bytesSent", 0),
+                getattr(self.reader, "bytesReceived", 0))
+
+    async def main(self, presenceRegistry) -> None:
+        self.outbox = fanout.AsyncOutbox(self, asyncio.get_running_loop(), OUTBOX_SIZE, SLOW_CLIENT_POLICY)
+        self.joinServer(presenceRegistry)
+        try:
+            while True:
                 try:
-                    groupClients[self.sessionToken["groupID"]].remove(self)  # If the client is in groupClients,
-                    # remove them
-                except ValueError:
-                    pass
-                clients.remove(self)  # Remove the client from the list of clients
-                self.clientSock.close()
-                return None
-            if dataType == "message":  # If the data is a message
-                event = events.Message([groupClients, data, self, encoding])  # Send it to all clients
-            elif dataType == "makeAccount":  # If the data is a request for a new account,
-                userPassword = json.loads(data.decode(encoding))
-                event = events.NewAccount([self.storageMethod, self, userPassword["username"], userPassword["password"]])  # Make the new account
-            elif dataType == "login":  # If the data is a request to login,
-                userPassword = json.loads(data.decode(encoding))
-                event = events.Login([self.storageMethod, self, userPassword["username"], userPassword["password"], clients])  # Try to login
-            elif dataType == "logout":  # If the client wishes to logout,
-                event = events.Logout([self, groupClients])  # And log them out
-            elif dataType == "makeGroup":  # If the client wishes to make a group,
-                groupName = json.loads(data.decode(encoding))["groupName"]
-                event = events.MakeGroup([self, groupName, self.storageMethod])  # Make the new group
-            elif dataType == "addUserToGroup":  # If the client wishes to add a user to a group,
-                groupInfo = json.loads(data.decode(encoding))
-                event = events.AddUserToGroup([self, groupInfo["userID"], groupInfo["groupID"]])  # Attempt to do so
-            elif dataType == "leaveGroup":
-                info = json.loads(data.decode(encoding))
-                event = events.LeaveGroup([self, json.loads(info["token"]), info["group"], self.storageMethod, groupClients,
-                                           eventQueue])
-            elif dataType == "switchGroup":  # If the user wishes to switch their group,
-                groupInfo = json.loads(data.decode(encoding))  # Try to switch their group
-                event = events.GroupSwitch([self, groupInfo["groupToSwitchTo"], groupClients, eventQueue])
-            elif dataType == "getGroups":
-                token = json.loads(json.loads(data.decode(encoding))["token"])  # Get the session token
-                event = events.ListGroups([self, token, self.storageMethod])  # And give the client the groups
-            elif dataType == "doHeartbeat":  # If the client wishes to perform a heartbeat,
-                event = events.Heartbeat([self, data])  # Then do it
-            elif dataType == "getMessages":
-                event = events.RetrieveMessages([self, self.messageStorage])
-            else:
-                event = events.Log(data)  # If the data is not any of the above, just log it
-            eventQueue.put(event)
-
-
-def handleEvents(storageMethod):  # A function to handle the events which come in
-    global eventQueue
-    storageMethod.getConnection()
+                    dataType, encoding, data, requestID = await transport.receiveRequestAsync(
+                        self.reader, self.AESKey, self.clientSock.protocolVersion)
+                except (ValueError, asyncio.IncompleteReadError, ConnectionResetError):  # If the client has
+                    # disconnected,
+                    return None
+                event = self.makeEvent(dataType, encoding, data, requestID)
+                if event is not None:
+                    eventQueue.put(event)
+        finally:  # However the loop ends, the client is removed from the server
+            self.leaveServer(presenceRegistry)
+
+
+class Stopping(Exception):  # Raised in the main thread when the server is told to stop
+    pass
+
+
+def stopAccepting(signalNumber, frame) -> None:
+    raise Stopping()
+
+
+def signalReady(readyFD: int) -> None:  # Tells whoever started the server (e.g. the launcher) that it is listening
+    if readyFD is not None:
+        os.write(readyFD, b"1")
+        os.close(readyFD)
+
+
+def drain(timeout: float, messageStorage: storage.MessageStorage) -> None:  # Run once the server has stopped
+    # accepting clients. Waits for the connected clients to leave (disconnecting any still there after the timeout),
+    # then for their messages to be saved
+    deadline = time.monotonic() + timeout
+    while presenceRegistry.connectionCount() > 0 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    for client in presenceRegistry.getConnections():
+        try:
+            client.clientSock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    if clusterNode is not None:  # Stop taking messages from the rest of the cluster, so the queues can empty
+        clusterNode.close()
+    eventQueue.join()
+    messageStorage.join()
+    eventQueue.join()  # The messages which were passed on are saved by events
+
+
+def serveThreaded(port: int, privKey, messageStorage, storageMethod, reusePort: bool = False,
+                  readyFD: int = None) -> None:  # Serves each client on its own thread, until told to stop
+    servSocket = socket.socket()
+    if reusePort:  # Lets several servers listen on the same port, with the OS sharing the clients out between them
+        servSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    servSocket.bind(("0.0.0.0", port))
+    servSocket.listen(HANDSHAKE_BACKLOG)
+    signal.signal(signal.SIGTERM, stopAccepting)
+    signalReady(readyFD)
+
+    def startClient(clientSock: socket.socket, claim) -> bool:  # Run by the handshake pool
+        return Client(clientSock, messageStorage, presenceRegistry, storageMethod).start(privKey, claim)
+
     while True:
-        if eventQueue.empty():
+        try:
+            handshakeStats.submit(servSocket.accept()[0], startClient)  # The handshake is done by the pool, so the
+            # next client can be accepted straight away
+        except socket.timeout:
             continue
-        else:  # If there is an event in the event queue,
-            event = eventQueue.get()
-            try:
-                event.handle()  # Handle it
-            except Exception as e:
-                print(e)  # If there is an error, log it and continue
-
-
-pubKey = encryption.readRSAKeyFromFile("pubKey.rsa")
-privKey = encryption.readRSAKeyFromFile("privKey.rsa")
-servSocket = socket.socket()
-servSocket.bind(("0.0.0.0", PORT))
-servSocket.listen()
-handlingThread = threading.Thread(target=handleEvents, daemon=True, args=(storageMethod, ))
-handlingThread.start()
-messageStorage = storage.MessageStorage(eventQueue)
-while True:
-    try:
-        clients.append(Client(servSocket.accept()[0], privKey, messageStorage, groupClients, storageMethod))
-    except socket.timeout:
-        continue
+        except Stopping:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)  # Being told again shouldn't cut the draining short
+            servSocket.close()
+            return None
+
+
+async def serveAsync(port: int, privKey, messageStorage, storageMethod, reusePort: bool = False,
+                     readyFD: int = None) -> None:  # Serves every client from one event loop, until told to stop
+    executor = concurrent.futures.ThreadPoolExecutor(HANDSHAKE_WORKERS)  # Does the RSA decryption for handshakes
+
+    async def onConnection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if handshakeStats.inProgress >= HANDSHAKE_BACKLOG:  # If the server is already behind, turn the client away
+            handshakeStats.reject()
+            writer.close()
+            return None
+        client = AsyncClient(reader, writer, messageStorage, storageMethod)
+        timeAccepted = time.perf_counter()
+        handshakeStats.start()
+        try:
+            await asyncio.wait_for(client.handshake(privKey, executor), HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            handshakeStats.finish("timedOut")
+            writer.close()
+            return None
+        except (ValueError, asyncio.IncompleteReadError, ConnectionResetError):  # If the handshake fails,
+            handshakeStats.finish("failed", time.perf_counter() - timeAccepted)
+            writer.close()  # Drop the connection
+            return None
+        handshakeStats.finish("succeeded", time.perf_counter() - timeAccepted)
+        await client.main(presenceRegistry)
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    servSocket = await asyncio.start_server(onConnection, "0.0.0.0", port, backlog=HANDSHAKE_BACKLOG,
+                                            reuse_port=reusePort)
+    signalReady(readyFD)
+    await stopping.wait()
+    servSocket.close()
+    await loop.run_in_executor(None, drain, DRAIN_TIMEOUT, messageStorage)  # The event loop keeps serving the
+    # clients while they leave
+
+
+def describeConnections() -> list:  # Gives each connected client's user, group and traffic, for the JSON metrics
+    connections = []
+    for client in presenceRegistry.getConnections():
+        bytesSent, bytesReceived = client.getTraffic()
+        connections.append({"user": client.username, "group": str(client.sessionToken["groupID"]),
+                            "isAPI": client.isAPI, "bytesSent": bytesSent, "bytesReceived": bytesReceived})
+    return connections
+
+
+def startMetrics(port: int, messageStorage: storage.MessageStorage) -> None:  # Serves the metrics on localhost,
+    # along with gauges which are read from the server's queues when scraped
+    eventQueueDepth = metrics.registry.gauge("chatroom_event_queue_depth", "Events waiting to be handled")
+    eventQueueDepth.setFunction(eventQueue.qsize)
+    messageBacklog = metrics.registry.gauge("chatroom_message_backlog",
+                                            "Messages waiting to be added to the history and saved")
+    messageBacklog.setFunction(messageStorage.toMessages.qsize)
+    connections = metrics.registry.gauge("chatroom_connections", "Connected clients")
+    connections.setFunction(lambda: presenceRegistry.connectionCount())  # Looked up each time, as the registry is
+    # replaced when running in a cluster
+    handshakesInProgress = metrics.registry.gauge("chatroom_handshakes_in_progress",
+                                                  "Handshakes which have started but not finished")
+    handshakesInProgress.setFunction(lambda: handshakeStats.getStats()["inProgress"])
+    metrics.registry.addCollector("dispatcher", eventQueue.getStats)
+    metrics.registry.addCollector("handshakes", lambda: handshakeStats.getStats())
+    metrics.registry.addCollector("connections", describeConnections)
+    metrics.serve(port)
+
+
+def reportStats(interval: float) -> None:  # Prints the event and handshake stats every so often
+    while True:
+        time.sleep(interval)
+        print({"events": eventQueue.getStats(), "handshakes": handshakeStats.getStats()})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a chatroom server")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--asyncio", action="store_true", default=USE_ASYNCIO,
+                        help="serve clients from an asyncio event loop instead of one thread per client")
+    parser.add_argument("--workers", type=int, default=EVENT_WORKERS, help="how many threads handle events")
+    parser.add_argument("--stats-interval", type=float, default=STATS_INTERVAL,
+                        help="print the event queue depth, event latencies and handshake stats every this many seconds")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="serve metrics at /metrics (Prometheus) and /metrics.json on this port on localhost")
+    parser.add_argument("--admin-user", action="append", default=[],
+                        help="the ID of a user who may profile the server (can be given more than once)")
+    parser.add_argument("--profile-dir", default=profiler.PROFILE_DIRECTORY, help="where profiles are written")
+    parser.add_argument("--plugin", action="append", default=[],
+                        help="a module to import, which can add types of request by defining events with a wireType "
+                             "(can be given more than once)")
+    parser.add_argument("--outbox-size", type=int, default=OUTBOX_SIZE,
+                        help="how many frames can be waiting to be sent to one client")
+    parser.add_argument("--slow-client-policy", choices=fanout.POLICIES, default=SLOW_CLIENT_POLICY,
+                        help="what to do when a client's outbox is full")
+    parser.add_argument("--writers", type=int, default=WRITER_THREADS,
+                        help="how many threads send messages to clients (when not using asyncio)")
+    parser.add_argument("--cache-size", type=int, default=storage.CACHE_SIZE,
+                        help="how many memberships and group names are cached (0 turns the cache off)")
+    parser.add_argument("--ticket-lifetime", type=int, default=encryption.TICKET_LIFETIME,
+                        help="how long (in seconds) a session ticket can be used to skip RSA when reconnecting")
+    parser.add_argument("--handshake-workers", type=int, default=HANDSHAKE_WORKERS,
+                        help="how many handshakes can be done at once")
+    parser.add_argument("--handshake-backlog", type=int, default=HANDSHAKE_BACKLOG,
+                        help="how many clients can wait for their handshake before more are turned away")
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKE_TIMEOUT,
+                        help="how long (in seconds) a client has to finish its handshake")
+    parser.add_argument("--group-keys", action="store_true", default=USE_GROUP_KEYS,
+                        help="seal each group message once with a key shared by the group, for clients which support it")
+    parser.add_argument("--json-only", dest="binary", action="store_false", default=USE_BINARY,
+                        help="send clients JSON, even if they can use the binary codec")
+    parser.add_argument("--database", default=DATABASE_PATH,
+                        help="the database file, which every server in a cluster should share")
+    parser.add_argument("--cluster-socket", default=CLUSTER_SOCKET,
+                        help="join a cluster through the broker listening on this UNIX socket")
+    parser.add_argument("--cluster-broker", action="store_true",
+                        help="run the cluster's broker (on --cluster-socket) in this server")
+    parser.add_argument("--node-id", help="this server's name in the cluster (random by default)")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="let other servers listen on the same port (as the launcher's workers do)")
+    parser.add_argument("--messages-dir", default="messages", help="where the message log is kept")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+                        help="when stopped (with SIGTERM), how long clients are given to leave")
+    parser.add_argument("--ready-fd", type=int, help="a file descriptor to write to once the server is listening")
+    parser.add_argument("--hashing-processes", type=int, default=HASHING_PROCESSES,
+                        help="how many processes hash passwords (defaults to one per CPU core)")
+    parser.add_argument("--argon-time-cost", type=int, default=ARGON_TIME_COST)
+    parser.add_argument("--argon-memory-cost", type=int, default=ARGON_MEMORY_COST, help="in kibibytes")
+    parser.add_argument("--argon-parallelism", type=int, default=ARGON_PARALLELISM)
+    arguments = parser.parse_args()
+    OUTBOX_SIZE = arguments.outbox_size
+    SLOW_CLIENT_POLICY = arguments.slow_client_policy
+    HANDSHAKE_WORKERS = arguments.handshake_workers
+    HANDSHAKE_BACKLOG = arguments.handshake_backlog
+    HANDSHAKE_TIMEOUT = arguments.handshake_timeout
+    DRAIN_TIMEOUT = arguments.drain_timeout
+    USE_BINARY = arguments.binary
+    ADMIN_USERS = set(arguments.admin_user)
+    samplingProfiler = profiler.SamplingProfiler(arguments.profile_dir)
+    hashingPool = encryption.PasswordHashingPool(arguments.hashing_processes, arguments.argon_time_cost,
+                                                 arguments.argon_memory_cost, arguments.argon_parallelism)
+    eventQueue = dispatcher.EventDispatcher(arguments.workers)
+    storageMethod = storage.SQLDatabase(arguments.database)
+    ticketIssuer = encryption.TicketIssuer(lifetime=arguments.ticket_lifetime)
+    if arguments.group_keys:
+        groupKeyring = fanout.GroupKeyring()
+    if arguments.cache_size > 0:
+        storageMethod = storage.CachedStorage(storageMethod, arguments.cache_size)
+    pubKey = encryption.readRSAKeyFromFile("pubKey.rsa")
+    privKey = encryption.readRSAKeyFromFile("privKey.rsa")
+    eventQueue.start()
+    if arguments.asyncio:
+        handshakeStats = handshakes.HandshakeStats()
+    else:
+        handshakeStats = handshakes.HandshakePool(HANDSHAKE_WORKERS, HANDSHAKE_BACKLOG, HANDSHAKE_TIMEOUT)
+    if arguments.stats_interval > 0:
+        statsThread = threading.Thread(target=reportStats, daemon=True, args=(arguments.stats_interval, ))
+        statsThread.start()
+    messageStorage = storage.MessageStorage(eventQueue, storage.MessageLog(arguments.messages_dir))
+    if arguments.cluster_socket is not None:
+        if arguments.cluster_broker:
+            broker = cluster.UnixSocketBroker(arguments.cluster_socket)
+            brokerThread = threading.Thread(target=broker.serveForever, daemon=True)
+            brokerThread.start()
+        presenceRegistry = cluster.ClusterPresenceRegistry()  # Replaced before any clients connect
+        clusterNode = cluster.ClusterNode(cluster.UnixSocketBackend(arguments.cluster_socket), presenceRegistry,
+                                          messageStorage, eventQueue, storageMethod, groupKeyring,
+                                          arguments.node_id)
+    for plugin in arguments.plugin:
+        importlib.import_module(plugin)
+    services = events.Services(presenceRegistry, eventQueue, hashingPool, groupKeyring, clusterNode,
+                               samplingProfiler, ADMIN_USERS)
+    if arguments.metrics_port > 0:
+        startMetrics(arguments.metrics_port, messageStorage)
+    if arguments.asyncio:
+        asyncio.run(serveAsync(arguments.port, privKey, messageStorage, storageMethod, arguments.reuse_port,
+                               arguments.ready_fd))
+    else:
+        writerPool = fanout.WriterPool(arguments.writers)
+        serveThreaded(arguments.port, privKey, messageStorage, storageMethod, arguments.reuse_port,
+                      arguments.ready_fd)
+        drain(DRAIN_TIMEOUT, messageStorage)
@@ -1,9 +1,46 @@
 import sqlite3
+import contextlib
+import collections
 import queue
 import threading
+import struct
+import json
+import os
 import encryption
 import events
 
+SEGMENT_SIZE = 4 * 1024 * 1024  # How big (in bytes) a segment of the message log can get before a new one is started
+COMPACT_AFTER_SEGMENTS = 8  # How many full segments can build up before they are compacted into one
+COMPACTED_BLOCK_SIZE = 1024  # How many records are encrypted together in a compacted segment
+MAX_PAGE_SIZE = 500  # The most messages which can be retrieved at once
+HISTORY_LENGTH = 100  # How many of the latest messages are sent when a client joins a group
+DATABASE_POOL_SIZE = 8  # How many sqlite connections are kept open
+DATABASE_BUSY_TIMEOUT = 5  # How long (in seconds) a connection waits for another one to finish writing
+CACHED_STATEMENTS = 128  # How many compiled statements each connection keeps
+PRAGMAS = ("PRAGMA journal_mode=WAL",  # Readers don't block the writer (or each other), and commits are appended to
+           # a log rather than rewriting the database
+           "PRAGMA synchronous=NORMAL",  # With WAL, this only syncs at checkpoints, and is still safe from corruption
+           "PRAGMA cache_size=-16000",  # 16MB of page cache per connection
+           "PRAGMA temp_store=MEMORY",
+           "PRAGMA mmap_size=268435456")  # Reads are done through up to 256MB of memory-mapped file
+
+MAX_QUERY_PARAMETERS = 500  # How many values can be passed to one query (sqlite's limit can be as low as 999)
+CACHE_SIZE = 10000  # How many users' groups, groups' users and groups' names CachedStorage keeps (of each)
+
+ADD_USER = """INSERT INTO users
+              VALUES(NULL, ? ,?)"""  # Here, the null just means that the userID is automatically generated, and the ? means that they are passed via python.
+ADD_GROUP = """INSERT INTO groups
+               VALUES(NULL, ?)"""
+ADD_USER_TO_GROUP = """INSERT OR IGNORE INTO userGroups
+                       VALUES(NULL, ?, ?)"""  # If the user is already in the group, nothing happens
+GET_MEMBERSHIP = """SELECT usergroupID FROM userGroups WHERE userID=? AND groupID=?"""
+REMOVE_USER_FROM_GROUP = """DELETE FROM userGroups WHERE userID=? AND groupID=?"""
+GET_USER = """SELECT userName, userPassword FROM users WHERE userID=?"""
+GET_GROUP = """SELECT groupName FROM groups WHERE groupID=?"""
+GET_GROUPS_FROM_USER = """SELECT groupID FROM userGroups WHERE userID=?"""
+GET_USERS_FROM_GROUP = """SELECT userID FROM userGroups WHERE groupID=?"""  # The commands are kept as constants so
+# that each connection's statement cache is hit every time
+
 
 class StorageMethod:  # A superclass for a storage method
     def __init__(self):
@@ -15,6 +52,9 @@ class StorageMethod:  # A superclass for a storage method
     def getGroup(self, ID):  # With a group's ID, get its name
         return "groupName"
 
+    def getGroups(self, IDs):  # With a list of groups' IDs, get a dictionary of their names
+        return {ID: self.getGroup(ID) for ID in IDs}
+
     def getGroupsFromUser(self, userID):  # Get a list of groups which a user is in
         return ["groupID1", "groupID2"]
 
@@ -32,6 +72,13 @@ class StorageMethod:  # A superclass for a storage method
                        groupID):  # Given a user and group's ID, add the user to the group, and return the userGroup ID
         return 1
 
+    def addUsers(self, users):  # Given a list of (username, hashed password), add all the users, and return their IDs
+        return [self.addUser(userName, userPass) for userName, userPass in users]
+
+    def addUsersToGroups(self, memberships):  # Given a list of (userID, groupID), add each user to their group
+        for userID, groupID in memberships:
+            self.addUserToGroup(userID, groupID)
+
     def removeUserFromGroup(self, userID, groupID):  # Given a user and group's ID, remove the user from the group if
         # they are in it
         pass
@@ -43,106 +90,531 @@ class StorageMethod:  # A superclass for a storage method
         pass
 
 
-class SQLDatabase(StorageMethod):
-    def __init__(self):  # Initialises a database (if it isn't already initialised)
-        self.getConnection()
-        SQLCommand = """CREATE TABLE IF NOT EXISTS users (userID INTEGER PRIMARY KEY,
-                                                          userName TEXT,
-                                                          userPassword TEXT);
-                        CREATE TABLE IF NOT EXISTS groups (groupID INTEGER PRIMARY KEY,
-                                                           groupName TEXT);
-                        CREATE TABLE IF NOT EXISTS userGroups (usergroupID INTEGER PRIMARY KEY,
-                                                               userID INTEGER,
-                                                               groupID INTEGER);"""  # An SQL command which creates 3 tables; one user table, one group table and one to link them in
-        # order to avoid a many-to-many relationship.
-        self.databaseCursor.executescript(SQLCommand)
-        self.databaseConnection.commit()
+MIGRATIONS = (  # Each migration brings the database up one version; the version a database is at is kept in its
+    # user_version, so only the migrations it hasn't had yet are run. New migrations go on the end
+    """CREATE TABLE IF NOT EXISTS users (userID INTEGER PRIMARY KEY,
+                                      userName TEXT,
+                                      userPassword TEXT);
+    CREATE TABLE IF NOT EXISTS groups (groupID INTEGER PRIMARY KEY,
+                                       groupName TEXT);
+    CREATE TABLE IF NOT EXISTS userGroups (usergroupID INTEGER PRIMARY KEY,
+                                           userID INTEGER,
+                                           groupID INTEGER);""",  # Creates 3 tables; one user table, one group table
+    # and one to link them in order to avoid a many-to-many relationship.
+    """CREATE TABLE newUserGroups (usergroupID INTEGER PRIMARY KEY,
+                                   userID INTEGER,
+                                   groupID INTEGER,
+                                   UNIQUE (userID, groupID));
+    INSERT OR IGNORE INTO newUserGroups SELECT * FROM userGroups ORDER BY usergroupID;
+    DROP TABLE userGroups;
+    ALTER TABLE newUserGroups RENAME TO userGroups;
+    CREATE INDEX userGroupsByGroup ON userGroups (groupID, userID);""",  # sqlite can't add a constraint to an
+    # existing table, so the table is rebuilt (dropping any duplicate memberships). The constraint's index is used
+    # to find a user's groups, and the new index to find a group's users, rather than scanning the whole table
+    """INSERT OR IGNORE INTO groups (groupID, groupName) VALUES (1, 'default');""",  # The default group is made
+    # here, so that servers sharing a database can't each make one
+)
+
+
+def splitStatements(script: str) -> list:  # Splits a script into its statements, so they can be run one at a time
+    statements = []
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ""
+    return statements
+
+
+def migrate(connection: sqlite3.Connection, migrations: tuple = MIGRATIONS) -> None:  # Runs the migrations which
+    # the database hasn't had yet
+    if connection.execute("PRAGMA user_version").fetchone()[0] >= len(migrations):
+        return None
+    isolationLevel = connection.isolation_level
+    connection.isolation_level = None  # The transaction is managed here, rather than by the sqlite3 module
+    try:
+        connection.execute("BEGIN IMMEDIATE")  # Locks the database before checking its version, so that servers
+        # sharing it (in a cluster) don't run the same migration twice
         try:
-            self.getGroup(1)  # Try and get the default group
-        except TypeError:
-            self.addGroup("default")  # If it doesn't exist, create it.
-        self.closeConnection()
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            for newVersion in range(version + 1, len(migrations) + 1):
+                for statement in splitStatements(migrations[newVersion - 1]):
+                    connection.execute(statement)
+                connection.execute(f"PRAGMA user_version={newVersion}")
+            connection.execute("COMMIT")  # The migrations are applied in full or not at all
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+    finally:
+        connection.isolation_level = isolationLevel
 
-    def getConnection(self):
-        self.databaseConnection = sqlite3.Connection("database.db")
-        self.databaseCursor = self.databaseConnection.cursor()
+
+class ConnectionPool:  # A pool of sqlite connections which any thread can borrow, so that the worker threads don't
+    # each need their own connection (or get "SQLite objects created in a thread" errors)
+    def __init__(self, path: str = "database.db", size: int = DATABASE_POOL_SIZE):
+        self.path = path
+        self.connections = queue.LifoQueue()  # The most recently used connection is handed out first, as its cache
+        # is the warmest
+        for i in range(size):
+            self.connections.put(self.connect())
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=DATABASE_BUSY_TIMEOUT, check_same_thread=False,
+                                     cached_statements=CACHED_STATEMENTS)  # A connection is only used by one thread
+        # at a time, so it can safely be passed between threads
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        return connection
+
+    @contextlib.contextmanager
+    def connection(self) -> sqlite3.Connection:  # Borrows a connection, giving it back afterwards
+        connection = self.connections.get()  # Blocks until a connection is free
+        try:
+            yield connection
+        finally:
+            self.connections.put(connection)
+
+    def close(self) -> None:
+        while not self.connections.empty():
+            self.connections.get().close()
+
+
+class SQLDatabase(StorageMethod):
+    def __init__(self, path: str = "database.db", poolSize: int = DATABASE_POOL_SIZE):  # Initialises a database (if it
+        # isn't already initialised)
+        self.pool = ConnectionPool(path, poolSize)
+        with self.getConnection() as connection:
+            migrate(connection)  # Brings the tables up to date (and makes the default group), whether the database
+            # is new or old
+
+    def getConnection(self):  # Borrows a connection from the pool, for use in a with statement
+        return self.pool.connection()
 
     def closeConnection(self):
-        self.databaseCursor.close()
-        self.databaseConnection.close()
+        self.pool.close()
+
+    def execute(self, SQLCommand: str, parameters: tuple = ()) -> sqlite3.Cursor:  # Runs a command in its own
+        # transaction, which is committed straight away
+        with self.getConnection() as connection:
+            with connection:  # Commits if the command succeeds, and rolls back if it doesn't
+                return connection.execute(SQLCommand, parameters)
+
+    def executeMany(self, SQLCommand: str, rows: list) -> None:  # Runs a command once for each row, all in one
+        # transaction, so that there is only one commit (and one sync to disk)
+        with self.getConnection() as connection:
+            with connection:
+                connection.executemany(SQLCommand, rows)
+
+    def query(self, SQLCommand: str, parameters: tuple = ()) -> list:  # Runs a command, and gives all of its results
+        with self.getConnection() as connection:
+            return connection.execute(SQLCommand, parameters).fetchall()
 
     def addUser(self, userName, userPass):
-        SQLCommand = """INSERT INTO users
-                        VALUES(NULL, ? ,?)"""  # Here, the null just means that the userID is automatically generated, and the ? means that they are passed via python.
-        self.databaseCursor.execute(SQLCommand, (userName, userPass,))
-        self.databaseConnection.commit()
-        ID = self.databaseCursor.lastrowid
-        return ID
+        return self.execute(ADD_USER, (userName, userPass,)).lastrowid
+
+    def addUsers(self, users: list) -> list:  # Given a list of (username, hashed password), add all the users at
+        # once, and return their IDs
+        with self.getConnection() as connection:
+            with connection:
+                return [connection.execute(ADD_USER, user).lastrowid for user in users]
 
     def addGroup(self, groupName):
-        SQLCommand = """INSERT INTO groups
-                        VALUES(NULL, ?)"""
-        self.databaseCursor.execute(SQLCommand, (groupName,))
-        self.databaseConnection.commit()
-        ID = self.databaseCursor.lastrowid
-        return ID
+        return self.execute(ADD_GROUP, (groupName,)).lastrowid
 
     def addUserToGroup(self, userID, groupID):
-        SQLCommand = """INSERT INTO userGroups
-                        VALUES(NULL, ?, ?)"""
-        self.databaseCursor.execute(SQLCommand, (userID, groupID))
-        self.databaseConnection.commit()
-        ID = self.databaseCursor.lastrowid
-        return ID
+        cursor = self.execute(ADD_USER_TO_GROUP, (userID, groupID))
+        if cursor.rowcount == 0:  # If the user was already in the group, give the ID of their existing membership
+            return self.query(GET_MEMBERSHIP, (userID, groupID))[0][0]
+        return cursor.lastrowid
+
+    def addUsersToGroups(self, memberships: list) -> None:  # Given a list of (userID, groupID), add all the users to
+        # their groups at once
+        self.executeMany(ADD_USER_TO_GROUP, memberships)
 
     def removeUserFromGroup(self, userID, groupID):
-        SQLCommand = """DELETE FROM userGroups WHERE userID=? AND groupID=?"""
-        self.databaseCursor.execute(SQLCommand, (userID, groupID, ))
-        self.databaseConnection.commit()
+        self.execute(REMOVE_USER_FROM_GROUP, (userID, groupID, ))
 
     def getUser(self, ID):
-        SQLCommand = """SELECT userName, userPassword FROM users WHERE userID=?"""
-        self.databaseCursor.execute(SQLCommand, (ID,))
-        result = self.databaseCursor.fetchone()  # Since the userID is the primary key, fetchone is used
+        result = self.query(GET_USER, (ID,))[0]  # Since the userID is the primary key, there is only one result
         return result[0], result[1]
 
     def getGroup(self, ID):
-        SQLCommand = """SELECT groupName FROM groups WHERE groupID=?"""
-        self.databaseCursor.execute(SQLCommand, (ID,))
-        result = self.databaseCursor.fetchone()[0]
-        return result
+        results = self.query(GET_GROUP, (ID,))
+        if not results:
+            raise TypeError(f"There is no group with ID {ID}")  # The same error as subscripting a missing row
+        return results[0][0]
+
+    def getGroups(self, IDs):  # Gets all the names in one query, rather than one query per group
+        IDs = list(IDs)
+        names = {}
+        for start in range(0, len(IDs), MAX_QUERY_PARAMETERS):
+            someIDs = IDs[start:start + MAX_QUERY_PARAMETERS]
+            SQLCommand = f"""SELECT groupID, groupName FROM groups WHERE groupID IN ({",".join("?" * len(someIDs))})"""
+            names.update(self.query(SQLCommand, tuple(someIDs)))
+        return {ID: names[int(ID)] for ID in IDs if int(ID) in names}
+
+    def getGroupsFromUser(self, userID):
+        return [result[0] for result in self.query(GET_GROUPS_FROM_USER, (userID,))]
+
+    def getUsersFromGroup(self, groupID):
+        return [result[0] for result in self.query(GET_USERS_FROM_GROUP, (groupID,))]
+
+
+class LRUCache:  # A dictionary which forgets the least recently used entries once it gets too big, and counts how
+    # often it has (and hasn't) had what was asked for
+    def __init__(self, maxSize: int = CACHE_SIZE):
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):  # Gives the value for a key, or None if it isn't cached
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def discard(self, key) -> None:
+        self.entries.pop(key, None)
+
+    def getStats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class CachedStorage(StorageMethod):  # Wraps another storage method, keeping the memberships and group names it has
+    # read in memory, so that (for example) switching to a busy group doesn't go to the database every time
+    def __init__(self, storageMethod: StorageMethod, maxSize: int = CACHE_SIZE):
+        super().__init__()
+        self.storageMethod = storageMethod
+        self.lock = threading.Lock()
+        self.groupsFromUser = LRUCache(maxSize)  # Maps a user's ID to a tuple of the groups they are in
+        self.usersFromGroup = LRUCache(maxSize)  # Maps a group's ID to a tuple of the users in it
+        self.groupNames = LRUCache(maxSize)  # Maps a group's ID to its name
+        self.generation = 0  # Goes up whenever a membership changes, so that a lookup which raced with the change
+        # doesn't cache what it read
+        self.listeners = []  # Called with the memberships changed through this cache (e.g. to tell other servers
+        # sharing the database to forget them too)
+
+    def getCached(self, cache: LRUCache, ID, load):  # Gives a cached value, loading (and caching) it if it isn't
+        # there
+        ID = int(ID)  # IDs arrive as both strings and integers
+        with self.lock:
+            value = cache.get(ID)
+            generation = self.generation
+        if value is None:
+            value = load(ID)
+            with self.lock:
+                if generation == self.generation:
+                    cache.put(ID, value)
+        return value
+
+    def addListener(self, listener) -> None:
+        self.listeners.append(listener)
+
+    def forgetMemberships(self, memberships) -> None:  # Called after memberships change in the wrapped storage
+        # method, so the next lookup reads them again
+        with self.lock:
+            self.generation += 1
+            for userID, groupID in memberships:
+                self.groupsFromUser.discard(int(userID))
+                self.usersFromGroup.discard(int(groupID))
+
+    def changedMemberships(self, memberships) -> None:  # Forgets memberships which were changed through this cache,
+        # and tells the listeners
+        self.forgetMemberships(memberships)
+        for listener in self.listeners:
+            listener(memberships)
+
+    def getUser(self, ID):
+        return self.storageMethod.getUser(ID)
+
+    def getGroup(self, ID):
+        return self.getCached(self.groupNames, ID, self.storageMethod.getGroup)
+
+    def getGroups(self, IDs):
+        names = {}
+        missing = []
+        with self.lock:
+            for ID in IDs:
+                name = self.groupNames.get(int(ID))
+                if name is None:
+                    missing.append(ID)
+                else:
+                    names[ID] = name
+        if missing:  # Any names which aren't cached are got all at once
+            loaded = self.storageMethod.getGroups(missing)
+            with self.lock:
+                for ID, name in loaded.items():
+                    self.groupNames.put(int(ID), name)
+            names.update(loaded)
+        return names
 
     def getGroupsFromUser(self, userID):
-        SQLCommand = """SELECT groupID FROM userGroups WHERE userID=?"""
-        self.databaseCursor.execute(SQLCommand, (userID,))
-        results = self.databaseCursor.fetchall()
-        formattedResults = []
-        for result in results:
-            formattedResults.append(result[0])
-        return formattedResults
+        return list(self.getCached(self.groupsFromUser, userID,
+                                   lambda ID: tuple(self.storageMethod.getGroupsFromUser(ID))))
 
     def getUsersFromGroup(self, groupID):
-        SQLCommand = """SELECT userID FROM userGroups WHERE groupID=?"""
-        self.databaseCursor.execute(SQLCommand, (groupID,))
-        results = self.databaseCursor.fetchall()
-        formattedResults = []
-        for result in results:
-            formattedResults.append(result[0])
-        return formattedResults
+        return list(self.getCached(self.usersFromGroup, groupID,
+                                   lambda ID: tuple(self.storageMethod.getUsersFromGroup(ID))))
+
+    def addUser(self, userName, userPass):
+        return self.storageMethod.addUser(userName, userPass)
+
+    def addUsers(self, users):
+        return self.storageMethod.addUsers(users)
+
+    def addGroup(self, groupName):
+        groupID = self.storageMethod.addGroup(groupName)
+        with self.lock:
+            self.groupNames.put(int(groupID), groupName)
+        return groupID
+
+    def addUserToGroup(self, userID, groupID):
+        try:
+            return self.storageMethod.addUserToGroup(userID, groupID)
+        finally:
+            self.changedMemberships([(userID, groupID)])
+
+    def addUsersToGroups(self, memberships):
+        try:
+            self.storageMethod.addUsersToGroups(memberships)
+        finally:
+            self.changedMemberships(memberships)
+
+    def removeUserFromGroup(self, userID, groupID):
+        try:
+            self.storageMethod.removeUserFromGroup(userID, groupID)
+        finally:
+            self.changedMemberships([(userID, groupID)])
+
+    def getConnection(self):
+        return self.storageMethod.getConnection()
+
+    def closeConnection(self):
+        self.storageMethod.closeConnection()
+
+    def getStats(self) -> dict:  # Gives the size, hits and misses of each cache
+        with self.lock:
+            return {"groupsFromUser": self.groupsFromUser.getStats(),
+                    "usersFromGroup": self.usersFromGroup.getStats(),
+                    "groupNames": self.groupNames.getStats()}
+
+
+class MessageLog:  # An append-only log of messages, split into segment files. Each entry in a segment is
+    # encrypted on its own, so saving a message only costs as much as the message itself
+    # An entry is laid out as: kind (1 byte), length of ciphertext (4 bytes), nonce (16 bytes), tag (16 bytes),
+    # ciphertext
+    RECORD = 0  # An entry holding one record
+    BLOCK = 1  # An entry holding a list of records (used when compacting)
+    COVERS = 2  # The first entry of a compacted segment, holding the number of the first segment it replaced
+    entryHeader = struct.Struct(">BI")
+
+    def __init__(self, directory: str = "messages", keyFile: str = "AES.key"):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.isCompacting = False
+        os.makedirs(directory, exist_ok=True)
+        self.AESKey = encryption.readOrMakeAESKey(keyFile)
+        self.removeReplacedSegments()
+        segments = self.getSegmentNumbers()
+        self.currentSegment = segments[-1] if segments else 1
+        if segments:
+            self.repairSegment(self.currentSegment)
+        self.segmentFile = open(self.getSegmentPath(self.currentSegment), "ab")
+        self.uncompactedSegments = len(self.getUncompactedSegments())
+        with self.lock:  # Segments which built up before the server last stopped don't wait for the next rollover
+            self.compactIfNeeded()
+
+    def getSegmentPath(self, segmentNumber: int) -> str:
+        return os.path.join(self.directory, f"segment-{segmentNumber:08d}.log")
+
+    def getSegmentNumbers(self) -> list:  # Gives the numbers of all the segments, in order
+        numbers = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith("segment-") and filename.endswith(".log"):
+                numbers.append(int(filename[8:-4]))
+        return sorted(numbers)
+
+    def isCompacted(self, segmentNumber: int) -> bool:  # Compacted segments start with a COVERS entry
+        with open(self.getSegmentPath(segmentNumber), "rb") as file:
+            firstByte = file.read(1)
+        return firstByte == bytes([self.COVERS])
+
+    def getUncompactedSegments(self) -> list:  # Gives the full segments which haven't been compacted yet
+        return [i for i in self.getSegmentNumbers() if i < self.currentSegment and not self.isCompacted(i)]
+
+    def encodeEntry(self, kind: int, data) -> bytes:  # Encrypts some JSON-able data into one entry
+        nonce, ciphertext, tag = encryption.encryptDataAES(json.dumps(data).encode("utf-8"), self.AESKey)
+        return self.entryHeader.pack(kind, len(ciphertext)) + nonce + tag + ciphertext
+
+    def readEntries(self, segmentNumber: int):  # Yields the (kind, data) of every entry in a segment
+        for kind, data, end in self.scanEntries(segmentNumber):
+            yield kind, data
+
+    def scanEntries(self, segmentNumber: int):  # Yields the (kind, data, end) of every entry in a segment, end being
+        # where in the segment the entry finishes
+        with open(self.getSegmentPath(segmentNumber), "rb") as file:
+            allData = file.read()
+        position = 0
+        while position + self.entryHeader.size + 32 <= len(allData):
+            kind, length = self.entryHeader.unpack_from(allData, position)
+            position += self.entryHeader.size
+            if position + 32 + length > len(allData):  # If the last entry was only partly written, ignore it
+                break
+            nonce = allData[position:position + 16]
+            tag = allData[position + 16:position + 32]
+            ciphertext = allData[position + 32:position + 32 + length]
+            position += 32 + length
+            yield kind, self.decryptEntry(nonce, tag, ciphertext), position
+
+    def readFirstEntry(self, segmentNumber: int):  # Gives the (kind, data) of a segment's first entry (or None if it
+        # doesn't have a whole one), without reading the rest of the segment
+        with open(self.getSegmentPath(segmentNumber), "rb") as file:
+            header = file.read(self.entryHeader.size + 32)
+            if len(header) < self.entryHeader.size + 32:
+                return None
+            kind, length = self.entryHeader.unpack_from(header)
+            ciphertext = file.read(length)
+        if len(ciphertext) < length:
+            return None
+        nonce = header[self.entryHeader.size:self.entryHeader.size + 16]
+        tag = header[self.entryHeader.size + 16:]
+        return kind, self.decryptEntry(nonce, tag, ciphertext)
+
+    def decryptEntry(self, nonce: bytes, tag: bytes, ciphertext: bytes):
+        return json.loads(encryption.decryptDataAES(self.AESKey, ciphertext, nonce, tag).decode("utf-8"))
+
+    def repairSegment(self, segmentNumber: int) -> None:  # Cuts a partly written last entry off a segment. Otherwise,
+        # entries appended after it would be read as part of it, and the segment couldn't be read any more
+        validLength = 0
+        try:
+            for kind, data, end in self.scanEntries(segmentNumber):
+                validLength = end
+        except ValueError:  # An entry which doesn't decrypt is where the last write stopped
+            pass
+        path = self.getSegmentPath(segmentNumber)
+        if validLength < os.path.getsize(path):
+            with open(path, "r+b") as file:
+                file.truncate(validLength)
+
+    def removeReplacedSegments(self) -> None:  # Deletes segments which a compacted segment has already replaced, in
+        # case the server stopped part-way through compacting. Only the first entry of a compacted segment says what
+        # it replaced, so nothing else is read (startup only checks the last segment all the way through)
+        segments = self.getSegmentNumbers()
+        for segmentNumber in segments:
+            if not self.isCompacted(segmentNumber):
+                continue
+            entry = self.readFirstEntry(segmentNumber)
+            if entry is not None:
+                for replaced in segments:
+                    if entry[1] <= replaced < segmentNumber:
+                        os.remove(self.getSegmentPath(replaced))
+
+    def replay(self):  # Yields every record in the log, in the order they were appended
+        for segmentNumber in self.getSegmentNumbers():
+            for kind, data in self.readEntries(segmentNumber):
+                if kind == self.RECORD:
+                    yield data
+                elif kind == self.BLOCK:
+                    yield from data
+
+    def append(self, record: dict) -> None:
+        self.appendMany([record])
+
+    def appendMany(self, records: list) -> None:  # Adds records to the end of the log
+        entries = b"".join(self.encodeEntry(self.RECORD, record) for record in records)
+        with self.lock:
+            self.segmentFile.write(entries)
+            self.segmentFile.flush()
+            if self.segmentFile.tell() < SEGMENT_SIZE:
+                return None
+            self.segmentFile.close()  # If the segment is full, start a new one
+            self.currentSegment += 1
+            self.segmentFile = open(self.getSegmentPath(self.currentSegment), "ab")
+            self.uncompactedSegments += 1
+            self.compactIfNeeded()
+
+    def compactIfNeeded(self) -> None:  # Starts compacting in the background once enough full segments have built up.
+        # Called with the lock held, whenever the number of them could have passed the limit
+        if self.uncompactedSegments >= COMPACT_AFTER_SEGMENTS and not self.isCompacting:
+            self.isCompacting = True
+            compactingThread = threading.Thread(target=self.compact, daemon=True)
+            compactingThread.start()
+
+    def compact(self) -> None:  # Merges the full segments which haven't been compacted yet into one, with records
+        # encrypted in blocks so that replaying them at startup is quicker
+        compacted = False
+        try:
+            with self.lock:
+                segments = self.getUncompactedSegments()
+            if len(segments) < 2:
+                return None
+            temporaryPath = os.path.join(self.directory, "compacting.tmp")
+            with open(temporaryPath, "wb") as file:
+                file.write(self.encodeEntry(self.COVERS, segments[0]))
+                block = []
+                for segmentNumber in segments:
+                    for kind, data in self.readEntries(segmentNumber):
+                        if kind == self.RECORD:
+                            block.append(data)
+                        elif kind == self.BLOCK:
+                            block.extend(data)
+                        while len(block) >= COMPACTED_BLOCK_SIZE:
+                            file.write(self.encodeEntry(self.BLOCK, block[:COMPACTED_BLOCK_SIZE]))
+                            block = block[COMPACTED_BLOCK_SIZE:]
+                if block:
+                    file.write(self.encodeEntry(self.BLOCK, block))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporaryPath, self.getSegmentPath(segments[-1]))  # The compacted segment takes the place of
+            # the last segment it replaces
+            for segmentNumber in segments[:-1]:
+                os.remove(self.getSegmentPath(segmentNumber))
+            with self.lock:
+                self.uncompactedSegments -= len(segments)
+            compacted = True
+        finally:
+            with self.lock:
+                self.isCompacting = False
+                if compacted:  # Segments which filled up while this ran may need compacting too (though a compaction
+                    # which failed isn't retried until the next rollover)
+                    self.compactIfNeeded()
+
+    def importEncryptedJSON(self, filename: str, AESKey: bytes) -> None:  # Moves messages saved by older versions
+        # (as one encrypted JSON file) into the log
+        messages = encryption.readEncryptedJSON(filename, AESKey)
+        records = []
+        for group in messages.keys():
+            for message in messages[group]:
+                records.append({"group": group, "message": message})
+        self.appendMany(records)
+        os.replace(filename, filename + ".imported")
 
 
 class MessageStorage:  # Used to store messages from clients
-    def __init__(self, events):
+    def __init__(self, events, messageLog: MessageLog = None):
         self.messages = {}
+        self.formattedMessages = {}  # Maps a group to its messages formatted as "username: message", where a
+        # message's ID is its position in the list plus one
+        self.messagesLock = threading.Lock()
         self.toMessages = queue.Queue()
-        self.messageCounter = 0
         self.events = events
-        try:  # Try to load the messages in
-            AESKey = encryption.readAESKey("AES.key")
-            messages = encryption.readEncryptedJSON("messages.enc", AESKey)
-            self.messages = messages
-        except FileNotFoundError:
-            pass
+        self.messageLog = messageLog if messageLog is not None else MessageLog()
+        if os.path.exists("messages.enc"):  # If there are messages saved in the old format, move them into the log
+            self.messageLog.importEncryptedJSON("messages.enc", self.messageLog.AESKey)
+        for message in self.messageLog.replay():  # Load the messages in
+            self.addMessage(message)
         storageThread = threading.Thread(target=self.main, daemon=True)
         storageThread.start()
 
@@ -153,15 +625,48 @@ class MessageStorage:  # Used to store messages from clients
         return self.messages.copy()  # Returns a copy of the messages so multiple threads won't try to change the same
     # Object at the same time
 
-    def main(self):
-        while True:
-            message = self.toMessages.get()  # Get a message from the queue
+    def addMessage(self, message):
+        group = str(message["group"])
+        userInfo = json.loads(message["message"]["sender"])  # Load info about the user (ID, username) once, rather
+        # than every time the message is retrieved
+        formatted = f"{userInfo['username']}: {message['message']['message']}"
+        with self.messagesLock:
             try:
-                self.messages[message["group"]].append(message["message"])  # And add it to the dictionary's list
+                self.messages[group].append(message["message"])  # Add it to the dictionary's list
+                self.formattedMessages[group].append(formatted)
             except KeyError:
-                self.messages[message["group"]] = [message["message"]]  # If this list has not been created yet,
+                self.messages[group] = [message["message"]]  # If this list has not been created yet,
                 # Create it.
-            self.messageCounter += 1
-            if self.messageCounter >= 1:
-                self.events.put(events.SaveMessage(self.getMessages()))
-                self.messageCounter = 0
+                self.formattedMessages[group] = [formatted]
+
+    def getMessagePage(self, group, limit: int, since: int = None, before: int = None) -> (list, bool):  # Gives
+        # up to limit (ID, formatted message) pairs from a group, and whether there are more in that direction.
+        # With since, the messages are the first ones after that ID; with before, the last ones before that ID;
+        # otherwise they are the latest messages
+        limit = max(0, min(limit, MAX_PAGE_SIZE))
+        with self.messagesLock:
+            formatted = self.formattedMessages.get(str(group), [])
+            if since is not None:
+                start = max(since, 0)
+                end = min(start + limit, len(formatted))
+                hasMore = end < len(formatted)
+            else:
+                end = len(formatted) if before is None else min(max(before - 1, 0), len(formatted))
+                start = max(end - limit, 0)
+                hasMore = start > 0
+            page = [(ID, formatted[ID - 1]) for ID in range(start + 1, end + 1)]
+        return page, hasMore
+
+    def main(self):
+        while True:
+            toSave = [self.toMessages.get()]  # Get a message from the queue
+            while not self.toMessages.empty():  # And any others which have built up, so they are saved together
+                toSave.append(self.toMessages.get())
+            for message in toSave:
+                self.addMessage(message)
+            self.events.put(events.SaveMessage([self.messageLog, toSave]))
+            for message in toSave:
+                self.toMessages.task_done()  # So that join() knows they have been passed on to be saved
+
+    def join(self) -> None:  # Waits until every message put so far has been passed on to be saved
+        self.toMessages.join()
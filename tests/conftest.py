@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # So the repo's modules can be
+# imported however pytest is run
+
+from benchmarks import common  # noqa: E402
+
+
+@pytest.fixture(params=["threaded", "asyncio"])
+def server(request):  # A server in a fresh directory (served either way), giving its port
+    process, port, workingDirectory = common.startServer("--argon-time-cost", "1", "--argon-memory-cost", "1024",
+                                                         *(["--asyncio"] if request.param == "asyncio" else []))
+    yield port
+    common.stopServer(process, workingDirectory)
+
+
+@pytest.fixture(scope="session")
+def publicKey():
+    return common.getPublicKey()
@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import threading
+import pytest
+import cluster
+from benchmarks import common
+from benchmarks import cluster as clusterBenchmark
+
+
+@pytest.fixture(scope="module")
+def clusterPorts():  # Three servers sharing a database, joined by a broker, giving their ports
+    sharedDirectory = tempfile.mkdtemp(prefix="chatroom-cluster-")
+    brokerPath = os.path.join(sharedDirectory, "broker.sock")
+    broker = cluster.UnixSocketBroker(brokerPath)
+    brokerThread = threading.Thread(target=broker.serveForever, daemon=True)
+    brokerThread.start()
+    servers = [common.startServer("--cluster-socket", brokerPath, "--database",
+                                  os.path.join(sharedDirectory, "database.db"), "--node-id", f"node{i}",
+                                  "--argon-time-cost", "1", "--argon-memory-cost", "1024")
+               for i in range(3)]
+    yield [port for process, port, workingDirectory in servers]
+    for process, port, workingDirectory in servers:
+        common.stopServer(process, workingDirectory)
+    shutil.rmtree(sharedDirectory, ignore_errors=True)
+
+
+def test_a_user_can_only_be_logged_in_on_one_node(clusterPorts, publicKey):
+    assert clusterBenchmark.checkPresence(clusterPorts, publicKey) == {"duplicateLoginRefused": True,
+                                                                       "loginAfterLogout": True}
+
+
+def test_messages_reach_every_node_and_its_history(clusterPorts, publicKey):
+    results = clusterBenchmark.measure(clusterPorts, publicKey, 20)
+    for node in range(len(clusterPorts)):
+        assert results[f"node{node}"]["delivered"] == 20
+    assert results["savedOnLastNode"] == 20
@@ -0,0 +1,70 @@
+import json
+import queue
+import concurrent.futures
+import concurrent.futures.process
+import api
+import events
+import transport
+
+
+def test_bad_encoding_is_refused_without_dropping_the_client(server, publicKey):
+    AESKey, servSocket = api.getConnection("127.0.0.1", server, publicKey)
+    servSocket.settimeout(10)
+    token = api.makeAccount(servSocket, AESKey, "alice", "password")
+    transport.sendDynamicData(json.dumps({"limit": 5}).encode("utf-8"), "getMessages", "bogus-enc", servSocket,
+                              AESKey, 1)
+    dataType, encoding, data, requestID = transport.receiveRequest(servSocket, AESKey)
+    assert (dataType, requestID) == ("error", 1)
+    api.heartBeat(servSocket, AESKey)  # The connection is still being served
+    servSocket.close()
+    AESKey, servSocket = api.getConnection("127.0.0.1", server, publicKey)
+    servSocket.settimeout(10)
+    api.heartBeat(servSocket, AESKey)  # Once the server has seen the first connection go, the user can log in again
+    assert str(api.login(servSocket, AESKey, f"alice:{token['id']}", "password")["id"]) == str(token["id"])
+    servSocket.close()
+
+
+class Client:
+    sessionToken = {"id": "0", "randomBytes": "0", "groupID": "1"}
+
+
+def test_unreadable_requests_become_invalid_requests():
+    services = events.Services(None, None)
+    for dataType, encoding, data in (("message", "utf-8", b'{"message": 3}'), ("message", "utf-8", b"not json"),
+                                     ("login", "bogus-enc", b"{}"), ("getGroups", "binary", b"\xff")):
+        event = events.dispatch(dataType, encoding, data, Client(), services, 1)
+        assert isinstance(event, events.InvalidRequest)
+        assert event.requestID == 1
+
+
+def test_events_get_a_default_context():
+    class Echo(events.Event):
+        clientIndex = 0
+        wireType = "testEcho"
+        schema = {"text": str}
+
+    client = Client()
+    event = events.dispatch("testEcho", "utf-8", b'{"text": "hi"}', client, events.Services(None, None))
+    assert isinstance(event, Echo)
+    assert event.context == [client, {"text": "hi"}]
+    del events.messageTypes["testEcho"]
+
+
+def test_a_failed_password_check_still_gets_a_reply():
+    class HashingPool:  # As though its processes had died
+        def verify(self, hashed, password):
+            future = concurrent.futures.Future()
+            future.set_exception(concurrent.futures.process.BrokenProcessPool("A process died"))
+            return future
+
+    class Storage:
+        def getUser(self, userID):
+            return "alice", "hash"
+
+    eventQueue = queue.Queue()
+    client = Client()
+    events.Login([Storage(), client, "alice:1", "password", None, HashingPool(), eventQueue], 3).handle()
+    event = eventQueue.get_nowait()
+    assert isinstance(event, events.RequestFailed)
+    assert event.context[0] is client
+    assert event.requestID == 3
@@ -0,0 +1,40 @@
+import dispatcher
+import events
+
+
+class Client:
+    def __init__(self):
+        self.sessionToken = {"id": "0", "randomBytes": "0", "groupID": "1"}
+
+
+def queueOf(eventQueue: dispatcher.EventDispatcher, event) -> int:  # Gives which worker's queue an event went to
+    eventQueue.put(event)
+    for index, workerQueue in enumerate(eventQueue.queues):
+        if not workerQueue.empty():
+            workerQueue.get_nowait()
+            return index
+
+
+def test_a_clients_events_stay_on_one_worker_when_its_group_changes():
+    eventQueue = dispatcher.EventDispatcher(8)
+    client = Client()
+    before = queueOf(eventQueue, events.Logout([client]))
+    client.sessionToken["groupID"] = 2  # As GroupSwitch or FinishLogin would
+    assert queueOf(eventQueue, events.Logout([client])) == before
+    client.sessionToken["groupID"] = "1"  # And resetToken
+    assert queueOf(eventQueue, events.FinishLogin([client, "1", "alice", True, None])) == before
+
+
+def test_guests_in_the_default_group_are_spread_over_the_workers():
+    eventQueue = dispatcher.EventDispatcher(8)
+    clients = [Client() for i in range(64)]  # Kept, as they would be while connected
+    used = {queueOf(eventQueue, events.Login([None, client, "alice:1", "password", None, None, None]))
+            for client in clients}
+    assert len(used) > 1
+
+
+def test_relayed_messages_are_kept_in_order_within_their_group():
+    eventQueue = dispatcher.EventDispatcher(8)
+    used = {queueOf(eventQueue, events.RelayedMessage([None, "2", f"message {i}", {}, None, None]))
+            for i in range(16)}
+    assert len(used) == 1
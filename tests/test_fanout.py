@@ -0,0 +1,60 @@
+import queue
+import encryption
+import events
+import fanout
+import presence
+import transport
+
+
+class Client:  # Just what an event needs to reply
+    def __init__(self, maxSize: int = 10):
+        self.outbox = fanout.Outbox(self, maxSize, fanout.DROP)
+
+
+def test_replies_are_queued_with_their_request_id():
+    client = Client()
+    event = events.Event([client], requestID=7)
+    event.clientIndex = 0
+    event.reply(b"done", "didSucceedMessage", "utf-8")
+    assert client.outbox.take() == (b"done", "didSucceedMessage", "utf-8", 7)
+
+
+def test_replies_follow_the_outbox_policy_when_it_is_full():
+    client = Client(maxSize=1)
+    client.outbox.put(b"hello", "message", "utf-8")
+    event = events.Event([client], requestID=1)
+    event.clientIndex = 0
+    event.reply(b"done", "didSucceedMessage", "utf-8")  # Doesn't block, even though nothing is sending
+    assert client.outbox.dropped == 1
+    assert client.outbox.take() == (b"hello", "message", "utf-8", None)
+    assert client.outbox.take() is None
+
+
+def test_a_member_who_leaves_gets_no_more_of_the_groups_frames_or_keys():
+    class Member(Client):
+        def __init__(self, userID: int):
+            super().__init__(100)
+            self.clientSock = type("Sock", (), {"protocolVersion": transport.PROTOCOL_GROUP_KEYS})()
+            self.AESKey = encryption.generateKey()
+            self.sessionToken = {"id": userID, "randomBytes": "ab", "groupID": 2}  # An integer, as after switchGroup
+
+    class Storage:
+        def removeUserFromGroup(self, userID, groupID):
+            pass
+
+    presenceRegistry = presence.PresenceRegistry()
+    groupKeyring = fanout.GroupKeyring()
+    leaver, stayer = Member(1), Member(2)
+    for member in (leaver, stayer):
+        presenceRegistry.joinGroup(member, "2")
+    fanout.broadcast(presenceRegistry.getGroupMembers("2"), b"before", "message", "utf-8", "2", groupKeyring)
+    while leaver.outbox.take() is not None:  # The key, and the message, which they could read
+        pass
+    eventQueue = queue.Queue()
+    events.LeaveGroup([leaver, dict(leaver.sessionToken), "2", Storage(), presenceRegistry, eventQueue,
+                       groupKeyring]).handle()
+    fanout.broadcast(presenceRegistry.getGroupMembers("2"), b"after", "message", "utf-8", "2", groupKeyring)
+    assert leaver.outbox.take() is None  # Even before the queued switch to the default group has been handled
+    assert presenceRegistry.getGroup(leaver) == "1"
+    assert isinstance(eventQueue.get_nowait(), events.GroupSwitch)
+    assert stayer.outbox.take() is not None
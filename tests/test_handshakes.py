@@ -0,0 +1,46 @@
+import socket
+import threading
+import time
+import handshakes
+
+
+def test_a_claimed_socket_is_left_alone_by_the_watchdog():
+    pool = handshakes.HandshakePool(workerCount=1, timeout=0.2)
+    ours, theirs = socket.socketpair()
+    served = threading.Event()
+
+    def handshake(clientSock, claim) -> bool:
+        assert claim()
+        time.sleep(0.5)  # Long past the deadline, as though the client were being served
+        served.set()
+        return True
+
+    pool.submit(ours, handshake)
+    assert served.wait(5)
+    theirs.sendall(b"x")
+    assert ours.recv(1) == b"x"  # Not shut down
+    time.sleep(0.1)
+    assert pool.getStats()["succeeded"] == 1
+    ours.close()
+    theirs.close()
+
+
+def test_a_slow_handshake_times_out():
+    pool = handshakes.HandshakePool(workerCount=1, timeout=0.2)
+    ours, theirs = socket.socketpair()
+    finished = threading.Event()
+    result = []
+
+    def handshake(clientSock, claim) -> bool:
+        clientSock.recv(1)  # The client never sends anything, so this ends when the watchdog shuts the socket down
+        result.append(claim())
+        finished.set()
+        return True
+
+    pool.submit(ours, handshake)
+    assert finished.wait(5)
+    assert result == [False]
+    time.sleep(0.1)
+    assert pool.getStats()["timedOut"] == 1
+    ours.close()
+    theirs.close()
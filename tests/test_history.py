@@ -0,0 +1,53 @@
+import queue
+import threading
+import parsing
+import storage
+
+
+def makeStorage(count: int) -> storage.MessageStorage:  # A group's history of count messages, without a log
+    messageStorage = storage.MessageStorage.__new__(storage.MessageStorage)
+    messageStorage.messagesLock = threading.Lock()
+    messageStorage.formattedMessages = {"1": [f"user: message {ID}" for ID in range(1, count + 1)]}
+    return messageStorage
+
+
+class Client:  # Answers each getMessages request straight away, as the server would
+    def __init__(self, messageStorage: storage.MessageStorage, shownMessages: int):
+        self.messageStorage = messageStorage
+        self.shownMessages = shownMessages
+        self.oldestMessageID = None
+        self.loadingHistory = None
+        self.toGUI = queue.Queue()
+        self.requests = []
+
+    def answer(self, request: dict) -> None:
+        self.requests.append(request)
+        page, hasMore = self.messageStorage.getMessagePage("1", request["limit"], before=request["before"])
+        self.loadingHistory.showPage(self, {"group": "1", "messages": [{"id": ID, "message": message}
+                                                                       for ID, message in page], "hasMore": hasMore})
+
+    def shown(self) -> list:
+        return [line for text in list(self.toGUI.queue) for line in text.split("\n")[2:]]
+
+
+class History(parsing.History):
+    def packToken(self, client):
+        return None
+
+    def sendRequest(self, client, request: dict, typeOfData: str) -> None:
+        client.answer(request)
+
+
+def test_the_first_history_skips_more_messages_than_fit_in_a_page():
+    client = Client(makeStorage(700), 600)  # 600 on screen, so more than a page has to be skipped
+    History(["20"]).handle(client)
+    assert client.shown() == [f"user: message {ID}" for ID in range(81, 101)]
+    assert all(request["limit"] <= storage.MAX_PAGE_SIZE for request in client.requests)
+    History(["20"]).handle(client)  # And the next carries on from there
+    assert client.shown()[20:] == [f"user: message {ID}" for ID in range(61, 81)]
+
+
+def test_history_says_when_everything_is_already_on_screen():
+    client = Client(makeStorage(600), 600)
+    History(["20"]).handle(client)
+    assert list(client.toGUI.queue) == ["\nThere are no earlier messages"]
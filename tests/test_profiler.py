@@ -0,0 +1,51 @@
+import collections
+import json
+import events
+import fanout
+import profiler
+
+
+def test_profiles_finishing_together_get_their_own_files(tmp_path):
+    sampler = profiler.SamplingProfiler(str(tmp_path))
+    files = {sampler.write(collections.Counter({"main;handle": 2}), collections.Counter(), 2, 1.0)["file"]
+             for i in range(5)}
+    assert len(files) == 5
+    assert len(list(tmp_path.iterdir())) == 5
+
+
+class Profiler:  # Records the profile it is asked for, rather than running it
+    seconds = None
+
+    def start(self, seconds, onFinish):
+        self.seconds = seconds
+        return True
+
+
+class Client:  # An admin, as far as the profile is concerned
+    sessionToken = {"id": "1", "randomBytes": "ab", "groupID": "1"}
+
+    def __init__(self):
+        self.outbox = fanout.Outbox(self, 10, fanout.DROP)
+
+
+def profile(request: dict) -> (Profiler, Client):  # Dispatches a profile request the client didn't number
+    sampler = Profiler()
+    client = Client()
+    services = events.Services(None, None, profiler=sampler, adminUsers={"1"})
+    events.dispatch("profile", "utf-8", json.dumps(request).encode("utf-8"), client, services).handle()
+    return sampler, client
+
+
+def test_a_null_length_profiles_for_the_default_time():
+    sampler, client = profile({"seconds": None})
+    assert sampler.seconds == 10
+
+
+def test_lengths_which_cant_be_run_are_refused_with_an_error():
+    for seconds in ("nan", "inf", "-1", 0, "soon", "", profiler.MAX_SECONDS + 1, 10 ** 400):
+        sampler, client = profile({"seconds": seconds})
+        assert sampler.seconds is None
+        data, typeOfData, encoding, requestID = client.outbox.take()
+        assert typeOfData == "error" and b"seconds" in data
+    sampler, client = profile({"seconds": "2.5"})
+    assert sampler.seconds == 2.5
@@ -0,0 +1,70 @@
+import os
+import time
+import storage
+
+
+def openLog(directory) -> storage.MessageLog:
+    return storage.MessageLog(str(directory / "messages"), str(directory / "AES.key"))
+
+
+def test_entries_appended_after_a_torn_entry_can_be_read(tmp_path):
+    log = openLog(tmp_path)
+    for i in range(3):
+        log.append({"group": "1", "message": f"message {i}"})
+    log.segmentFile.close()
+    path = log.getSegmentPath(log.currentSegment)
+    with open(path, "r+b") as file:  # The server stopped part-way through writing the last entry
+        file.truncate(os.path.getsize(path) - 10)
+    log = openLog(tmp_path)
+    for i in range(3, 5):
+        log.append({"group": "1", "message": f"message {i}"})
+    log.segmentFile.close()
+    log = openLog(tmp_path)
+    assert [record["message"] for record in log.replay()] == ["message 0", "message 1", "message 3", "message 4"]
+    log.segmentFile.close()
+
+
+def fillSegments(log: storage.MessageLog, count: int) -> None:  # Appends until count segments have filled up
+    i = 0
+    while log.currentSegment <= count:
+        log.append({"group": "1", "message": f"message {i}"})
+        i += 1
+
+
+def waitForCompaction(log: storage.MessageLog) -> None:
+    deadline = time.monotonic() + 10
+    while log.isCompacting and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_startup_only_reads_the_last_segment_through(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "SEGMENT_SIZE", 1024)
+    monkeypatch.setattr(storage, "COMPACT_AFTER_SEGMENTS", 3)
+    log = openLog(tmp_path)
+    fillSegments(log, 4)
+    waitForCompaction(log)  # Leaves a compacted segment, then one full segment, then the one being written
+    fillSegments(log, log.currentSegment)
+    log.segmentFile.close()
+    scanned = []
+    scanEntries = storage.MessageLog.scanEntries
+    monkeypatch.setattr(storage.MessageLog, "scanEntries",
+                        lambda self, segmentNumber: scanned.append(segmentNumber) or scanEntries(self, segmentNumber))
+    log = openLog(tmp_path)
+    assert scanned == [log.currentSegment]
+    log.segmentFile.close()
+
+
+def test_segments_left_from_before_a_restart_are_compacted_without_waiting_for_a_rollover(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "SEGMENT_SIZE", 1024)
+    monkeypatch.setattr(storage, "COMPACT_AFTER_SEGMENTS", 1000)
+    log = openLog(tmp_path)
+    fillSegments(log, 5)
+    log.segmentFile.close()
+    messages = [record["message"] for record in log.replay()]
+    monkeypatch.setattr(storage, "COMPACT_AFTER_SEGMENTS", 3)  # The limit was lowered while the server was down
+    log = openLog(tmp_path)
+    waitForCompaction(log)
+    assert log.getUncompactedSegments() == []
+    assert log.uncompactedSegments == 0
+    assert [record["message"] for record in log.replay()] == messages
+    log.segmentFile.close()
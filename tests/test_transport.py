@@ -0,0 +1,61 @@
+import socket
+import threading
+import pytest
+import api
+import encryption
+import transport
+
+
+class TrickleSocket:  # Hands over at most a few bytes at a time, as a busy network might
+    def __init__(self, sock: socket.socket, pieceSize: int = 7):
+        self.sock = sock
+        self.pieceSize = pieceSize
+
+    def recv_into(self, buffer) -> int:
+        return self.sock.recv_into(buffer[:self.pieceSize])
+
+
+@pytest.mark.parametrize("protocolVersion", [transport.PROTOCOL_LEGACY, transport.PROTOCOL_FRAMED])
+def test_large_frames_round_trip(protocolVersion):
+    ours, theirs = socket.socketpair()
+    sender = transport.Connection(ours, protocolVersion)
+    receiver = transport.Connection(theirs, protocolVersion)
+    AESKey = encryption.generateKey()
+    sizes = [17 * 1024, 100, 200 * 1024]  # Bigger than a recv is likely to give at once, and than the reader's buffer
+    payloads = [bytes([i]) * size for i, size in enumerate(sizes)]
+
+    def send():
+        for payload in payloads:
+            transport.sendDynamicData(payload, "message", "utf-8", sender, AESKey)
+
+    sending = threading.Thread(target=send)
+    sending.start()
+    for payload in payloads:
+        assert transport.receiveDynamicData(receiver, AESKey) == ("message", "utf-8", payload)
+    sending.join()
+    sender.close()
+    receiver.close()
+
+
+def test_frames_split_into_tiny_pieces_are_put_back_together():
+    ours, theirs = socket.socketpair()
+    receiver = transport.Connection(theirs, transport.PROTOCOL_FRAMED)
+    receiver.reader = transport.SocketReader(TrickleSocket(theirs), bufferSize=64)
+    AESKey = encryption.generateKey()
+    payload = bytes(range(256)) * 80
+    ours.sendall(transport.sealFrame(payload, "message", "utf-8", AESKey, 5))
+    assert transport.receiveRequest(receiver, AESKey) == ("message", "utf-8", payload, 5)
+    ours.close()
+    receiver.close()
+
+
+def test_pipelined_requests_are_answered_in_order(server, publicKey):
+    AESKey, servSocket = api.getConnection("127.0.0.1", server, publicKey)
+    servSocket.settimeout(10)
+    payloads = [bytes([i]) * (20 * 1024 if i % 10 == 0 else 32) for i in range(50)]  # Some bigger than 16 KiB
+    frames = [transport.sealFrame(payload, "doHeartbeat", "none", AESKey, requestID)
+              for requestID, payload in enumerate(payloads, 1)]
+    transport.sendSealedFrame(b"".join(frames), servSocket)  # All at once, without waiting for any replies
+    for requestID, payload in enumerate(payloads, 1):
+        assert transport.receiveRequest(servSocket, AESKey) == ("heartbeatResponse", "none", payload, requestID)
+    servSocket.close()
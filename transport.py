@@ -1,31 +1,180 @@
 import socket
+import asyncio
+import threading
+import contextlib
+import struct
 import encryption
+import metrics
 import json
 
+PROTOCOL_LEGACY = 0  # Headers are sent as encrypted 64 byte chunks, followed by the encrypted data
+PROTOCOL_FRAMED = 1  # The header and data are sealed together into one length-prefixed frame
+PROTOCOL_TICKETS = 2  # After the handshake, the server gives the client a session ticket, which it can use to skip
+# RSA when it reconnects
+PROTOCOL_GROUP_KEYS = 3  # The server may seal a group's messages once with a key shared by the group (sent to each
+# member over their own connection), rather than once per member
+PROTOCOL_REQUEST_IDS = 4  # Clients may number their requests, and the server gives the number back with the reply,
+# so that several requests can be waiting at once
+PROTOCOL_BINARY = 5  # Structured payloads are packed with codec rather than sent as JSON, with session tokens as
+# typed fields rather than JSON text. Payloads say which they are in their encoding, so JSON is still understood
+PROTOCOL_VERSION = PROTOCOL_BINARY  # The newest version of the protocol which this code can speak
+HANDSHAKE_SIZE = 256  # The size of the RSA-encrypted key a client starts with (or the resume request sent instead)
+RESUME_MAGIC = b"RESUME"  # Starts a resume request, which is laid out as: magic, client nonce (32 bytes), ticket,
+# then zeros up to HANDSHAKE_SIZE
+RESUME_REPLY_SIZE = 1 + 32  # Whether the ticket was accepted (1 byte), then the server's nonce
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # The largest frame which will be accepted
+FRAME_SEALED = 0  # A kind of frame which is sealed with the connection's own key
+FRAME_GROUP_SEALED = 1  # A kind of frame which is sealed with a group's key, and starts with the key's ID
+FRAME_GROUP_KEY = 2  # A kind of frame which is sealed with the connection's own key, and gives a group key's ID
+# and the key itself
+MAX_GROUP_KEYS = 16  # How many group keys a client keeps (older ones are forgotten as keys are replaced)
+frameHeader = struct.Struct(">IB")  # The length of the rest of the frame (4 bytes), then the kind of frame (1 byte)
+groupKeyID = struct.Struct(">I")  # Identifies which group key a frame is sealed with
+FLAG_REQUEST_ID = 1  # Set in a frame's flags when a request ID (4 bytes) follows them
+requestIDField = struct.Struct(">I")
+bytesSent = metrics.registry.counter("chatroom_bytes_sent_total", "Bytes sent to every connection")
+bytesReceived = metrics.registry.counter("chatroom_bytes_received_total", "Bytes received from every connection")
+
+
+def countSent(stream, numOfBytes: int) -> None:  # Adds to the bytes sent over a connection (kept by whatever does
+    # the sending: a Connection, AsyncSocket or stream writer) and to the total
+    stream.bytesSent = getattr(stream, "bytesSent", 0) + numOfBytes
+    bytesSent.inc(numOfBytes)
+
+
+def countReceived(stream, numOfBytes: int) -> None:  # The same as countSent, for received bytes (kept by a
+    # SocketReader or stream reader)
+    stream.bytesReceived = getattr(stream, "bytesReceived", 0) + numOfBytes
+    bytesReceived.inc(numOfBytes)
+
+
+class SocketReader:  # Reads exact amounts of data from a socket, using one reusable buffer rather than making new
+    # bytes objects for every recv
+    def __init__(self, sock: socket.socket, bufferSize: int = 65536):
+        self.sock = sock
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Where the data which hasn't been read yet starts in the buffer
+        self.end = 0  # And where it ends
+
+    def read(self, numOfBytes: int) -> memoryview:  # Gives exactly numOfBytes from the socket. The memoryview is
+        # only valid until the next read, so it should be copied (with bytes()) if it needs to be kept
+        if self.end - self.start < numOfBytes:
+            self.fill(numOfBytes)
+        data = self.view[self.start:self.start + numOfBytes]
+        self.start += numOfBytes
+        return data
+
+    def fill(self, numOfBytes: int) -> None:  # Receives from the socket until numOfBytes are waiting in the buffer
+        if self.start + numOfBytes > len(self.buffer):  # If the data won't fit after where it starts,
+            waiting = self.end - self.start
+            if numOfBytes > len(self.buffer):  # Make the buffer bigger if it is too small altogether
+                newBuffer = bytearray(max(numOfBytes, len(self.buffer) * 2))
+                newBuffer[:waiting] = self.view[self.start:self.end]
+                self.buffer = newBuffer
+                self.view = memoryview(self.buffer)
+            else:  # Otherwise, move the waiting data to the front of the buffer
+                self.buffer[:waiting] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = waiting
+        while self.end - self.start < numOfBytes:
+            received = self.sock.recv_into(self.view[self.end:])
+            if received == 0:  # If the socket has been closed,
+                raise ConnectionResetError("The connection was closed")
+            self.end += received
+            countReceived(self, received)
+
+
+class Connection:  # Wraps a socket, remembering which version of the protocol is spoken over it
+    def __init__(self, sock: socket.socket, protocolVersion: int = PROTOCOL_LEGACY):
+        self.sock = sock
+        self.protocolVersion = protocolVersion
+        self.reader = SocketReader(sock)
+        self.sendLock = threading.Lock()  # Stops frames sent from different threads being mixed together
+        self.groupKeys = {}  # Maps the ID of each group key the server has given to the key
+        self.cipherContext = None  # Seals what is sent over the connection, once its key is known
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Each send is a whole frame (or handshake
+            # step), so there is nothing to gain from waiting to merge it with the next one, and the handshake's
+            # back-and-forth would otherwise stall on delayed ACKs
+        except OSError:  # If it isn't a TCP socket
+            pass
+
+    def send(self, data: bytes) -> int:  # Sends all the data, rather than however much the OS will take at once
+        self.sock.sendall(data)
+        countSent(self, len(data))
+        return len(data)
+
+    def close(self) -> None:  # Drops the cipher context, so the key isn't kept after the connection is closed
+        self.cipherContext = None
+        self.sock.close()
+
+    def __getattr__(self, name):  # Anything else (recv, connect, shutdown...) is passed on to the socket
+        return getattr(self.sock, name)
+
+
+class AsyncSocket:  # Wraps an asyncio stream writer so that threads outside the event loop can send to it like a
+    # normal socket
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop):
+        self.writer = writer
+        self.loop = loop
+        self.protocolVersion = PROTOCOL_LEGACY
+        self.sendLock = threading.Lock()
+        self.cipherContext = None
+
+    def send(self, data: bytes) -> int:  # Queues the data to be written by the event loop
+        self.loop.call_soon_threadsafe(self.writer.write, bytes(data))
+        countSent(self, len(data))
+        return len(data)
+
+    def close(self) -> None:
+        self.cipherContext = None
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+    def shutdown(self, how: int) -> None:  # Drops the connection straight away
+        self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
 
 def receiveData(numOfBytes: int,
                 socketToReceiveFrom: socket.socket) -> bytes:  # Receives a certain number of bytes from a socket
-    return socketToReceiveFrom.recv(numOfBytes)
+    return bytes(receiveView(numOfBytes, socketToReceiveFrom))
 
 
 def sendData(data: bytes, socketToSendTo: socket.socket) -> None:  # Sends raw data to a socket
     socketToSendTo.send(data)
 
 
+def getCipherContext(AESKey: bytes, stream=None) -> encryption.CipherContext:  # Gives the cipher context a stream
+    # (a Connection, AsyncSocket or stream writer) keeps for its key, making it if the stream doesn't have one yet.
+    # Without a stream, or with one which can't keep it (such as a plain socket), the context is only used once
+    context = getattr(stream, "cipherContext", None)
+    if context is not None and context.key == AESKey:
+        return context
+    context = encryption.CipherContext(AESKey)
+    if isinstance(stream, (Connection, AsyncSocket, asyncio.StreamWriter)):
+        stream.cipherContext = context
+    return context
+
+
+def openSealed(sealed: memoryview, AESKey: bytes) -> bytes:  # Decrypts and verifies the nonce, ciphertext and tag
+    return encryption.decryptDataAES(AESKey, sealed[16:-16], sealed[:16], sealed[-16:])
+
+
+def encryptForSending(dataToSend: bytes, AESKey: bytes) -> bytes:  # Encrypts data into the form it is sent in
+    return bytes(encryption.CipherContext(AESKey).seal(dataToSend))  # The nonce, ciphertext and tag
+
+
 def sendEncryptedData(dataToSend: bytes, socketToSendTo: socket.socket,
                       AESKey: bytes) -> None:  # Sends encrypted data to a socket:
-    nonce, ciphertext, tag = encryption.encryptDataAES(dataToSend, AESKey)
-    totalEncryptedData = nonce + ciphertext + tag
-    socketToSendTo.send(totalEncryptedData)
+    with getattr(socketToSendTo, "sendLock", contextlib.nullcontext()):  # The sealed data is in the context's
+        # buffer until it has been sent
+        socketToSendTo.send(getCipherContext(AESKey, socketToSendTo).seal(dataToSend))
 
 
 def receiveEncryptedData(lengthOfData: int, socketToReceiveFrom: socket.socket,
                          AESKey: bytes) -> bytes:  # Receives encrypted data from a socket
-    nonce = socketToReceiveFrom.recv(16)
-    ciphertext = socketToReceiveFrom.recv(lengthOfData)
-    tag = socketToReceiveFrom.recv(16)
-    plaintext = encryption.decryptDataAES(AESKey, ciphertext, nonce, tag)
-    return plaintext
+    return openSealed(receiveView(16 + lengthOfData + 16, socketToReceiveFrom), AESKey)  # The nonce, ciphertext
+    # and tag
 
 
 def generateHeader(data: bytes, typeOfData: str,
@@ -51,7 +200,10 @@ def receiveHeader(socketToReceiveFrom: socket.socket, AESKey: bytes) -> dict:  #
     headerChunks = [b"a"]
     while 0 != headerChunks[-1][-1]:  # While the padding has not been detected,
         headerChunks.append(receiveEncryptedData(64, socketToReceiveFrom, AESKey))  # Receive the header from the socket
-    headerChunks = headerChunks[1:]
+    return chunksToHeader(headerChunks[1:])
+
+
+def chunksToHeader(headerChunks: list) -> dict:  # Turns a list of received chunks back into one header
     rawHeader = b""
     for chunk in headerChunks:
         rawHeader += chunk  # Add all the chunks
@@ -69,16 +221,339 @@ def sendHeader(socketToSendTo: socket.socket, header: bytes, AESKey: bytes) -> N
         sendEncryptedData(chunk, socketToSendTo, AESKey)
 
 
+def receiveView(numOfBytes: int, socketToReceiveFrom: socket.socket) -> memoryview:  # Receives exactly a certain
+    # number of bytes from a socket, however the OS splits them up. The memoryview is only valid until the next receive
+    if hasattr(socketToReceiveFrom, "reader"):
+        return socketToReceiveFrom.reader.read(numOfBytes)
+    data = bytearray()  # Plain sockets don't have a reader, so are read from directly
+    while len(data) < numOfBytes:
+        received = socketToReceiveFrom.recv(numOfBytes - len(data))
+        if not received:  # If the socket has been closed,
+            raise ConnectionResetError("The connection was closed")
+        data += received
+    return memoryview(data)
+
+
+def makeFramePlaintext(data: bytes, typeOfData: str, encoding: str, requestID: int = None) -> bytes:  # Lays out a
+    # header and data as they are sealed in a frame: flags, the request ID (if there is one), then the type, encoding
+    # and data
+    typeBytes = typeOfData.encode("ascii")
+    encodingBytes = encoding.encode("ascii")
+    if requestID is None:
+        prefix = b"\x00"
+    else:
+        prefix = bytes([FLAG_REQUEST_ID]) + requestIDField.pack(requestID)
+    return prefix + bytes([len(typeBytes)]) + typeBytes + bytes([len(encodingBytes)]) + encodingBytes + data
+
+
+def readFramePlaintext(plaintext: bytes) -> (str, str, bytes, int):  # Gives the type, encoding, data and request
+    # ID (or None) laid out in a frame
+    start = 1
+    requestID = None
+    if plaintext[0] & FLAG_REQUEST_ID:
+        requestID = requestIDField.unpack(plaintext[1:1 + requestIDField.size])[0]
+        start += requestIDField.size
+    typeLength = plaintext[start]
+    typeOfData = plaintext[start + 1:start + 1 + typeLength].decode("ascii")
+    encodingLength = plaintext[start + 1 + typeLength]
+    encodingStart = start + 2 + typeLength
+    encoding = plaintext[encodingStart:encodingStart + encodingLength].decode("ascii")
+    return typeOfData, encoding, plaintext[encodingStart + encodingLength:], requestID
+
+
+def sealFrameInto(output, plaintext: bytes, context: encryption.CipherContext) -> None:  # Writes the frame header,
+    # then encrypts the plaintext straight after it, rather than joining the pieces together afterwards
+    frameHeader.pack_into(output, 0, 16 + len(plaintext) + 16 + 1, FRAME_SEALED)
+    context.sealInto(memoryview(output)[frameHeader.size:], plaintext)
+
+
+def sealFrame(data: bytes, typeOfData: str, encoding: str, AESKey: bytes, requestID: int = None,
+              context: encryption.CipherContext = None) -> bytes:  # Seals a header and data into one frame with a
+    # single encryption, in a buffer of its own (so it can be kept, unlike the frames sendDynamicData seals)
+    plaintext = makeFramePlaintext(data, typeOfData, encoding, requestID)
+    frame = bytearray(frameHeader.size + 16 + len(plaintext) + 16)
+    sealFrameInto(frame, plaintext, context or encryption.CipherContext(AESKey))
+    return frame
+
+
+def sealGroupFrame(data: bytes, typeOfData: str, encoding: str, keyID: int,
+                   groupContext: encryption.CipherContext) -> bytes:  # Seals a header and data with a group's key, so
+    # the same frame can be sent to every member of the group
+    plaintext = makeFramePlaintext(data, typeOfData, encoding)
+    sealedLength = 16 + len(plaintext) + 16
+    sealedStart = frameHeader.size + groupKeyID.size
+    frame = bytearray(sealedStart + sealedLength)
+    frameHeader.pack_into(frame, 0, groupKeyID.size + sealedLength + 1, FRAME_GROUP_SEALED)
+    groupKeyID.pack_into(frame, frameHeader.size, keyID)
+    groupContext.sealInto(memoryview(frame)[sealedStart:], plaintext)
+    return bytes(frame)  # Made immutable, as it is shared between every member's outbox
+
+
+def makeGroupKeyFrame(keyID: int, groupKey: bytes, AESKey: bytes) -> bytes:  # Seals a group's key (and its ID) with
+    # a member's own key, to be sent before any frame sealed with it
+    plaintext = groupKeyID.pack(keyID) + groupKey
+    sealedLength = 16 + len(plaintext) + 16
+    frame = bytearray(frameHeader.size + sealedLength)
+    frameHeader.pack_into(frame, 0, sealedLength + 1, FRAME_GROUP_KEY)
+    encryption.CipherContext(AESKey).sealInto(memoryview(frame)[frameHeader.size:], plaintext)
+    return frame
+
+
+def storeGroupKey(body: memoryview, AESKey: bytes, groupKeys: dict) -> None:  # Opens the body of a group key frame,
+    # keeping the key (and forgetting the oldest one if there are too many)
+    if len(body) != 16 + groupKeyID.size + 32 + 16:
+        raise ValueError("Invalid frame")
+    plaintext = openSealed(body, AESKey)
+    groupKeys[groupKeyID.unpack(plaintext[:groupKeyID.size])[0]] = bytes(plaintext[groupKeyID.size:])
+    while len(groupKeys) > MAX_GROUP_KEYS:
+        del groupKeys[next(iter(groupKeys))]  # Dictionaries keep their order, so the first key is the oldest
+
+
+def openFrame(kind: int, body: memoryview, AESKey: bytes, groupKeys: dict = None) -> (str, str, bytes, int):  # Gives
+    # the type, encoding, data and request ID in the body of a frame (everything after the frame header). Frames
+    # sealed with a group's key are opened with the matching key from groupKeys
+    if kind == FRAME_GROUP_SEALED and groupKeys is not None and len(body) >= groupKeyID.size + 32:
+        keyID = groupKeyID.unpack(body[:groupKeyID.size])[0]
+        if keyID not in groupKeys:
+            raise ValueError("Unknown group key")
+        AESKey = groupKeys[keyID]
+        body = body[groupKeyID.size:]
+    elif kind != FRAME_SEALED or len(body) < 32:
+        raise ValueError("Invalid frame")
+    return readFramePlaintext(openSealed(body, AESKey))
+
+
+def readFrameHeader(rawHeader: memoryview) -> (int, int):  # Gives the length of the frame's body, and its kind
+    length, kind = frameHeader.unpack(rawHeader)
+    if not 1 <= length <= MAX_FRAME_SIZE:
+        raise ValueError("Invalid frame length")
+    return length - 1, kind
+
+
 def sendDynamicData(data: bytes, typeOfData: str, encoding: str, socketToSendTo: socket.socket,
-                    AESKey: bytes) -> None:  # Sends data of dynamic size to a socket
-    header = generateHeader(data, typeOfData, encoding)  # Generate and send the header
-    sendHeader(socketToSendTo, header, AESKey)
-    sendEncryptedData(data, socketToSendTo, AESKey)  # Then send the actual data
+                    AESKey: bytes, requestID: int = None) -> None:  # Sends data of dynamic size to a socket, with
+    # the ID of the request it is a reply to (or, from a client, the ID of the request), if there is one
+    with getattr(socketToSendTo, "sendLock", contextlib.nullcontext()):  # Stops frames from different threads being
+        # mixed together, and from being sealed into the connection's buffer while it is still being sent
+        context = getCipherContext(AESKey, socketToSendTo)
+        if getattr(socketToSendTo, "protocolVersion", PROTOCOL_LEGACY) >= PROTOCOL_FRAMED:
+            plaintext = makeFramePlaintext(data, typeOfData, encoding, requestID)
+            frame = context.reserve(frameHeader.size + 16 + len(plaintext) + 16)
+            sealFrameInto(frame, plaintext, context)
+        else:
+            header = generateHeader(data, typeOfData, encoding)  # Generate the header
+            frame = context.sealEach(headerToChunks(header) + [data])  # Then the actual data, so that it is all
+            # sent at once
+        socketToSendTo.send(frame)
+
+
+def sendSealedFrame(frame: bytes, socketToSendTo: socket.socket) -> None:  # Sends a frame which has already been
+    # sealed (such as one sealed with a group's key)
+    with getattr(socketToSendTo, "sendLock", contextlib.nullcontext()):
+        socketToSendTo.send(frame)
 
 
 def receiveDynamicData(socketToReceiveFrom: socket.socket, AESKey: bytes) -> (str, str, bytes):  # Receives data of
     # dynamic size from a socket
+    return receiveRequest(socketToReceiveFrom, AESKey)[:3]
+
+
+def receiveRequest(socketToReceiveFrom: socket.socket, AESKey: bytes) -> (str, str, bytes, int):  # Receives data of
+    # dynamic size from a socket, along with its request ID (or None)
+    if getattr(socketToReceiveFrom, "protocolVersion", PROTOCOL_LEGACY) >= PROTOCOL_FRAMED:
+        groupKeys = getattr(socketToReceiveFrom, "groupKeys", None)
+        while True:
+            length, kind = readFrameHeader(receiveView(frameHeader.size, socketToReceiveFrom))
+            body = receiveView(length, socketToReceiveFrom)
+            if kind != FRAME_GROUP_KEY or groupKeys is None:
+                return openFrame(kind, body, AESKey, groupKeys)
+            storeGroupKey(body, AESKey, groupKeys)  # Group keys are kept by the socket rather than given to the
+            # caller, and the next frame is waited for instead
     header = receiveHeader(socketToReceiveFrom, AESKey)  # Firstly, receive the header
     sizeOfData = header["length"]  # To know the length of data
     data = receiveEncryptedData(sizeOfData, socketToReceiveFrom, AESKey)  # Then, receive the actual data
-    return header["type"], header["encoding"], data
+    return header["type"], header["encoding"], data, None
+
+
+def makeHandshakeFlags(isAPI: bool, protocolVersion: int) -> bytes:  # The byte a client sends after its AES key,
+    # saying whether it is an API and the newest protocol it speaks (older clients only send 0 or 1)
+    return bytes([int(isAPI) | (protocolVersion << 1)])
+
+
+def readHandshakeFlags(flags: bytes) -> (bool, int):  # Gives whether a client is an API, and its newest protocol
+    return flags[0] & 1 == 1, flags[0] >> 1
+
+
+def requestProtocol(socketToSendTo: socket.socket, AESKey: bytes, isAPI: bool) -> int:  # Used by clients to
+    # finish a handshake, agreeing on which version of the protocol to use
+    sendEncryptedData(makeHandshakeFlags(isAPI, PROTOCOL_VERSION), socketToSendTo, AESKey)
+    protocolVersion = receiveEncryptedData(1, socketToSendTo, AESKey)[0]  # The server replies with the version to use
+    socketToSendTo.protocolVersion = protocolVersion
+    if protocolVersion >= PROTOCOL_TICKETS:
+        socketToSendTo.sessionTicket = receiveSessionTicket(socketToSendTo, AESKey)  # Kept, so the next connection
+        # can be resumed
+    return protocolVersion
+
+
+def connectToServer(socketToSendTo: socket.socket, publicKey, isAPI: bool,
+                    sessionTicket: (bytes, bytes) = None) -> bytes:  # Used by clients to perform a whole handshake
+    # with a (connected) server, resuming the session with the ticket if there is one, and giving the AES key. The new
+    # ticket (if any) is left in the socket's sessionTicket
+    AESKey = None
+    if sessionTicket is not None:
+        AESKey = resumeSession(socketToSendTo, sessionTicket)
+    if AESKey is None:  # If there is no ticket, or the server didn't accept it, send a key with RSA
+        AESKey = encryption.generateKey()
+        sendData(encryption.encryptDataRSA(publicKey, AESKey), socketToSendTo)
+    requestProtocol(socketToSendTo, AESKey, isAPI)
+    return AESKey
+
+
+def sendSessionTicket(socketToSendTo: socket.socket, AESKey: bytes, ticketIssuer) -> None:  # Used by servers to
+    # give a client a ticket (and the secret in it) at the end of a handshake
+    secret, ticket = ticketIssuer.issue()
+    sendEncryptedData(secret + ticket, socketToSendTo, AESKey)
+
+
+def receiveSessionTicket(socketToReceiveFrom: socket.socket, AESKey: bytes) -> (bytes, bytes):  # Gives the secret
+    # and ticket sent by the server
+    secretAndTicket = receiveEncryptedData(32 + encryption.TICKET_SIZE, socketToReceiveFrom, AESKey)
+    return secretAndTicket[:32], secretAndTicket[32:]
+
+
+def isResumeRequest(handshake: bytes) -> bool:  # Whether a client sent a resume request rather than an RSA-encrypted
+    # key (RSA ciphertext is random, so it is vanishingly unlikely to start with the magic)
+    return handshake[:len(RESUME_MAGIC)] == RESUME_MAGIC
+
+
+def resumeSession(socketToSendTo: socket.socket, sessionTicket: (bytes, bytes)) -> bytes:  # Used by clients to start
+    # a handshake with a ticket, giving the new AES key, or None if the server wouldn't accept the ticket (in which
+    # case the client should carry on with RSA)
+    secret, ticket = sessionTicket
+    clientNonce = encryption.generateKey()
+    sendData((RESUME_MAGIC + clientNonce + ticket).ljust(HANDSHAKE_SIZE, b"\0"), socketToSendTo)
+    reply = receiveData(RESUME_REPLY_SIZE, socketToSendTo)
+    if reply[0] != 1:
+        return None
+    return encryption.deriveResumedKey(secret, clientNonce, reply[1:])
+
+
+def acceptResumption(handshake: bytes, socketToSendTo: socket.socket, ticketIssuer) -> bytes:  # Used by servers to
+    # answer a resume request, giving the new AES key, or None if the ticket isn't valid (in which case the client
+    # sends an RSA-encrypted key next)
+    clientNonce = handshake[len(RESUME_MAGIC):len(RESUME_MAGIC) + 32]
+    ticket = handshake[len(RESUME_MAGIC) + 32:len(RESUME_MAGIC) + 32 + encryption.TICKET_SIZE]
+    secret = ticketIssuer.redeem(ticket)
+    if secret is None:
+        sendData(bytes(RESUME_REPLY_SIZE), socketToSendTo)
+        return None
+    serverNonce = encryption.generateKey()
+    sendData(b"\x01" + serverNonce, socketToSendTo)
+    return encryption.deriveResumedKey(secret, clientNonce, serverNonce)
+
+
+def chooseProtocol(clientVersion: int, newestVersion: int = PROTOCOL_VERSION) -> int:  # Used by servers to pick the
+    # protocol to speak with a client (the newest both speak, up to newestVersion)
+    return min(clientVersion, newestVersion)
+
+
+def usesBinary(connection) -> bool:  # Whether structured payloads sent over a connection are packed with codec
+    return getattr(connection, "protocolVersion", PROTOCOL_LEGACY) >= PROTOCOL_BINARY
+
+
+async def receiveDataAsync(numOfBytes: int,
+                           reader: asyncio.StreamReader) -> bytes:  # Receives a certain number of bytes from a stream
+    data = await reader.readexactly(numOfBytes)
+    countReceived(reader, numOfBytes)
+    return data
+
+
+async def receiveEncryptedDataAsync(lengthOfData: int, reader: asyncio.StreamReader,
+                                    AESKey: bytes) -> bytes:  # Receives encrypted data from a stream
+    nonce = await reader.readexactly(16)
+    ciphertext = await reader.readexactly(lengthOfData)
+    tag = await reader.readexactly(16)
+    countReceived(reader, 16 + lengthOfData + 16)
+    plaintext = encryption.decryptDataAES(AESKey, ciphertext, nonce, tag)
+    return plaintext
+
+
+async def receiveHeaderAsync(reader: asyncio.StreamReader, AESKey: bytes) -> dict:  # Receives a header from a stream
+    headerChunks = [b"a"]
+    while 0 != headerChunks[-1][-1]:  # While the padding has not been detected,
+        headerChunks.append(await receiveEncryptedDataAsync(64, reader, AESKey))  # Receive the next chunk
+    return chunksToHeader(headerChunks[1:])
+
+
+async def sendDynamicDataAsync(data: bytes, typeOfData: str, encoding: str, writer: asyncio.StreamWriter,
+                               AESKey: bytes, protocolVersion: int = PROTOCOL_LEGACY,
+                               requestID: int = None) -> None:  # Sends data of dynamic size to a stream
+    context = getCipherContext(AESKey, writer)  # Frames aren't sealed into the context's buffer here, as the
+    # writer may keep what it is given until it has been sent
+    if protocolVersion >= PROTOCOL_FRAMED:
+        frame = sealFrame(data, typeOfData, encoding, AESKey, requestID, context)
+    else:
+        header = generateHeader(data, typeOfData, encoding)
+        frame = bytes(context.sealEach(headerToChunks(header) + [data]))
+    writer.write(frame)
+    countSent(writer, len(frame))
+    await writer.drain()  # Wait until the stream is ready for more data
+
+
+async def receiveDynamicDataAsync(reader: asyncio.StreamReader, AESKey: bytes,
+                                  protocolVersion: int = PROTOCOL_LEGACY) -> (str, str, bytes):  # Receives data of
+    # dynamic size from a stream
+    return (await receiveRequestAsync(reader, AESKey, protocolVersion))[:3]
+
+
+async def receiveRequestAsync(reader: asyncio.StreamReader, AESKey: bytes, protocolVersion: int = PROTOCOL_LEGACY,
+                              groupKeys: dict = None) -> (str, str, bytes, int):  # Receives data of dynamic size
+    # from a stream, along with its request ID (or None). Clients give the group keys they have been sent, which
+    # group key frames are stored in
+    if protocolVersion >= PROTOCOL_FRAMED:
+        while True:
+            length, kind = readFrameHeader(await reader.readexactly(frameHeader.size))
+            body = memoryview(await reader.readexactly(length))
+            countReceived(reader, frameHeader.size + length)
+            if kind != FRAME_GROUP_KEY or groupKeys is None:
+                return openFrame(kind, body, AESKey, groupKeys)
+            storeGroupKey(body, AESKey, groupKeys)
+    header = await receiveHeaderAsync(reader, AESKey)
+    data = await receiveEncryptedDataAsync(header["length"], reader, AESKey)
+    return header["type"], header["encoding"], data, None
+
+
+async def resumeSessionAsync(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                             sessionTicket: (bytes, bytes)) -> bytes:  # The same as resumeSession, over a stream
+    secret, ticket = sessionTicket
+    clientNonce = encryption.generateKey()
+    writer.write((RESUME_MAGIC + clientNonce + ticket).ljust(HANDSHAKE_SIZE, b"\0"))
+    reply = await reader.readexactly(RESUME_REPLY_SIZE)
+    if reply[0] != 1:
+        return None
+    return encryption.deriveResumedKey(secret, clientNonce, reply[1:])
+
+
+async def requestProtocolAsync(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, AESKey: bytes,
+                               isAPI: bool) -> (int, (bytes, bytes)):  # The same as requestProtocol, over a stream,
+    # giving the version to use and the session ticket (or None)
+    writer.write(encryptForSending(makeHandshakeFlags(isAPI, PROTOCOL_VERSION), AESKey))
+    protocolVersion = (await receiveEncryptedDataAsync(1, reader, AESKey))[0]
+    sessionTicket = None
+    if protocolVersion >= PROTOCOL_TICKETS:
+        secretAndTicket = await receiveEncryptedDataAsync(32 + encryption.TICKET_SIZE, reader, AESKey)
+        sessionTicket = secretAndTicket[:32], secretAndTicket[32:]
+    return protocolVersion, sessionTicket
+
+
+async def connectToServerAsync(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, publicKey, isAPI: bool,
+                               sessionTicket: (bytes, bytes) = None) -> (bytes, int, (bytes, bytes)):  # The same as
+    # connectToServer, over a stream, giving the AES key, the version of the protocol to use and the new session ticket
+    AESKey = None
+    if sessionTicket is not None:
+        AESKey = await resumeSessionAsync(reader, writer, sessionTicket)
+    if AESKey is None:
+        AESKey = encryption.generateKey()
+        writer.write(encryption.encryptDataRSA(publicKey, AESKey))
+    protocolVersion, newTicket = await requestProtocolAsync(reader, writer, AESKey, isAPI)
+    return AESKey, protocolVersion, newTicket